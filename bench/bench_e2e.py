@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# End to end throughput against the stand-in hosts in bench/emulator.py.
+#
+# Each scenario runs in its own process, with its own emulator process and
+# a scratch directory, so class-level state (caches, the scheduler, the
+# ranker) and peak RSS start fresh every time.  It resolves the scenario's
+# tosho ids with ToshoResolver, which hands the files to FileDownloader as
+# usual, and reports:
+#   MB/s        bytes of finished files / wall time
+#   CPU         user + system seconds of the downloading process
+#   RSS         peak resident set size of the downloading process
+#   lag         how late a 10ms sleep wakes up, max and 99th percentile
+#   write       mean milliseconds per block written by the DiskWriter
+#   phases      mean seconds in each Metrics phase
+#
+#   bench/bench_e2e.py [--repeat N] [--verbose] [scenario ...]
+#   bench/bench_e2e.py --list
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import asyncio
+import resource
+import tempfile
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+
+MB = 1048576
+
+def files(count, size, sources=('GoFile',), pieces=1, prefix='file'):
+    return [ { 'name': f'{ prefix } { i + 1:02d}.mkv', 'size': size, 'pieces': pieces, 'sources': list(sources) }
+             for i in range(count) ]
+
+def single_items(count, size, **kwargs):
+    return [ { 'id': 100 + i, 'title': f'Show - { i + 1:02d}', 'files': files(1, size, prefix=f'Show { i + 1:02d}', **kwargs) }
+             for i in range(count) ]
+
+# name => (description, emulator config, class attributes to set)
+scenarios = {
+    'gofile': ('4 single files of 32 MB from GoFile, no limits',
+               { 'items': single_items(4, 32 * MB) }, { }),
+    'gofile-slow': ('the same, at 8 MB/s per connection with 50ms latency',
+                    { 'items': single_items(4, 32 * MB),
+                      'default': { 'latency': 0.05 },
+                      'hosts': { 'store1.gofile.io': { 'bandwidth': 8 * MB } } }, { }),
+    'buzzheavier-batch': ('a batch of 8 files of 8 MB from BuzzHeavier at 4 MB/s per connection',
+                          { 'items': [ { 'id': 200, 'title': 'Batch', 'files': files(8, 8 * MB, sources=[ 'BuzzHeavier' ]) } ],
+                            'hosts': { 'buzzheavier.com': { 'bandwidth': 4 * MB } } }, { }),
+    'split-pieces': ('2 files of 48 MB in 3 pieces each, joined afterwards',
+                     { 'items': single_items(2, 48 * MB, pieces=3) }, { }),
+    'split-direct': ('the same, with the pieces written in place',
+                     { 'items': single_items(2, 48 * MB, pieces=3) },
+                     { 'FileDownloader.direct_write': True }),
+    'scrapers': ('2 files each from ClickNUpload and DailyUploads, 8 MB at 4 MB/s',
+                 { 'items': [ { 'id': 300, 'title': 'Scraped',
+                                'files': files(2, 8 * MB, sources=[ 'ClickNUpload' ], prefix='cnu')
+                                       + files(2, 8 * MB, sources=[ 'DailyUploads' ], prefix='du') } ],
+                   'default': { 'bandwidth': 4 * MB } }, { }),
+    'flaky': ('4 files of 16 MB from GoFile and BuzzHeavier; 10% of transfers get a 503 and 10% are cut off',
+              { 'items': single_items(4, 16 * MB, sources=[ 'GoFile', 'BuzzHeavier' ]),
+                'hosts': { h: { 'error_rate': 0.1, 'drop_rate': 0.1, 'retry_after': 1 } for h in ('store1.gofile.io', 'buzzheavier.com') } },
+              { }),
+}
+
+# Stands in for the console, so the downloaders' output doesn't get in the
+# way of the numbers unless asked for
+class Console(object):
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    def write(self, data):
+        if self.verbose:
+            sys.stderr.buffer.write(data)
+
+    async def drain(self):
+        pass
+
+async def monitor_lag(samples, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+# Run one scenario in this process and return the results
+def run_scenario(name, verbose):
+    description, config, settings = scenarios[name]
+    config = dict(config, seed=1)
+    tmp = tempfile.mkdtemp(prefix='toshodl-bench-')
+    os.environ['TOSHODL_STATE_DIR'] = os.path.join(tmp, '.toshodl')
+    os.chdir(tmp)
+    random.seed(1)
+
+    with open('emulator.json', 'w') as fh:
+        json.dump(config, fh)
+    emulator_proc = subprocess.Popen([ sys.executable, os.path.join(bench_dir, 'emulator.py'), 'emulator.json' ],
+                                     stdout=subprocess.PIPE)
+    try:
+        port = int(emulator_proc.stdout.readline())
+
+        import emulator
+        from toshodl import AsyncConsole
+        from toshodl.HttpClient import HttpClient
+        from toshodl.ToshoResolver import ToshoResolver
+        from toshodl.Metrics import metrics
+        from toshodl.ProgressBoard import board
+        from toshodl import FileDownloader
+        from toshodl.ClickNUploadDownloader import ClickNUploadDownloader
+        from toshodl.DailyUploadsDownloader import DailyUploadsDownloader
+
+        AsyncConsole.cache_stdout = Console(verbose)
+        board.mode = 'off'
+        emulator.install(HttpClient.pool, port)
+        # These aren't used by default any more, but the scenarios can ask for them
+        FileDownloader.download_classes.setdefault('ClickNUpload', ClickNUploadDownloader)
+        FileDownloader.download_classes.setdefault('DailyUploads', DailyUploadsDownloader)
+        classes = { 'FileDownloader': FileDownloader.FileDownloader }
+        classes.update({ cls.__name__: cls for cls in FileDownloader.download_classes.values() })
+        for key, value in settings.items():
+            cls, attr = key.split('.')
+            setattr(classes[cls], attr, value)
+
+        lag = [ ]
+        async def drive():
+            monitor = asyncio.create_task(monitor_lag(lag))
+            async with asyncio.TaskGroup() as tg:
+                for item in config['items']:
+                    tg.create_task(ToshoResolver(str(item['id'])).run())
+            monitor.cancel()
+
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        asyncio.run(drive())
+        elapsed = time.perf_counter() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        expected = sum(len(item['files']) for item in config['items'])
+        done_bytes = 0
+        ok = bad = 0
+        for dirpath, dirnames, filenames in os.walk('.'):
+            dirnames[:] = [ d for d in dirnames if d not in ('working', '.toshodl') ]
+            for f in filenames:
+                if f == 'emulator.json':
+                    continue
+                if f.startswith('badsum-'):
+                    bad += 1
+                else:
+                    ok += 1
+                    done_bytes += os.path.getsize(os.path.join(dirpath, f))
+
+        lag.sort()
+        phases = { }
+        writes = [ 0, 0.0 ]
+        for (metric, labels), (count, total) in metrics.timings.items():
+            if metric == 'disk_write_seconds':
+                writes[0] += count
+                writes[1] += total
+            if metric != 'phase_seconds':
+                continue
+            phase = dict(labels).get('phase')
+            c, t = phases.get(phase, (0, 0.0))
+            phases[phase] = (c + count, t + total)
+
+        return {
+            'scenario':     name,
+            'files_ok':     ok,
+            'files_bad':    bad,
+            'files':        expected,
+            'bytes':        done_bytes,
+            'seconds':      elapsed,
+            'mb_per_s':     done_bytes / MB / elapsed,
+            'cpu_seconds':  (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime),
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb':  usage.ru_maxrss / 1024,
+            'lag_max_ms':   lag[-1] * 1000 if lag else 0,
+            'lag_p99_ms':   lag[int(len(lag) * 0.99)] * 1000 if lag else 0,
+            'write_ms':     writes[1] / writes[0] * 1000 if writes[0] else 0,
+            'phases':       { phase: total / count for phase, (count, total) in phases.items() },
+        }
+    finally:
+        emulator_proc.kill()
+        emulator_proc.wait()
+        os.chdir('/')
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def print_results(results):
+    print(f'{ "scenario":<20} { "files":>7} { "MB":>7} { "secs":>7} { "MB/s":>8} { "CPU s":>7} { "RSS MB":>7} { "lag max":>8} { "lag p99":>8} { "write":>8}')
+    for r in results:
+        files = f'{ r["files_ok"] }/{ r["files"] }'
+        print(f'{ r["scenario"]:<20} { files:>7} { r["bytes"] / MB:>7.1f} { r["seconds"]:>7.2f} { r["mb_per_s"]:>8.1f} '
+              f'{ r["cpu_seconds"]:>7.2f} { r["peak_rss_mb"]:>7.1f} { r["lag_max_ms"]:>6.1f}ms { r["lag_p99_ms"]:>6.1f}ms { r["write_ms"]:>6.2f}ms')
+        phases = '  '.join(f'{ phase } { secs:.3f}s' for phase, secs in sorted(r['phases'].items()))
+        print(f'    mean { phases }')
+
+def main(args):
+    if '--list' in args:
+        for name, (description, config, settings) in scenarios.items():
+            print(f'{ name:<20} { description }')
+        return
+
+    if '--run' in args:
+        name = args[args.index('--run') + 1]
+        print(json.dumps(run_scenario(name, '--verbose' in args)))
+        return
+
+    repeat = 1
+    if '--repeat' in args:
+        i = args.index('--repeat')
+        repeat = int(args[i + 1])
+        del args[i:i+2]
+    verbose = '--verbose' in args
+    names = [ a for a in args if not a.startswith('--') ] or list(scenarios)
+    unknown = [ n for n in names if n not in scenarios ]
+    if unknown:
+        sys.exit(f'Unknown scenarios: { ", ".join(unknown) }.  Try --list')
+
+    results = [ ]
+    for name in names:
+        for i in range(repeat):
+            cmd = [ sys.executable, os.path.abspath(__file__), '--run', name ] + ([ '--verbose' ] if verbose else [ ])
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                print(f'*** { name } failed', file=sys.stderr)
+                continue
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    print_results(results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
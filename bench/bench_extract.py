@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Time PageExtractor's backends on the saved landing/captcha/download pages
+# in bench/fixtures, using the same selectors the downloaders use, and check
+# that every backend finds the same things.
+#
+#   bench/bench_extract.py [iterations]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from toshodl.PageExtractor import PageExtractor, have_lxml, padding_ordered_text
+from toshodl.ClickNUploadDownloader import ClickNUploadDownloader
+from toshodl.DailyUploadsDownloader import DailyUploadsDownloader
+from toshodl.BuzzHeavierDownloader import BuzzHeavierDownloader
+
+fixtures = [
+    ('clicknupload_landing.html',   ClickNUploadDownloader.landing_page_queries),
+    ('clicknupload_captcha.html',   ClickNUploadDownloader.captcha_page_queries),
+    ('clicknupload_download.html',  ClickNUploadDownloader.download_page_queries),
+    ('dailyuploads_captcha.html',   DailyUploadsDownloader.captcha_page_queries),
+    ('dailyuploads_download.html',  DailyUploadsDownloader.download_page_queries),
+    ('buzzheavier_landing.html',    BuzzHeavierDownloader.landing_page_queries),
+]
+
+def summary(page):
+    found = { name: [ (e.tag, e.attrs, e.text.strip()) for e in elts ] for name, elts in page.items() }
+    if 'digits' in page:
+        found['captcha'] = padding_ordered_text(page['digits'])
+    return found
+
+def main(iterations):
+    backends = [ 'soup', 'stream' ] + ([ 'lxml' ] if have_lxml else [ ])
+    extractor = PageExtractor()
+    fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+    totals = { b: 0 for b in backends }
+    print(f'{ "page":28}' + ''.join(f'{ b:>12}' for b in backends) + '   (ms per page)')
+    for filename, queries in fixtures:
+        with open(os.path.join(fixture_dir, filename)) as fh:
+            html = fh.read()
+
+        expected = summary(extractor.extract(html, queries, backend='soup'))
+        times = [ ]
+        for backend in backends:
+            got = summary(extractor.extract(html, queries, backend=backend))
+            if got != expected:
+                print(f'*** { backend } disagrees with soup on { filename }:\n  { got }\n  { expected }')
+            start = time.perf_counter()
+            for i in range(iterations):
+                extractor.extract(html, queries, backend=backend)
+            elapsed = (time.perf_counter() - start) / iterations
+            totals[backend] += elapsed
+            times.append(elapsed)
+        print(f'{ filename:28}' + ''.join(f'{ t * 1000:12.2f}' for t in times))
+
+    print(f'{ "total":28}' + ''.join(f'{ totals[b] * 1000:12.2f}' for b in backends))
+
+main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
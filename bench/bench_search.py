@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Time title lookups through ToshoSearch.search() against an index of
+# synthetic feed titles.  The feed API is replaced with an empty local
+# response so only the local index is being measured.
+#
+#   bench/bench_search.py [number-of-titles] [number-of-queries]
+
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from toshodl import AsyncConsole
+from toshodl.ToshoSearch import ToshoSearch
+from toshodl.TitleIndex import TitleIndex
+
+groups = [ 'SubsPlease', 'Erai-raws', 'EMBER', 'Judas', 'ASW', 'Tsundere-Raws', 'DKB' ]
+words = [ 'Kimi', 'no', 'Sora', 'Tensei', 'Shitara', 'Slime', 'Datta', 'Ken', 'Kaguya', 'sama',
+          'Frieren', 'Sousou', 'Dungeon', 'Meshi', 'Spy', 'Family', 'Oshi', 'Ko', 'Mahou', 'Shoujo' ]
+
+def synthetic_titles(count):
+    for id in range(1, count + 1):
+        name = ' '.join(random.choice(words) for i in range(random.randint(2, 5)))
+        yield { 'id': id,
+                'title': f'[{ random.choice(groups) }] { name } - { id % 24 + 1:02d} ({ random.choice(["720p", "1080p"]) }) [{ id:08X}].mkv' }
+
+async def main(count, queries):
+    await AsyncConsole.init(stdin=False)
+    random.seed(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = TitleIndex(os.path.join(tmp, 'titles.sqlite'))
+        items = list(synthetic_titles(count))
+        start = time.perf_counter()
+        for i in range(0, len(items), 1000):
+            index.add(items[i:i+1000])
+        print(f'indexed { count } titles in { time.perf_counter() - start:.2f}s')
+        index.set_last_refresh()
+
+        search = ToshoSearch(index=index)
+        search.client = httpx.AsyncClient(base_url='http://feed.invalid',
+                                          transport=httpx.MockTransport(lambda request: httpx.Response(200, json=[])))
+        search.print = lambda msg: None
+
+        samples = random.sample(items, queries)
+        kinds = {
+            'exact':        [ item['title'] for item in samples ],
+            'substring':    [ item['title'][10:-4] for item in samples ],
+            'normalized':   [ item['title'].lower().replace('[', '').replace(']', ' ').replace('-', ' ') for item in samples ],
+            'checksum':     [ f'{ item["id"]:08x}' for item in samples ],
+        }
+        for kind, keys in kinds.items():
+            found = 0
+            start = time.perf_counter()
+            for key in keys:
+                if await search.search(key) is not None:
+                    found += 1
+            elapsed = time.perf_counter() - start
+            print(f'{ kind:12} { queries } lookups in { elapsed:.3f}s ({ elapsed / queries * 1000:.2f} ms each), { found } found')
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+asyncio.run(main(count, queries))
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# Stand-ins for the hosts toshodl talks to, all served from one local port.
+# Requests are told apart by their Host header, so the real URLs can be used
+# as long as the client sends them here (see RewritingTransport):
+#
+#   feed.animetosho.org     /json?show=torrent&id=N, /json?q=...
+#   gofile.io               /dist/js/config.js with the website token
+#   api.gofile.io           POST /accounts, GET /contents/<id>
+#   store1.gofile.io        /download/<id>/<name>, wants the accountToken cookie
+#   buzzheavier.com         landing page, hx-get => hx-redirect, /dl/<id>
+#   clicknupload.click      landing form, captcha form, page with the link
+#   dailyuploads.net        captcha form, page with the link
+#   dl.clicknupload.click, dl.dailyuploads.net      the files
+#
+# It's configured with a JSON dict:
+#   { "seed": 1,
+#     "items": [ { "id": 1, "title": "...",
+#                  "files": [ { "name": "a.mkv", "size": 33554432, "pieces": 1,
+#                               "sources": [ "GoFile", "BuzzHeavier" ] } ] } ],
+#     "default": { "bandwidth": 0, "latency": 0, "error_rate": 0, "drop_rate": 0, "retry_after": null },
+#     "hosts": { "store1.gofile.io": { "bandwidth": 4194304 } } }
+# bandwidth is bytes per second for each connection (0 for no limit),
+# latency is seconds before each response, error_rate is the chance a file
+# request gets a 503 (with a Retry-After of retry_after seconds, if set) and
+# drop_rate the chance its connection is cut partway.
+# File contents are made up from the seed, so the MD5s in the feed are
+# always the same for the same config.
+#
+#   bench/emulator.py config.json       prints the port, then serves until killed
+
+import sys
+import json
+import random
+import asyncio
+import hashlib
+import urllib.parse
+
+import httpx
+
+block_size = 1048576
+
+# One file in the feed, and its made-up contents
+class EmuFile(object):
+    def __init__(self, seed, item, idx, spec):
+        self.item = item
+        self.idx = idx
+        self.name = spec['name']
+        self.size = spec['size']
+        self.pieces = spec.get('pieces', 1)
+        self.sources = spec.get('sources', [ 'GoFile' ])
+        self.block = random.Random(f'{ seed }-{ item["id"] }-{ idx }').randbytes(block_size)
+        md5 = hashlib.md5()
+        for chunk in self.chunks(0, self.size):
+            md5.update(chunk)
+        self.md5 = md5.hexdigest()
+
+    def chunks(self, start, end, chunk_size=65536):
+        pos = start
+        while pos < end:
+            offset = pos % block_size
+            n = min(chunk_size, end - pos, block_size - offset)
+            yield self.block[offset:offset+n]
+            pos += n
+
+    # (start, end) of each piece
+    def piece_ranges(self):
+        step = -(-self.size // self.pieces)
+        return [ (i, min(i + step, self.size)) for i in range(0, self.size, step) ]
+
+# A piece of a file, as uploaded to one of the hosts
+class Upload(object):
+    def __init__(self, fid, file, start, end, piece):
+        self.fid = fid
+        self.file = file
+        self.start = start
+        self.end = end
+        self.name = file.name if file.pieces == 1 else '%s.%03d' % (file.name, piece)
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def chunks(self, start, end):
+        return self.file.chunks(self.start + start, self.start + end)
+
+class Request(object):
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        self.headers = headers
+        self.body = body
+        url = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(url.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        self.host = headers.get('host', '').split(':')[0]
+
+    def form(self):
+        return dict(urllib.parse.parse_qsl(self.body.decode()))
+
+    def cookies(self):
+        cookies = { }
+        for part in self.headers.get('cookie', '').split(';'):
+            if '=' in part:
+                k, v = part.strip().split('=', 1)
+                cookies[k] = v
+        return cookies
+
+class Response(object):
+    def __init__(self, status=200, body=b'', headers=None, upload=None, content_type='text/html'):
+        self.status = status
+        self.body = body.encode() if isinstance(body, str) else body
+        self.headers = { 'Content-Type': content_type }
+        self.headers.update(headers or { })
+        # Set for file downloads.  The body is streamed from it instead
+        self.upload = upload
+        self.range = None
+
+def json_response(data, status=200):
+    return Response(status, json.dumps(data), content_type='application/json')
+
+reasons = { 200: 'OK', 204: 'No Content', 206: 'Partial Content', 401: 'Unauthorized',
+            404: 'Not Found', 416: 'Range Not Satisfiable', 503: 'Service Unavailable' }
+
+class Emulator(object):
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.get('seed', 1))
+        self.default = dict(bandwidth=0, latency=0, error_rate=0, drop_rate=0, retry_after=None)
+        self.default.update(config.get('default', { }))
+        self.host_profiles = config.get('hosts', { })
+        self.items = { }
+        self.uploads = { }
+        self.website_token = 'emulated-website-token'
+        self.account_tokens = set()
+        self.captchas = { }
+        self.buzzheavier_links = { }
+        self.requests = 0
+
+        for item in config['items']:
+            files = [ EmuFile(config.get('seed', 1), item, idx, spec) for idx, spec in enumerate(item['files']) ]
+            self.items[str(item['id'])] = (item, files)
+            for f in files:
+                for piece, (start, end) in enumerate(f.piece_ranges(), start=1):
+                    fid = f'{ item["id"] }x{ f.idx }x{ piece }'
+                    self.uploads[fid] = Upload(fid, f, start, end, piece)
+
+        self.routes = {
+            'feed.animetosho.org':      self.feed,
+            'gofile.io':                self.gofile_site,
+            'api.gofile.io':            self.gofile_api,
+            'store1.gofile.io':         self.gofile_store,
+            'buzzheavier.com':          self.buzzheavier,
+            'clicknupload.click':       self.clicknupload,
+            'dl.clicknupload.click':    self.file_host,
+            'dailyuploads.net':         self.dailyuploads,
+            'dl.dailyuploads.net':      self.file_host,
+        }
+
+    def profile(self, host):
+        p = dict(self.default)
+        p.update(self.host_profiles.get(host, { }))
+        return p
+
+    # The links the feed lists for a file, by source name
+    def links(self, f):
+        fids = [ f'{ f.item["id"] }x{ f.idx }x{ piece }' for piece in range(1, len(f.piece_ranges()) + 1) ]
+        templates = {
+            'GoFile':       'https://gofile.io/d/{}',
+            'BuzzHeavier':  'https://buzzheavier.com/{}',
+            'ClickNUpload': 'https://clicknupload.click/{}',
+            'DailyUploads': 'https://dailyuploads.net/{}',
+        }
+        return { source: [ templates[source].format(fid) for fid in fids ] for source in f.sources }
+
+    async def serve(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = { }
+                while True:
+                    h = await reader.readline()
+                    if not h.strip():
+                        break
+                    k, v = h.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                request = Request(method, target, headers, body)
+                self.requests += 1
+                route = self.routes.get(request.host)
+                response = route(request) if route else Response(404, 'Unknown host')
+                if not await self.send(writer, request, response):
+                    break
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Write the response.  Returns False if the connection was dropped
+    async def send(self, writer, request, response):
+        profile = self.profile(request.host)
+        if profile['latency']:
+            await asyncio.sleep(profile['latency'])
+
+        upload = response.upload
+        if upload is not None:
+            if self.random.random() < profile['error_rate']:
+                headers = { }
+                if profile['retry_after'] is not None:
+                    headers['Retry-After'] = str(profile['retry_after'])
+                response = Response(503, 'Try again later', headers=headers)
+                upload = None
+            else:
+                self.apply_range(request, response)
+
+        if upload is not None:
+            start, end = response.range
+            length = end - start
+        else:
+            length = len(response.body)
+        head = [ f'HTTP/1.1 { response.status } { reasons.get(response.status, "OK") }',
+                 f'Content-Length: { length }' ]
+        head += [ f'{ k }: { v }' for k, v in response.headers.items() ]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        if upload is None or request.method == 'HEAD':
+            if request.method != 'HEAD':
+                writer.write(response.body)
+            await writer.drain()
+            return True
+
+        drop_at = None
+        if self.random.random() < profile['drop_rate']:
+            drop_at = start + self.random.randrange(max(length, 1))
+        bandwidth = profile['bandwidth']
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        sent = 0
+        for chunk in upload.chunks(start, end):
+            if drop_at is not None and start + sent + len(chunk) > drop_at:
+                writer.write(chunk[:drop_at - start - sent])
+                await writer.drain()
+                writer.transport.abort()
+                return False
+            writer.write(chunk)
+            sent += len(chunk)
+            await writer.drain()
+            if bandwidth:
+                ahead = sent / bandwidth - (loop.time() - began)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        return True
+
+    def apply_range(self, request, response):
+        upload = response.upload
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['ETag'] = f'"{ upload.fid }"'
+        response.headers.setdefault('Content-Type', 'application/octet-stream')
+        response.range = (0, upload.size)
+        rng = request.headers.get('range')
+        if not rng or not rng.startswith('bytes='):
+            return
+        first, last = rng[6:].split(',')[0].split('-')
+        start = int(first) if first else upload.size - int(last)
+        end = int(last) + 1 if first and last else upload.size
+        end = min(end, upload.size)
+        if start >= upload.size:
+            response.status, response.upload, response.body = 416, None, b''
+            return
+        response.status = 206
+        response.range = (start, end)
+        response.headers['Content-Range'] = f'bytes { start }-{ end - 1 }/{ upload.size }'
+
+    def file_response(self, fid):
+        upload = self.uploads.get(fid)
+        if upload is None:
+            return Response(404, 'No such file')
+        return Response(200, headers={ 'Content-Type': 'application/octet-stream' }, upload=upload)
+
+    def fid_from_path(self, request, index=-1):
+        parts = [ p for p in request.path.split('/') if p ]
+        return parts[index] if parts else None
+
+    # The tosho feed
+    def feed(self, request):
+        if request.path != '/json':
+            return Response(404, 'Not found')
+        if request.query.get('show') == 'torrent':
+            found = self.items.get(request.query.get('id'))
+            if found is None:
+                return json_response({ })
+            item, files = found
+            return json_response({
+                'id':           item['id'],
+                'title':        item['title'],
+                'status':       item.get('status', 'complete'),
+                'num_files':    len(files),
+                'files':        [ { 'id': f.idx, 'filename': f.name, 'md5': f.md5, 'size': f.size,
+                                    'links': self.links(f) } for f in files ],
+            })
+        q = request.query.get('q', '').lower()
+        return json_response([ { 'id': item['id'], 'title': item['title'] }
+                               for item, files in self.items.values()
+                               if not q or q in item['title'].lower() ])
+
+    # GoFile
+    def gofile_site(self, request):
+        if request.path == '/dist/js/config.js':
+            return Response(200, f'appdata.apiServer = "api";\nappdata.wt = "{ self.website_token }";\n',
+                            content_type='application/javascript')
+        return Response(404, 'Not found')
+
+    def gofile_api(self, request):
+        if request.path == '/accounts' and request.method == 'POST':
+            token = f'account{ len(self.account_tokens) + 1 }'
+            self.account_tokens.add(token)
+            return json_response({ 'status': 'ok', 'data': { 'token': token } })
+
+        if request.path.startswith('/contents/'):
+            auth = request.headers.get('authorization', '')
+            if auth.removeprefix('Bearer ') not in self.account_tokens:
+                return json_response({ 'status': 'error-auth' }, 401)
+            if request.headers.get('x-website-token') != self.website_token:
+                return json_response({ 'status': 'error-notPremium', 'data': { } })
+            upload = self.uploads.get(self.fid_from_path(request))
+            if upload is None:
+                return json_response({ 'status': 'error-notFound', 'data': { } })
+            child = { 'id': upload.fid, 'name': upload.name, 'size': upload.size, 'type': 'file',
+                      'link': f'https://store1.gofile.io/download/{ upload.fid }/{ urllib.parse.quote(upload.name) }' }
+            return json_response({ 'status': 'ok', 'data': { 'type': 'folder', 'children': { upload.fid: child } } })
+        return json_response({ 'status': 'error-notFound', 'data': { } }, 404)
+
+    def gofile_store(self, request):
+        if request.cookies().get('accountToken') not in self.account_tokens:
+            return Response(401, 'Unauthorized')
+        return self.file_response(self.fid_from_path(request, -2))
+
+    # BuzzHeavier
+    def buzzheavier(self, request):
+        parts = [ p for p in request.path.split('/') if p ]
+        if len(parts) == 2 and parts[0] == 'dl':
+            fid = self.buzzheavier_links.get(request.query.get('v'))
+            if fid != parts[1]:
+                return Response(404, 'Link expired')
+            return self.file_response(fid)
+        if len(parts) == 2 and parts[1] == 'download':
+            if request.headers.get('hx-request') != 'true' or parts[0] not in self.uploads:
+                return Response(404, 'Not found')
+            key = '%08x' % self.random.getrandbits(32)
+            self.buzzheavier_links[key] = parts[0]
+            return Response(204, headers={ 'hx-redirect': f'/dl/{ parts[0] }?v={ key }' })
+        if len(parts) == 1 and parts[0] in self.uploads:
+            upload = self.uploads[parts[0]]
+            return Response(200, f'''<!DOCTYPE html>
+<html><head><title>{ upload.name } | BuzzHeavier</title></head>
+<body><div class="container"><h1>{ upload.name }</h1>
+<p>Size: { upload.size } bytes</p>
+<a class="link-button gay-button" hx-get="/{ upload.fid }/download" hx-swap="none">Download</a>
+</div></body></html>''')
+        return Response(404, 'Not found')
+
+    # A 4-digit captcha drawn as spans out of order, put in order with
+    # padding-left.  Returns the HTML and remembers the answer
+    def captcha(self):
+        code = '%04d' % self.random.randrange(10000)
+        rand = '%016x' % self.random.getrandbits(64)
+        self.captchas[rand] = code
+        spans = [ f'<span style="position:absolute;padding-left:{ 8 + i * 18 }px;padding-top:4px;">&#{ ord(d) };</span>'
+                  for i, d in enumerate(code) ]
+        self.random.shuffle(spans)
+        return rand, ''.join(spans)
+
+    def solved(self, form):
+        return self.captchas.pop(form.get('rand'), None) == form.get('code')
+
+    def download_link(self, host, upload):
+        return f'https://{ host }/files/{ upload.fid }/{ upload.name }'
+
+    # ClickNUpload
+    def clicknupload(self, request):
+        if request.method == 'GET':
+            parts = [ p for p in request.path.split('/') if p ]
+            upload = self.uploads.get(parts[0]) if parts else None
+            if upload is None:
+                return Response(404, 'File Not Found')
+            return Response(200, f'''<html><body><div class="download">
+<form method="POST" action="">
+<input type="hidden" name="op" value="download1">
+<input type="hidden" name="usr_login" value="">
+<input type="hidden" name="id" value="{ upload.fid }">
+<input type="hidden" name="fname" value="{ upload.name }">
+<input type="hidden" name="referer" value="">
+<input type="submit" name="method_free" value="Slow Download">
+</form></div></body></html>''')
+
+        form = request.form()
+        upload = self.uploads.get(form.get('id'))
+        if upload is None:
+            return Response(404, 'File Not Found')
+        if form.get('op') == 'download1':
+            rand, spans = self.captcha()
+            return Response(200, f'''<html><body>
+<form name="F1" method="POST" action="">
+<input type="hidden" name="op" value="download2">
+<input type="hidden" name="id" value="{ upload.fid }">
+<input type="hidden" name="rand" value="{ rand }">
+<input type="hidden" name="referer" value="">
+<input type="hidden" name="method_free" value="Slow Download">
+<div class="download"><div style="width:80px;height:26px;font:bold 13px Arial;background:#ccc;text-align:left;direction:ltr;">{ spans }</div>
+<input type="text" name="code" class="captcha_code"></div>
+<button id="downloadbtn" class="downloadbtn" type="submit">Create Download Link</button>
+</form></body></html>''')
+        if form.get('op') == 'download2' and self.solved(form):
+            return Response(200, f'''<html><body><div class="download">
+<a class="downloadbtn" href="{ self.download_link('dl.clicknupload.click', upload) }">Click To Download</a>
+</div></body></html>''')
+        return Response(200, '<html><body><div class="err">Wrong captcha</div></body></html>')
+
+    # DailyUploads
+    def dailyuploads(self, request):
+        if request.method == 'GET':
+            parts = [ p for p in request.path.split('/') if p ]
+            upload = self.uploads.get(parts[0]) if parts else None
+            if upload is None:
+                return Response(404, 'File Not Found')
+            rand, spans = self.captcha()
+            return Response(200, f'''<html><body>
+<form name="F29" method="POST">
+<input type="hidden" name="op" value="download2">
+<input type="hidden" name="id" value="{ upload.fid }">
+<input type="hidden" name="rand" value="{ rand }">
+<input type="hidden" name="referer" value="">
+<div id="commonId"><table><tr><td align="right">
+<div style="width:80px;height:26px;font:bold 13px Arial;background:#ccc;text-align:left;direction:ltr;">{ spans }</div>
+</td><td><input type="text" name="code" class="captcha_code"></td></tr></table></div>
+<button id="downloadBtnClick" type="submit">Download</button>
+</form></body></html>''')
+
+        form = request.form()
+        upload = self.uploads.get(form.get('id'))
+        if upload is not None and self.solved(form):
+            return Response(200, f'''<html><body>
+<a id="fbtn1" class="btn" href="{ self.download_link('dl.dailyuploads.net', upload) }">Download</a>
+</body></html>''')
+        return Response(200, '<html><body><div class="err">Wrong captcha</div></body></html>')
+
+    def file_host(self, request):
+        return self.file_response(self.fid_from_path(request, -2))
+
+# Sends requests for the emulated hosts to the emulator at 127.0.0.1:port
+# instead, over plain HTTP.  The Host header and the URL the caller sees
+# stay the same
+class RewritingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport, port, hosts):
+        self.transport = transport
+        self.port = port
+        self.hosts = set(hosts)
+
+    async def handle_async_request(self, request):
+        if request.url.host in self.hosts:
+            request = httpx.Request(request.method,
+                                    request.url.copy_with(scheme='http', host='127.0.0.1', port=self.port),
+                                    headers=request.headers,
+                                    stream=request.stream,
+                                    extensions=request.extensions)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+# Route all of a ClientPool's clients to the emulator
+def install(pool, port, hosts=None):
+    for verify in (True, False):
+        limited = pool.transport(verify)
+        limited.transport = RewritingTransport(limited.transport, port,
+                                               hosts or Emulator({ 'items': [ ] }).routes.keys())
+
+async def main(config):
+    emulator = Emulator(config)
+    port = await emulator.serve(port=config.get('port', 0))
+    print(port, flush=True)
+    async with emulator.server:
+        await emulator.server.serve_forever()
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as fh:
+        config = json.load(fh)
+    try:
+        asyncio.run(main(config))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Manage the cache of torrent details from the feed API (see TorrentCache)
+#
+#   tosho-cache.py preload [id ...]     fetch and cache these ids (or ids from stdin)
+#   tosho-cache.py invalidate id ...    forget these ids, here and in the job journal
+#   tosho-cache.py invalidate --all     forget everything
+#   tosho-cache.py expire               drop entries past their TTL
+#   tosho-cache.py list                 print the cached ids
+
+import sys
+import asyncio
+import argparse
+
+from toshodl import AsyncConsole
+from toshodl.ToshoResolver import ToshoResolver
+from toshodl.JobJournal import journal
+
+cache = ToshoResolver.cache
+
+async def preload(ids, concurrency):
+    if not ids:
+        ids = [ line.strip() for line in sys.stdin if line.strip() ]
+    await AsyncConsole.init(stdin=False)
+
+    # Not query_tosho(), which uses the JobJournal's copy for an unfinished
+    # item and then doesn't touch the cache
+    sem = asyncio.Semaphore(concurrency)
+    async def one(id):
+        if cache.get(id) is not None:
+            return
+        async with sem:
+            data = await ToshoResolver(id).fetch_tosho()
+        if data is not None:
+            cache.put(id, data)
+
+    async with asyncio.TaskGroup() as tg:
+        for id in ids:
+            tg.create_task(one(id))
+    await AsyncConsole.stdout().drain()
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the tosho torrent details cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('preload', help='Fetch and cache ids, from the command line or stdin')
+    p.add_argument('ids', nargs='*')
+    p.add_argument('--concurrency', type=int, default=4)
+
+    p = commands.add_parser('invalidate', help='Remove ids from the cache and the job journal')
+    p.add_argument('ids', nargs='*')
+    p.add_argument('--all', action='store_true')
+
+    commands.add_parser('expire', help='Remove entries past their TTL')
+    commands.add_parser('list', help='Print the cached ids')
+
+    args = parser.parse_args()
+    if args.command == 'preload':
+        asyncio.run(preload(args.ids, args.concurrency))
+    elif args.command == 'invalidate':
+        if not args.all and not args.ids:
+            parser.error('invalidate needs ids or --all')
+        count = cache.invalidate(None if args.all else args.ids)
+        # An unfinished item would otherwise go on using the journal's copy
+        journal.forget_item_data(None if args.all else args.ids)
+        print(f'Removed { count } entries')
+    elif args.command == 'expire':
+        print(f'Removed { cache.expire() } entries')
+    elif args.command == 'list':
+        for id in cache.ids():
+            print(id)
+
+if __name__ == '__main__':
+    main()
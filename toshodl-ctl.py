@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Talk to a toshodl.py started with --daemon (see Daemon)
+#
+#   toshodl-ctl.py enqueue [title ...]          queue titles or ids (or titles from stdin)
+#   toshodl-ctl.py cancel job ...               stop jobs for good
+#   toshodl-ctl.py pause [job ...]              stop jobs until resumed; all of them by default
+#   toshodl-ctl.py resume [job ...]             start paused jobs again; all of them by default
+#   toshodl-ctl.py priority N job ...           higher priority jobs start first
+#   toshodl-ctl.py status                       list the jobs and what's downloading
+#   toshodl-ctl.py shutdown                     stop the daemon
+#
+# --socket and --port pick which daemon, like they do for toshodl.py
+
+import sys
+import json
+import socket
+import argparse
+import datetime
+
+from toshodl import StateDir
+
+def send(args, request):
+    if args.port:
+        sock = socket.create_connection(('127.0.0.1', args.port))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket or StateDir.path('toshodl.sock'))
+    with sock, sock.makefile('rwb') as fh:
+        fh.write(json.dumps(request).encode() + b'\n')
+        fh.flush()
+        response = json.loads(fh.readline())
+    if not response.pop('ok', False):
+        sys.exit(f'*** { response.get("error") }')
+    return response
+
+def print_status(status):
+    for job in status['jobs']:
+        created = datetime.datetime.fromtimestamp(job['created']).strftime('%H:%M:%S')
+        id = job['id'] or '-'
+        print(f'{ job["job"]:>4}  { job["state"]:<12} { job["priority"]:>4}  { created }  { id:>8}  { job["title"] }')
+        if job['error']:
+            print(f'      { job["error"] }')
+    if status['progress']:
+        print()
+        for line in status['progress']:
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Control a toshodl.py --daemon')
+    parser.add_argument('--socket', help='Unix socket the daemon is listening on')
+    parser.add_argument('--port', type=int, help='Localhost TCP port the daemon is listening on')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('enqueue', help='Queue titles or ids, from the command line or stdin')
+    p.add_argument('titles', nargs='*')
+    p.add_argument('--priority', type=int, default=0)
+
+    p = commands.add_parser('cancel', help='Stop jobs for good')
+    p.add_argument('jobs', nargs='+', type=int)
+
+    p = commands.add_parser('pause', help='Stop jobs until they are resumed')
+    p.add_argument('jobs', nargs='*', type=int)
+
+    p = commands.add_parser('resume', help='Start paused jobs again')
+    p.add_argument('jobs', nargs='*', type=int)
+
+    p = commands.add_parser('priority', help='Change the priority of jobs')
+    p.add_argument('priority', type=int)
+    p.add_argument('jobs', nargs='+', type=int)
+
+    commands.add_parser('status', help='List the jobs')
+    commands.add_parser('shutdown', help='Stop the daemon')
+
+    args = parser.parse_args()
+    if args.command == 'enqueue':
+        titles = args.titles or [ line.strip() for line in sys.stdin if line.strip() ]
+        response = send(args, { 'command': 'enqueue', 'titles': titles, 'priority': args.priority })
+        for job in response['jobs']:
+            print(f'Job { job["job"] }: { job["title"] }')
+    elif args.command == 'status':
+        print_status(send(args, { 'command': 'status' }))
+    elif args.command == 'priority':
+        send(args, { 'command': 'priority', 'jobs': args.jobs, 'priority': args.priority })
+    elif args.command in ('cancel', 'pause', 'resume'):
+        send(args, { 'command': args.command, 'jobs': args.jobs })
+    else:
+        send(args, { 'command': args.command })
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,85 @@
 #!/usr/bin/env python
 
+import signal
 import asyncio
+import argparse
 import queue
 
 from toshodl.ToshoSearch import ToshoSearch
 from toshodl import AsyncConsole
+from toshodl.HttpClient import HttpClient
 from toshodl.ToshoResolver import ToshoResolver
+from toshodl.SearchPipeline import SearchPipeline
+from toshodl.DownloadSourceBase import DownloadSourceBase
+from toshodl.Metrics import metrics
+from toshodl.ProgressBoard import board
+from toshodl.JobJournal import journal
+from toshodl.Daemon import Daemon
 
-async def main():
-    reader, writer = await AsyncConsole.init()
+async def main(args):
+    reader, writer = await AsyncConsole.init(stdin=not args.daemon)
+    DownloadSourceBase.rate_limiter.watch_signal()
 
     tosho = ToshoSearch()
+    exporters = await metrics.start_exporters()
 
-    tasks = []
+    try:
+        if args.daemon:
+            await run_daemon(tosho, args)
+        else:
+            await read_input(tosho, reader, writer)
+    finally:
+        await board.stop()
+        await DownloadSourceBase.browser_pool.close()
+        await metrics.stop_exporters(exporters)
+
+async def read_input(tosho, reader, writer):
     async with asyncio.TaskGroup() as tg:
+        tg.create_task(HttpClient.pool.prewarm())
+        pipeline = SearchPipeline(tosho, tg)
+
+        # Pick up whatever a previous run didn't finish.  Items paused in the
+        # daemon stay paused until it's told to resume them
+        unfinished = [ id for id in journal.unfinished_items() if journal.item_state(id) != 'paused' ]
+        if unfinished:
+            board.write(writer, f'Resuming { len(unfinished) } unfinished items from the journal\n'.encode())
+        for id in unfinished:
+            pipeline.start_resolver(id)
+
         while True:
-            writer.write('waiting for input: '.encode())
+            board.write(writer, 'waiting for input: '.encode())
             line = await reader.readline()
             if not line:
-                print("Done reading input!\nWaiting for all tasks to finish...")
+                board.write(writer, "Done reading input!\nWaiting for all tasks to finish...\n".encode())
                 break
             trimmed = line.decode().strip()
             if len(trimmed) > 0:
-                id = await tosho.search(trimmed)
-                if id is not None:
-                    writer.write(f'{trimmed} is id {id}\n'.encode())
-                    resolver = ToshoResolver(id)
-                    tg.create_task(resolver.run())
+                await pipeline.add(trimmed)
+        await pipeline.close()
+
+    if len(ToshoResolver.repoll):
+        board.write(writer, f'Waiting for { len(ToshoResolver.repoll) } items that aren\'t ready yet...\n'.encode())
+    await ToshoResolver.repoll.join()
+
+# Take work from toshodl-ctl.py until it says to shut down (see Daemon)
+async def run_daemon(tosho, args):
+    daemon = Daemon(tosho)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, daemon.stopping.set)
+
+    prewarm = asyncio.create_task(HttpClient.pool.prewarm())
+    try:
+        await daemon.run(path=args.socket, port=args.port)
+    finally:
+        for task in (prewarm, ToshoResolver.repoll.task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Download titles from Anime Tosho, read from stdin one per line')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and take titles from toshodl-ctl.py instead')
+    parser.add_argument('--socket', help='Unix socket for --daemon to listen on (default .toshodl/toshodl.sock)')
+    parser.add_argument('--port', type=int, help='Listen on this localhost TCP port instead of a Unix socket')
+    asyncio.run(main(parser.parse_args()))
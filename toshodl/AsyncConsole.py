@@ -3,15 +3,17 @@ import asyncio
 
 cache_stdin = None
 cache_stdout = None
-async def init():
+# A daemon doesn't read stdin, which might not even be open
+async def init(stdin=True):
     global cache_stdin
     global cache_stdout
 
     # stdin
     loop = asyncio.get_event_loop()
-    cache_stdin = asyncio.StreamReader()
-    protocol = asyncio.StreamReaderProtocol(cache_stdin)
-    await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+    if stdin:
+        cache_stdin = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(cache_stdin)
+        await loop.connect_read_pipe(lambda: protocol, sys.stdin)
 
     # stdout
 
@@ -0,0 +1,94 @@
+# Headless browsers for download sources that need to run the site's
+# javascript to get a link.
+#
+# Playwright and the browser are only started the first time a context is
+# asked for.  After that, each caller gets a fresh context (so no cookies
+# leak between pieces) in the same browser, with at most max_contexts open
+# at once.  A browser is retired after recycle_after contexts, or as soon
+# as it's found disconnected, and closed once the contexts still using it
+# are done.  close() shuts everything down.
+
+import asyncio
+import contextlib
+
+from playwright.async_api import async_playwright
+
+class BrowserPool(object):
+    max_contexts = 2
+    recycle_after = 25
+    browser_type = 'firefox'
+
+    def __init__(self):
+        self.playwright = None
+        self.current = None
+        self.browsers = [ ]
+        self.sem = asyncio.Semaphore(self.max_contexts)
+        self.lock = asyncio.Lock()
+
+    # A new browser context, closed on the way out
+    @contextlib.asynccontextmanager
+    async def context(self):
+        async with self.sem:
+            pooled = await self.browser()
+            pooled.active += 1
+            try:
+                ctx = await pooled.browser.new_context()
+            except Exception:
+                pooled.active -= 1
+                pooled.retired = True
+                await self.close_retired()
+                raise
+            try:
+                yield ctx
+            finally:
+                pooled.active -= 1
+                try:
+                    await ctx.close()
+                except Exception:
+                    pass
+                await self.close_retired()
+
+    async def browser(self):
+        async with self.lock:
+            if self.current is not None:
+                if not self.current.browser.is_connected() or self.current.uses >= self.recycle_after:
+                    self.current.retired = True
+                    self.current = None
+
+            if self.current is None:
+                if self.playwright is None:
+                    self.playwright = await async_playwright().start()
+                launcher = getattr(self.playwright, self.browser_type)
+                self.current = PooledBrowser(await launcher.launch())
+                self.browsers.append(self.current)
+
+            self.current.uses += 1
+            return self.current
+
+    async def close_retired(self):
+        for pooled in [ b for b in self.browsers if b.retired and b.active == 0 ]:
+            self.browsers.remove(pooled)
+            await pooled.close()
+
+    async def close(self):
+        async with self.lock:
+            self.current = None
+            for pooled in self.browsers:
+                await pooled.close()
+            self.browsers = [ ]
+            if self.playwright is not None:
+                await self.playwright.stop()
+                self.playwright = None
+
+class PooledBrowser(object):
+    def __init__(self, browser):
+        self.browser = browser
+        self.uses = 0
+        self.active = 0
+        self.retired = False
+
+    async def close(self):
+        try:
+            await self.browser.close()
+        except Exception:
+            pass
@@ -1,25 +1,32 @@
-from io import BytesIO
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 
 from toshodl.DownloadSourceBase import DownloadSourceBase, XTryAnotherSource, XTryThisSourceAgain
 
 class BuzzHeavierDownloader(DownloadSourceBase):
+    # If the download links really are one-time-use, the extra segment
+    # requests get refused and we fall back to a single stream
+    max_segments = 4
+
+    # What to pull out of the landing page; see PageExtractor
+    landing_page_queries = {
+        'link':         'a.link-button',
+    }
 
     async def download_from_url(self):
         response = await self.exception_retry(lambda: self.client.get(self.url))
         dl_link = await self.get_download_link(response)
 
         if dl_link:
-            async with self.client.stream('GET', dl_link, timeout=30.0) as response:
-                if response.status_code == 500:
-                    # Sometimes trying again will work
-                    self.print('Got 500 response from BuzzHeavier, will try again')
-                    raise XTryThisSourceAgain()
-                await self.save_stream_response(response)
+            await self.stream_to_file(dl_link, timeout=30.0)
+
+    def check_stream_response(self, response):
+        if response.status_code == 500:
+            # Sometimes trying again will work
+            self.print('Got 500 response from BuzzHeavier, will try again')
+            raise XTryThisSourceAgain()
 
     async def get_download_link(self, response):
-        dom = BeautifulSoup(BytesIO(response.content), features='html.parser')
+        page = self.page_extractor.extract(response.text, self.landing_page_queries)
 
         # There's a link 'Download: <a hx-get="/hashhash/download">Download</a>'
         # Do a get() on that URL with some headers:
@@ -30,10 +37,10 @@ class BuzzHeavierDownloader(DownloadSourceBase):
         # Do a get() on that url (maybe without the ?v=...) to download.  It seems that
         # the DL links are one-time-only use
 
-        link = dom.select_one('a.link-button')
-        if not link:
+        if not page['link']:
             self.print('did not find download link at { self.url }')
             raise XTryAnotherSource()
+        link = page['link'][0]
 
         #self.print(f"Found link { link }\n")
         link_url = urljoin(self.url, link.get('hx-get'))
@@ -0,0 +1,145 @@
+# Computes the MD5 of a file while its pieces are being downloaded.  Bytes
+# that arrive in order are hashed as they stream in; only the ones that
+# arrive out of order are read back from disk.
+#
+# MD5 has to see the bytes in order, but the pieces (and the segments within
+# a piece) arrive in any order.  Only the piece at the head of the chain is
+# being hashed, and only while its bytes arrive in order.  Bytes that were
+# written while their piece wasn't at the head, or that landed ahead of
+# where the hash has gotten to (a resumed piece, or a later segment), are
+# read back from disk a chunk at a time once the hash catches up to them.
+# With parallel pieces that's usually most of pieces 2 onward.  Either way,
+# memory use is bounded by the chunk size.
+#
+# Since bytes can be read back as soon as they're reported, downloaders only
+# report them once they're in the file (see DiskWriter's on_written).
+
+import asyncio
+import hashlib
+
+class ChainedHasher(object):
+    chunk_size = 1048576
+
+    def __init__(self, filenames):
+        self.md5 = hashlib.md5()
+        self.pieces = [ PieceHasher(self, filename) for filename in filenames ]
+        self.head = 0
+        self.hashed = 0
+        self.head_md5 = self.md5.copy()
+        self.catch_up_task = None
+        self.error = None
+        self.finished = asyncio.Event()
+        if not self.pieces:
+            self.finished.set()
+
+    # The object the downloader for piece number idx (0-based) reports to
+    def piece(self, idx):
+        return self.pieces[idx]
+
+    async def result(self):
+        await self.finished.wait()
+        if self.error:
+            raise self.error
+        return self.md5
+
+    def head_piece(self):
+        return self.pieces[self.head] if self.head < len(self.pieces) else None
+
+    def feed(self, piece, offset, chunk):
+        if piece is self.head_piece() and self.catch_up_task is None and offset == self.hashed:
+            self.md5.update(chunk)
+            self.hashed += len(chunk)
+        self.kick()
+
+    def restart(self, piece):
+        if piece is self.head_piece():
+            self.md5 = self.head_md5.copy()
+            self.hashed = 0
+
+    # Start reading from disk if the head piece has bytes we haven't hashed
+    # and aren't going to see from the network
+    def kick(self):
+        if self.catch_up_task is not None:
+            return
+        piece = self.head_piece()
+        if piece is None:
+            return
+        if self.hashed < piece.high or piece.is_done():
+            self.catch_up_task = asyncio.create_task(self.catch_up())
+
+    async def catch_up(self):
+        try:
+            while (piece := self.head_piece()) is not None:
+                if self.hashed < piece.high:
+                    generation = piece.generation
+                    chunk = await asyncio.to_thread(read_chunk, piece.filename, piece.base_offset + self.hashed,
+                                                    min(self.chunk_size, piece.high - self.hashed))
+                    if generation != piece.generation:
+                        continue    # It was restarted while we were reading
+                    if not chunk:
+                        raise ValueError(f'{ piece.filename } is shorter than expected at byte { self.hashed }')
+                    self.md5.update(chunk)
+                    self.hashed += len(chunk)
+
+                elif piece.is_done():
+                    self.head += 1
+                    self.hashed = 0
+                    self.head_md5 = self.md5.copy()
+
+                else:
+                    # Caught up to a piece still downloading; feed() takes it from here
+                    break
+        except Exception as e:
+            self.error = e
+            self.finished.set()
+        finally:
+            self.catch_up_task = None
+
+        if self.head_piece() is None:
+            self.finished.set()
+
+# What a downloader sees: reports about one piece of the chain
+class PieceHasher(object):
+    def __init__(self, chain, filename):
+        self.chain = chain
+        self.filename = filename
+        # Where the piece starts in the file
+        self.base_offset = 0
+        # How much of the piece, from the start, is known to be on disk
+        self.high = 0
+        self.size = None
+        self.generation = 0
+
+    def is_done(self):
+        return self.size is not None and self.high >= self.size
+
+    # chunk was just written at offset within the piece
+    def feed(self, offset, chunk):
+        if offset == self.high:
+            self.high += len(chunk)
+        self.chain.feed(self, offset, chunk)
+
+    # The downloader is starting (or resuming) the piece at offset, and the
+    # bytes before that are already on disk
+    def start_at(self, offset):
+        if offset < self.high:
+            self.restart()
+        self.high = offset
+        self.chain.kick()
+
+    # The piece is being downloaded again from the beginning
+    def restart(self):
+        self.high = 0
+        self.size = None
+        self.generation += 1
+        self.chain.restart(self)
+
+    # The whole piece is on disk
+    def done(self, size):
+        self.size = self.high = size
+        self.chain.kick()
+
+def read_chunk(filename, offset, size):
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(size)
@@ -0,0 +1,301 @@
+# Hands out httpx clients that all share the same connection pools, so
+# connections (and their TLS sessions) get reused between the tosho feed,
+# the download sites' APIs and landing pages, and the downloads themselves.
+#
+# There's one pool for normal clients and another for ones that don't verify
+# certificates.  On top of httpx's own limits:
+#   * requests to any one host are capped at per_host_limit at a time (or
+#     host_limits[host]).  Over HTTP/1.1 that's the number of connections
+#   * looked-up addresses are cached for dns_ttl seconds
+#   * HTTP/2 is used if http2 is set and the h2 package is installed
+#   * prewarm() opens connections ahead of time to hosts we know we'll need
+#
+# stats() reports how many connections are idle and active, and how many
+# have been created and reused.  They're also metrics gauges: pool_connections,
+# pool_connections_created, pool_requests and dns_cache_lookups.
+
+import time
+import socket
+import asyncio
+import ipaddress
+import contextlib
+import logging
+
+import httpx
+import httpcore
+
+from toshodl.Metrics import metrics
+from toshodl.Scheduler import waiting
+
+try:
+    import h2
+    have_h2 = True
+except ImportError:
+    have_h2 = False
+
+logger = logging.getLogger(__name__)
+
+class ClientPool(object):
+    max_connections = 100
+    max_keepalive_connections = 40
+    # Seconds an idle connection is kept around
+    keepalive_expiry = 90
+    per_host_limit = 8
+    host_limits = { }
+    http2 = False
+    dns_ttl = 5 * 60
+    timeout = httpx.Timeout(5.0)
+    prewarm_urls = [ 'https://feed.animetosho.org/',
+                     'https://api.gofile.io/',
+                     'https://buzzheavier.com/' ]
+
+    def __init__(self):
+        self.transports = { }
+        self.connection_pools = { }
+        self.clients = { }
+        self.host_sems = { }
+        self.backend = CachingNetworkBackend(self)
+        self.requests = 0
+        self.connections_created = 0
+        metrics.gauge_function('semaphore_waiters', self.waiters)
+        metrics.gauge_function('pool_connections', lambda: [ ({ 'state': state }, self.stats()[state])
+                                                             for state in ('idle', 'active') ])
+        metrics.gauge_function('pool_connections_created', lambda: [ ({ }, self.connections_created) ])
+        metrics.gauge_function('pool_requests', lambda: [ ({ }, self.requests) ])
+        metrics.gauge_function('dns_cache_lookups', lambda: [ ({ 'result': 'hit' }, self.backend.hits),
+                                                              ({ 'result': 'miss' }, self.backend.misses) ])
+
+    def transport(self, verify=True):
+        if verify not in self.transports:
+            http2 = self.http2 and have_h2
+            if self.http2 and not have_h2:
+                logger.warning('HTTP/2 needs the h2 package, using HTTP/1.1')
+            connection_pool = httpcore.AsyncConnectionPool(
+                ssl_context=httpx.create_ssl_context(verify=verify, http2=http2),
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+                http1=True,
+                http2=http2,
+                network_backend=self.backend)
+            self.connection_pools[verify] = connection_pool
+            self.transports[verify] = HostLimitedTransport(self, ConnectionPoolTransport(connection_pool))
+        return self.transports[verify]
+
+    # A client using the shared pool.  Clients are shared too, one for each
+    # combination of args
+    def client(self, verify=True, base_url=''):
+        key = (verify, base_url)
+        if key not in self.clients:
+            self.clients[key] = httpx.AsyncClient(transport=self.transport(verify),
+                                                  base_url=base_url,
+                                                  timeout=self.timeout)
+        return self.clients[key]
+
+    def host_semaphore(self, host):
+        if host not in self.host_sems:
+            self.host_sems[host] = asyncio.Semaphore(self.host_limits.get(host, self.per_host_limit))
+        return self.host_sems[host]
+
+    # Open connections to these URLs' hosts (prewarm_urls by default) so
+    # the first real requests to them don't have to wait for DNS and TLS
+    async def prewarm(self, urls=None):
+        client = self.client()
+        async def warm(url):
+            try:
+                await client.head(url)
+            except httpx.HTTPError as e:
+                logger.debug('Prewarming %s failed: %s', url, e)
+        await asyncio.gather(*[ warm(url) for url in (urls or self.prewarm_urls) ])
+
+    def waiters(self):
+        return [ ({ 'kind': 'connection-host', 'key': host }, waiting(sem)) for host, sem in self.host_sems.items() ]
+
+    def stats(self):
+        idle = active = 0
+        for connection_pool in self.connection_pools.values():
+            for conn in connection_pool.connections:
+                if conn.is_idle():
+                    idle += 1
+                elif not conn.is_closed():
+                    active += 1
+        return { 'idle': idle,
+                 'active': active,
+                 'created': self.connections_created,
+                 'reused': max(self.requests - self.connections_created, 0),
+                 'requests': self.requests,
+                 'dns_hits': self.backend.hits,
+                 'dns_misses': self.backend.misses }
+
+# httpcore's exceptions, and the httpx ones to raise instead, most specific
+# first
+mapped_exceptions = [ (getattr(httpcore, name), getattr(httpx, name)) for name in (
+    'ConnectTimeout', 'ReadTimeout', 'WriteTimeout', 'PoolTimeout', 'TimeoutException',
+    'ConnectError', 'ReadError', 'WriteError', 'NetworkError', 'ProxyError',
+    'UnsupportedProtocol', 'RemoteProtocolError', 'LocalProtocolError', 'ProtocolError') ]
+
+@contextlib.contextmanager
+def httpx_exceptions(request):
+    try:
+        yield
+    except tuple(core_class for core_class, httpx_class in mapped_exceptions) as e:
+        for core_class, httpx_class in mapped_exceptions:
+            if isinstance(e, core_class):
+                raise httpx_class(str(e), request=request) from e
+        raise
+
+# Sends httpx requests through an httpcore connection pool we made ourselves,
+# so we can give it our network backend and count its connections
+class ConnectionPoolTransport(httpx.AsyncBaseTransport):
+    def __init__(self, connection_pool):
+        self.connection_pool = connection_pool
+
+    async def handle_async_request(self, request):
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme,
+                             host=request.url.raw_host,
+                             port=request.url.port,
+                             target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions)
+        with httpx_exceptions(request):
+            core_response = await self.connection_pool.handle_async_request(core_request)
+        return httpx.Response(status_code=core_response.status,
+                              headers=core_response.headers,
+                              stream=CoreResponseStream(core_response.stream, request),
+                              extensions=core_response.extensions)
+
+    async def aclose(self):
+        await self.connection_pool.aclose()
+
+class CoreResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream, request):
+        self.stream = stream
+        self.request = request
+
+    async def __aiter__(self):
+        with httpx_exceptions(self.request):
+            async for chunk in self.stream:
+                yield chunk
+
+    async def aclose(self):
+        with httpx_exceptions(self.request):
+            await self.stream.aclose()
+
+# Wraps the real transport to hold a per-host slot from when a request is
+# sent until its response is closed.  The request's 'host_slot' extension
+# is the response stream holding it (see host_slot_suspended())
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, pool, transport):
+        self.pool = pool
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        sem = self.pool.host_semaphore(request.url.host)
+        await sem.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            sem.release()
+            raise
+        self.pool.requests += 1
+        response.stream = ReleasingStream(response.stream, sem)
+        request.extensions['host_slot'] = response.stream
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, sem):
+        self.stream = stream
+        self.sem = sem
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.sem is not None:
+                self.sem.release()
+                self.sem = None
+
+    # Let another request to the host have the slot while we wait on
+    # something, like Scheduler slots' suspended()
+    @contextlib.asynccontextmanager
+    async def suspended(self):
+        sem, self.sem = self.sem, None
+        if sem is not None:
+            sem.release()
+        try:
+            yield
+        finally:
+            if sem is not None:
+                await sem.acquire()
+                self.sem = sem
+
+# Give up an open response's per-host slot for the length of a with block
+def host_slot_suspended(response):
+    stream = response.request.extensions.get('host_slot')
+    if stream is None:
+        return contextlib.nullcontext()
+    return stream.suspended()
+
+# Looks up hosts itself, remembering the answers, then connects by address.
+# TLS still uses the host name for SNI and certificate checks
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self, pool):
+        self.pool = pool
+        self.backend = httpcore.AnyIOBackend()
+        self.cache = { }
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port):
+        try:
+            ipaddress.ip_address(host)
+            return [ host ]
+        except ValueError:
+            pass
+
+        cached = self.cache.get((host, port))
+        if cached and cached[0] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self.cache[(host, port)] = (time.monotonic() + self.pool.dns_ttl, addresses)
+        return addresses
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await self.resolve(host, port)
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(str(e)) from e
+
+        for i, address in enumerate(addresses):
+            try:
+                stream = await self.backend.connect_tcp(address, port, timeout=timeout,
+                                                        local_address=local_address,
+                                                        socket_options=socket_options)
+            except httpcore.ConnectError:
+                if i == len(addresses) - 1:
+                    # None of them worked.  Look it up again next time
+                    self.cache.pop((host, port), None)
+                    raise
+                continue
+            self.pool.connections_created += 1
+            return stream
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
@@ -0,0 +1,293 @@
+# Keeps running and takes work over a local socket, instead of reading
+# titles from stdin and exiting when they're done.  The connection pool,
+# GoFile tokens, title index and browser pool stay warm between batches.
+#
+# It listens on a Unix socket (StateDir's toshodl.sock by default) or a
+# localhost TCP port.  Each request is one line of JSON, and gets one line
+# of JSON back, { "ok": true, ... } or { "ok": false, "error": "..." }:
+#   { "command": "enqueue", "titles": [ ... ], "priority": 0 }
+#   { "command": "cancel", "jobs": [ 3, 4 ] }
+#   { "command": "pause", "jobs": [ 3 ] }       no jobs means all of them
+#   { "command": "resume", "jobs": [ 3 ] }      likewise
+#   { "command": "priority", "jobs": [ 3 ], "priority": 10 }
+#   { "command": "status" }
+#   { "command": "shutdown" }
+# toshodl-ctl.py sends these from the command line.
+#
+# Each title (or tosho id) is a job.  Up to max_jobs run at once, and queued
+# jobs start highest priority first, then oldest first.  Pausing or
+# cancelling a running job cancels its task; the working files and the
+# JobJournal are left as they are, so resuming it picks up where it was.
+# A job whose item wasn't ready yet waits on the RepollQueue, which hands
+# back the resolver it starts once it's ready, so the job can still be
+# paused or cancelled.
+
+import os
+import json
+import time
+import asyncio
+
+from toshodl.Printable import Printable
+from toshodl.ToshoResolver import ToshoResolver
+from toshodl.JobJournal import journal
+from toshodl.ProgressBoard import board
+from toshodl.Metrics import metrics
+from toshodl import StateDir
+
+class Daemon(Printable):
+    max_jobs = int(os.environ.get('TOSHODL_DAEMON_JOBS', 4))
+    # How many finished jobs to keep around for status
+    keep_finished = 200
+    finished_states = [ 'done', 'not-found', 'failed', 'cancelled' ]
+
+    def __init__(self, tosho, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tosho = tosho
+        self.jobs = { }
+        self.next_number = 1
+        self.active_ids = { }
+        self.stopping = asyncio.Event()
+        metrics.gauge_function('daemon_jobs', self.job_counts)
+
+    # Serve until told to shut down
+    async def run(self, path=None, port=None):
+        if port:
+            server = await asyncio.start_server(self.handle_client, '127.0.0.1', port)
+            where = f'127.0.0.1:{ port }'
+        else:
+            path = path or StateDir.path('toshodl.sock')
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle_client, path)
+            os.chmod(path, 0o600)
+            where = path
+        self.print(f'Listening on { where }\n')
+
+        # Pick up whatever a previous run didn't finish
+        for id in journal.unfinished_items():
+            job = self.add_job(id, id=id)
+            if journal.item_state(id) == 'paused':
+                job.state = 'paused'
+        self.dispatch()
+        await self.flush_stdout()
+
+        try:
+            await self.stopping.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if path and not port and os.path.exists(path):
+                os.unlink(path)
+            running = [ job.task for job in self.jobs.values() if job.is_running() ]
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def add_job(self, title, priority=0, id=None):
+        job = Job(self.next_number, title, priority, id)
+        self.next_number += 1
+        self.jobs[job.number] = job
+        return job
+
+    # Start the queued jobs that fit
+    def dispatch(self):
+        if self.stopping.is_set():
+            return
+        # A job calling this as it finishes doesn't count as running
+        def running(job):
+            return job.is_running() and job.task is not asyncio.current_task()
+        running_count = sum(1 for job in self.jobs.values() if running(job))
+        queued = sorted((job for job in self.jobs.values() if job.state == 'queued' and not running(job)),
+                        key=lambda job: (-job.priority, job.number))
+        for job in queued[:max(self.max_jobs - running_count, 0)]:
+            job.task = asyncio.create_task(self.run_job(job))
+        self.forget_finished()
+
+    def forget_finished(self):
+        finished = [ job for job in self.jobs.values() if job.state in self.finished_states ]
+        for job in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[job.number]
+
+    # resolver_task is the resolver the RepollQueue started for a waiting job
+    async def run_job(self, job, resolver_task=None):
+        try:
+            if resolver_task is not None:
+                await resolver_task
+            else:
+                if job.id is None:
+                    job.state = 'searching'
+                    id = journal.title_id(job.title)
+                    if id is None:
+                        id = await self.tosho.search(job.title)
+                        if id is None:
+                            job.state = 'not-found'
+                            return
+                        journal.found_title(job.title, id)
+                    job.id = str(id)
+
+                other = self.active_ids.get(job.id)
+                if other is not None and other is not job:
+                    self.print(f'{ job.title } is id { job.id }, which job { other.number } is already doing\n')
+                    job.state = 'done'
+                    return
+
+                self.active_ids[job.id] = job
+                job.state = 'downloading'
+                journal.set_item_state(job.id, 'queued')
+                await ToshoResolver(job.id).run()
+            self.resolver_finished(job)
+
+        except asyncio.CancelledError:
+            # Whoever cancelled it set the state, unless we're shutting down
+            if job.state not in ('paused', 'cancelled'):
+                job.state = 'queued'
+        except Exception as e:
+            self.print(f'*** Job { job.number } ({ job.title }) failed: { type(e).__name__ } { e }\n')
+            job.state = 'failed'
+            job.error = f'{ type(e).__name__ }: { e }'
+        finally:
+            # A waiting job still has the id
+            if self.active_ids.get(job.id) is job and job.state != 'waiting':
+                del self.active_ids[job.id]
+            job.finished = time.time()
+            self.dispatch()
+
+    # The job's resolver returned.  Its item is done, or waiting to be ready
+    def resolver_finished(self, job):
+        state = journal.item_state(job.id)
+        if state == 'waiting':
+            job.state = 'waiting'
+            ToshoResolver.repoll.watch(job.id, lambda task: self.repoll_started(job, task))
+        elif state == 'done':
+            job.state = 'done'
+        elif state == 'failed':
+            job.state = 'failed'
+            job.error = f'Some of the files for item { job.id } failed'
+        else:
+            job.state = 'failed'
+            job.error = f'Item { job.id } was left { state }'
+
+    # The RepollQueue started the resolver for a waiting job, or gave up on it
+    def repoll_started(self, job, task):
+        if job.state != 'waiting':
+            return
+        if task is None:
+            job.state = 'failed'
+            job.error = f'Item { job.id } never became ready'
+            if self.active_ids.get(job.id) is job:
+                del self.active_ids[job.id]
+            return
+        job.state = 'downloading'
+        job.task = asyncio.create_task(self.run_job(job, task))
+
+    # Stop a job, leaving it in state
+    def stop_job(self, job, state):
+        if job.state in self.finished_states:
+            return
+        job.state = state
+        if job.id is not None:
+            journal.set_item_state(job.id, state)
+            ToshoResolver.repoll.remove(job.id)
+        if job.is_running():
+            job.task.cancel()
+        elif self.active_ids.get(job.id) is job:
+            # It was waiting
+            del self.active_ids[job.id]
+
+    def selected_jobs(self, request, default_all=False):
+        numbers = request.get('jobs')
+        if not numbers and default_all:
+            return list(self.jobs.values())
+        missing = [ n for n in numbers or [ ] if int(n) not in self.jobs ]
+        if missing:
+            raise ValueError(f'No such job { ", ".join(str(n) for n in missing) }')
+        return [ self.jobs[int(n)] for n in numbers or [ ] ]
+
+    def command(self, request):
+        command = request.get('command')
+
+        if command == 'enqueue':
+            titles = request.get('titles') or [ ]
+            jobs = [ self.add_job(title, int(request.get('priority', 0))) for title in titles if title.strip() ]
+            self.dispatch()
+            return { 'jobs': [ job.status() for job in jobs ] }
+
+        if command == 'cancel':
+            for job in self.selected_jobs(request):
+                self.stop_job(job, 'cancelled')
+            return { }
+
+        if command == 'pause':
+            for job in self.selected_jobs(request, default_all=True):
+                if job.state != 'paused':
+                    self.stop_job(job, 'paused')
+            return { }
+
+        if command == 'resume':
+            for job in self.selected_jobs(request, default_all=True):
+                if job.state == 'paused':
+                    job.state = 'queued'
+                    if job.id is not None:
+                        journal.set_item_state(job.id, 'queued')
+            self.dispatch()
+            return { }
+
+        if command == 'priority':
+            for job in self.selected_jobs(request):
+                job.priority = int(request['priority'])
+            self.dispatch()
+            return { }
+
+        if command == 'status':
+            return { 'jobs': [ job.status() for job in self.jobs.values() ],
+                     'progress': board.lines() if board.files else [ ] }
+
+        if command == 'shutdown':
+            self.print('Shutting down\n')
+            self.stopping.set()
+            return { }
+
+        raise ValueError(f'Unknown command { command !r}')
+
+    async def handle_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = self.command(json.loads(line))
+                    response['ok'] = True
+                except (ValueError, KeyError, TypeError) as e:
+                    response = { 'ok': False, 'error': str(e) }
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            await self.flush_stdout()
+
+    # For the metrics: how many jobs are in each state
+    def job_counts(self):
+        counts = { }
+        for job in self.jobs.values():
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return [ ({ 'state': state }, count) for state, count in counts.items() ]
+
+class Job(object):
+    def __init__(self, number, title, priority=0, id=None):
+        self.number = number
+        self.title = title
+        self.priority = priority
+        self.id = id
+        self.state = 'queued'
+        self.task = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def status(self):
+        return { 'job': self.number, 'title': self.title, 'id': self.id, 'state': self.state,
+                 'priority': self.priority, 'error': self.error,
+                 'created': self.created, 'finished': self.finished }
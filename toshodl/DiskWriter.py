@@ -0,0 +1,169 @@
+# Writes downloaded data to disk in large blocks on its own threads, instead
+# of handing every 64 KB chunk to a thread pool on its way to the file.
+#
+# Each open file collects chunks in a buffer.  Once there's write_size of
+# it, it goes to disk as one pwrite(), lined up on write_size boundaries in
+# the file, while the next block collects.  There's at most one write in
+# flight per file.  If the disk falls behind and the buffer reaches
+# buffer_size, write() waits, which stops the network reads feeding it.
+#
+# on_written(offset, data) is called once data is actually in the file, for
+# things that might read it back, like the ChainedHasher.  flush() waits
+# for everything written so far, so call it before recording how much has
+# been saved.
+#
+# TOSHODL_FSYNC picks when to fsync:
+#   none        leave it to the OS.  The default
+#   checkpoint  on every flush(), so resume checkpoints are on disk
+#   close       when the file is closed
+#   always      after every write
+#
+# Write and fsync times go to the metrics as disk_write_seconds and
+# disk_fsync_seconds.
+
+import os
+import time
+import asyncio
+import collections
+import concurrent.futures
+
+from toshodl.Metrics import metrics
+
+class DiskWriter(object):
+    threads = 4
+    write_size = 1048576
+    buffer_size = 4 * 1048576
+    fsync = os.environ.get('TOSHODL_FSYNC', 'none')
+
+    open_flags = {
+        'wb':   os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        'ab':   os.O_WRONLY | os.O_CREAT,
+        'r+b':  os.O_WRONLY,
+    }
+
+    def __init__(self):
+        self.executor = None
+
+    def run(self, fn, *args):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+                                                                  thread_name_prefix='toshodl-writer')
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # A FileWriter for filename, writing from offset on.  mode is 'wb',
+    # 'ab' or 'r+b', like open().  Use it with "async with"
+    def open(self, filename, mode, offset=0, write_size=None, buffer_size=None, on_written=None, source=''):
+        return FileWriter(self, filename, self.open_flags[mode], offset,
+                          write_size or self.write_size, buffer_size or self.buffer_size,
+                          on_written, source)
+
+class FileWriter(object):
+    def __init__(self, writer, filename, flags, offset, write_size, buffer_size, on_written, source):
+        self.writer = writer
+        self.filename = filename
+        self.flags = flags
+        self.pos = offset
+        self.write_size = write_size
+        self.buffer_size = max(buffer_size, write_size)
+        self.on_written = on_written
+        self.source = source
+        self.fd = None
+        # Chunks waiting to be written, and how many bytes they add up to
+        self.buffer = collections.deque()
+        self.buffered = 0
+        self.inflight = None
+        self.error = None
+
+    async def __aenter__(self):
+        self.fd = await self.writer.run(os.open, self.filename, self.flags, 0o666)
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            if type is None:
+                await self.flush()
+                if self.writer.fsync == 'close':
+                    await self.sync()
+            elif self.inflight is not None:
+                # Don't leave a write going on a closed file
+                await asyncio.gather(self.inflight, return_exceptions=True)
+        finally:
+            await self.writer.run(os.close, self.fd)
+
+    async def write(self, data):
+        if self.error:
+            raise self.error
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.inflight is not None and (self.inflight.done() or self.buffered >= self.buffer_size):
+            await self.finish_write()
+        if self.inflight is None and self.buffered >= self.next_write_size():
+            self.start_write(self.next_write_size())
+
+    # Enough to get to the next write_size boundary, or as many whole blocks
+    # as are buffered
+    def next_write_size(self):
+        first = self.write_size - self.pos % self.write_size
+        if self.buffered <= first:
+            return first
+        return first + (self.buffered - first) // self.write_size * self.write_size
+
+    def start_write(self, size):
+        chunks = [ ]
+        taken = 0
+        while taken < size:
+            chunk = self.buffer.popleft()
+            if taken + len(chunk) > size:
+                self.buffer.appendleft(chunk[size - taken:])
+                chunk = chunk[:size - taken]
+            chunks.append(chunk)
+            taken += len(chunk)
+        data = b''.join(chunks)
+        self.buffered -= size
+        pos = self.pos
+        self.pos += len(data)
+        self.inflight = self.writer.run(self.pwrite, pos, data)
+
+    def pwrite(self, pos, data):
+        start = time.monotonic()
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, view[written:], pos + written)
+        if self.writer.fsync == 'always':
+            os.fsync(self.fd)
+        return pos, data, time.monotonic() - start
+
+    async def finish_write(self):
+        try:
+            # If we're cancelled, the write carries on and flush() waits for it
+            pos, data, seconds = await asyncio.shield(self.inflight)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # Anything after this would leave a hole in the file
+            self.inflight = None
+            self.error = e
+            raise
+        self.inflight = None
+        metrics.observe('disk_write_seconds', seconds, source=self.source)
+        metrics.inc('disk_write_bytes_total', len(data), source=self.source)
+        if self.on_written:
+            self.on_written(pos, data)
+
+    # Wait until everything written so far is in the file
+    async def flush(self):
+        if self.error:
+            raise self.error
+        if self.inflight is not None:
+            await self.finish_write()
+        if self.buffered:
+            self.start_write(self.buffered)
+            await self.finish_write()
+        if self.writer.fsync == 'checkpoint':
+            await self.sync()
+
+    async def sync(self):
+        start = time.monotonic()
+        await self.writer.run(os.fsync, self.fd)
+        metrics.observe('disk_fsync_seconds', time.monotonic() - start, source=self.source)
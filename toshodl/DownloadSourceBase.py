@@ -3,10 +3,21 @@
 import httpx
 import time
 import asyncio
-import aiofiles
 import os.path
+import contextlib
 
 from toshodl.HttpClient import HttpClient
+from toshodl.ClientPool import host_slot_suspended
+from toshodl.Scheduler import Scheduler
+from toshodl.RateLimiter import RateLimiter
+from toshodl.SourceRanker import SourceRanker
+from toshodl.BrowserPool import BrowserPool
+from toshodl.PageExtractor import PageExtractor
+from toshodl.Metrics import metrics
+from toshodl.ProgressBoard import board
+from toshodl.ResumeState import ResumeState, total_length
+from toshodl.DiskWriter import DiskWriter
+from toshodl.RetryPolicy import XThrottled
 
 # raised when one source wants to give up and allow another source to try
 class XTryAnotherSource(Exception):
@@ -16,10 +27,69 @@ class XTryAnotherSource(Exception):
 class XTryThisSourceAgain(Exception):
     pass
 
+# raised when a segment can't be fetched on its own, and the whole piece
+# needs to be tried again
+class XSegmentRefused(Exception):
+    pass
+
 class DownloadSourceBase(HttpClient):
-    def __init__(self, url, filename, *args, **kwargs):
+    # When true, keep a sidecar next to the working file recording how much
+    # has been saved so retries (and restarts of the program) can ask for
+    # just the rest of the file with a Range request
+    resumable = True
+    # Update the sidecar after about this many bytes
+    resume_checkpoint_bytes = 16 * 1048576
+
+    # Read the response this many bytes at a time, and write it to disk in
+    # blocks of write_size.  If the disk falls behind and write_buffer_size
+    # bytes are waiting, stop reading until it catches up
+    chunk_size = 65536
+    write_size = 1048576
+    write_buffer_size = 4 * 1048576
+    disk_writer = DiskWriter()
+
+    # Fetch a piece as up to this many byte ranges at the same time, each
+    # over its own connection, if the host supports Range requests.  1 means
+    # a plain single stream.  Subclasses opt in by raising it, and entries in
+    # segments_per_host (hostname => count) override it for particular hosts
+    max_segments = 1
+    segments_per_host = { }
+    # Each segment gets at least this many bytes
+    min_segment_size = 8 * 1048576
+    _no_segment_hosts = set()
+
+    # Limits on how many of this class's pieces can be transferring, or
+    # working out their download links, at the same time.  None means only
+    # the scheduler's per-host and overall limits apply
+    transfer_limit = None
+    resolve_limit = None
+    scheduler = Scheduler()
+    rate_limiter = RateLimiter()
+    ranker = SourceRanker()
+    # For sources that need a real browser to get the link
+    browser_pool = BrowserPool()
+    # For sources that scrape the link out of HTML pages
+    page_extractor = PageExtractor()
+
+    # hasher is the ChainedHasher PieceHasher this piece reports its bytes to.
+    # slot is the PieceLayout PieceSlot if this piece is written into part of
+    # a file shared with the other pieces, starting at self.base_offset.
+    # progress gets add_bytes() calls as chunks are saved, and its pathname
+    # and size label this piece on the progress board
+    def __init__(self, url, filename, hasher=None, slot=None, progress=None, *args, **kwargs):
         self.url = url
         self.filename = filename
+        self.hasher = hasher
+        self.progress = progress
+        self.slot = slot
+        self.base_offset = 0
+        self.resolve_slot = None
+        self.transfer_slot = None
+        self.link_start = None
+        # Subclasses that download with an account token set this so
+        # transfers can be limited per token
+        self.account_token = None
+        self.resume = ResumeState(filename, sidecar=slot.sidecar if slot else None)
         super().__init__(*args, **kwargs)
 
     def __str__(self):
@@ -29,74 +99,356 @@ class DownloadSourceBase(HttpClient):
         raise NotImplemented(f'Class { type(self).__name__ } does not implement "download_from_url()"')
 
     async def download(self):
+        if self.resumable:
+            self.resume.load()
+            if self.resume.is_complete():
+                self.print(f'{ self.filename } was already downloaded\n')
+                await self.place(self.resume.content_length)
+                self.piece_done()
+                return
+        else:
+            self.resume.remove()
+
+        # Don't start new pieces on a host that keeps failing (see RetryPolicy)
+        host = httpx.URL(self.url).host
+        if not self.retry_policy.allow(host):
+            self.print(f'*** { host } keeps failing, trying another source for { self.filename }...\n')
+            raise XTryAnotherSource
+
+        # stream_to_file() gives up the resolution slot when the link is ready
+        async def resolve_and_download():
+            self.resolve_slot = self.scheduler.resolution(self, self.url)
+            async with self.resolve_slot:
+                self.link_start = time.monotonic()
+                return await self.download_from_url()
+
         try:
-            return await self.exception_retry(self.download_from_url,
-                                              exception=(httpx.TransportError, XTryThisSourceAgain),
-                                              tries=5)
-        except (httpx.TransportError, XTryThisSourceAgain):
+            rv = await self.exception_retry(resolve_and_download,
+                                            exception=(httpx.TransportError, XTryThisSourceAgain),
+                                            host=host)
+        except (httpx.TransportError, XTryThisSourceAgain, XThrottled):
             self.print(f'*** Exhausted retries downloading from { self.url }, trying another source...\n')
             raise XTryAnotherSource
 
-    async def save_stream_response(self, response):
-        self.print(f'Trying to download from { response.url }\n')
-        if response.status_code != 200:
-            self.print(f"  status code { response.status_code }, try another source...\n")
+        self.piece_done()
+        return rv
+
+    def piece_done(self):
+        if self.hasher:
+            self.hasher.done(self.resume.content_length if self.slot else os.path.getsize(self.filename))
+
+    # Find out where in the shared file this piece goes, now that we know how
+    # big it is.  response is the open one the size came from, if any
+    async def place(self, size, response=None):
+        if self.slot is None:
+            return
+        if size is None:
+            self.print(f'*** Need to know the size of { self.url } to write it into { self.filename }\n')
             raise XTryAnotherSource()
+
+        async with contextlib.AsyncExitStack() as stack:
+            if not self.slot.is_ready():
+                # The pieces we're waiting on may need these slots to get going
+                for s in (self.resolve_slot, self.transfer_slot):
+                    if s is not None:
+                        await stack.enter_async_context(s.suspended())
+                # Including the connection slot for the host, which the
+                # response keeps until it's closed
+                if response is not None:
+                    await stack.enter_async_context(host_slot_suspended(response))
+            self.base_offset = await self.slot.place(size)
+        if self.hasher:
+            self.hasher.base_offset = self.base_offset
+
+    # Subclasses can override this to look at the response before the body
+    # is saved, and raise XTryThisSourceAgain or XTryAnotherSource
+    def check_stream_response(self, response):
+        pass
+
+    # How many byte ranges to fetch a piece as at the same time for this url.
+    # Hosts in segments_per_host override the class's max_segments, and hosts
+    # that turned down a ranged request for a segment only get one stream
+    def segment_count(self, url):
+        host = httpx.URL(url).host
+        if host in DownloadSourceBase._no_segment_hosts:
+            return 1
+        return DownloadSourceBase.segments_per_host.get(host, self.max_segments)
+
+    # GET the url and save the body to self.filename, resuming a previous
+    # attempt if possible.  Extra args are passed along to client.stream()
+    async def stream_to_file(self, url, client=None, headers=None, **kwargs):
+        # We have the link now, so trade the resolution slot for a transfer slot
+        if self.resolve_slot is not None:
+            self.resolve_slot.release()
+        if self.link_start is not None:
+            metrics.observe('phase_seconds', time.monotonic() - self.link_start, phase='link', source=type(self).__name__)
+            self.link_start = None
+        self.transfer_slot = self.scheduler.transfer(self, url, token=self.account_token)
+        async with self.transfer_slot:
+            with metrics.timer('transfer', source=type(self).__name__):
+                await self.fetch_to_file(url, client, headers, **kwargs)
+
+    async def fetch_to_file(self, url, client=None, headers=None, **kwargs):
+        if client is None:
+            client = self.client
+        headers = dict(headers) if headers else { }
+        segments = self.segment_count(url)
+
+        if self.resume.segments:
+            if segments > 1 and self.resume.is_preallocated():
+                await self.place(self.resume.content_length)
+                return await self.fetch_segments(client, url, headers, **kwargs)
+            self.resume.unsplit()
+
+        if self.resumable:
+            headers.update(self.resume.request_headers())
+        if segments > 1 and 'Range' not in headers:
+            # Asking for a range tells us if the host supports them, and the
+            # 206 response includes the full size
+            headers['Range'] = 'bytes=0-'
+
+        request_time = time.time()
+        async with client.stream('GET', url, headers=headers, **kwargs) as response:
+            self.ranker.record_ttfb(type(self).__name__, time.time() - request_time)
+            self.check_throttled(response)
+            self.check_stream_response(response)
+            if self.resume.range_finished(response):
+                self.print(f'{ self.filename } was already all downloaded\n')
+                await self.place(self.resume.content_length, response)
+                self.resume.complete = True
+                self.resume.save()
+                return
+            if response.status_code == 416 and 'Range' in headers:
+                # What we have doesn't fit the file on the server any more
+                self.print(f'*** { self.filename } changed on the server, starting over\n')
+                self.resume.remove()
+                raise XTryThisSourceAgain()
+            if segments > 1 and self.can_split(response, segments):
+                self.resume.split(response, min(segments, total_length(response) // self.min_segment_size))
+                await self.place(self.resume.content_length, response)
+                self.preallocate(self.resume.content_length)
+                await self.fetch_segments(client, url, headers, first_response=response, **kwargs)
+            else:
+                await self.save_stream_response(response)
+
+    def can_split(self, response, segments):
+        if response.status_code != 206:
+            return False
+        if response.headers.get('Accept-Ranges', 'bytes') != 'bytes':
+            return False
+        total = total_length(response)
+        return total is not None and total >= 2 * self.min_segment_size
+
+    def preallocate(self, size):
+        if self.slot:
+            return  # place() already allocated our part of the shared file
+        self.make_working_dir()
+        with open(self.filename, 'wb') as fh:
+            try:
+                os.posix_fallocate(fh.fileno(), 0, size)
+            except (AttributeError, OSError):
+                fh.truncate(size)
+
+    def make_working_dir(self):
         dirname = os.path.dirname(self.filename)
         try:
             os.makedirs(dirname)
         except FileExistsError:
             pass
 
-        start_time = prev_time = time.time()
-        bytes_dl = prev_bytes = 0
-        total_size = int(response.headers['Content-Length'])
+    # Fetch all the unfinished segments at the same time.  first_response is
+    # the already-open response for the probe request, which continues on
+    # as the first segment
+    async def fetch_segments(self, client, url, headers, first_response=None, **kwargs):
+        remaining = [ seg for seg in self.resume.segments if seg['pos'] < seg['end'] ]
+        self.print(f'Downloading { self.filename } as { len(remaining) } segments\n')
+        progress = TransferProgress(self, self.resume.content_length,
+                                    sum(seg['pos'] - seg['start'] for seg in self.resume.segments))
+        if self.hasher:
+            self.hasher.start_at(self.resume.contiguous_bytes())
+
+        try:
+            with progress:
+                async with asyncio.TaskGroup() as tg:
+                    for seg in remaining:
+                        response = first_response if seg['start'] == 0 and seg['pos'] == 0 else None
+                        tg.create_task(self.fetch_segment(client, url, headers, seg, progress,
+                                                          response=response, **kwargs))
+        except ExceptionGroup as eg:
+            # download() retries on particular exception types, not groups
+            raise eg.exceptions[0]
+
+        if self.resumable:
+            self.resume.complete = True
+            self.resume.save()
+        else:
+            self.resume.remove()
+        progress.print_done()
+
+    # Download one segment, retrying it on its own if it times out, the host
+    # says to slow down or the source wants to try again (a 5xx, say)
+    async def fetch_segment(self, client, url, headers, seg, progress, response=None, **kwargs):
+        async def attempt():
+            nonlocal response
+            if response is not None:
+                rsp, response = response, None
+                return await self.save_segment(rsp, seg, progress)
 
-        def print_progress(msg = 'In progress:', final=False):
-            nonlocal prev_time
-            nonlocal prev_bytes
+            seg_headers = dict(headers)
+            seg_headers.update(self.resume.range_headers(seg['pos'], seg['end']))
+            async with client.stream('GET', url, headers=seg_headers, **kwargs) as rsp:
+                self.check_throttled(rsp)
+                self.check_stream_response(rsp)
+                if rsp.status_code != 206 or not self.resume.range_matches(rsp, seg['pos']):
+                    self.segment_refused(rsp, url)
+                await self.save_segment(rsp, seg, progress)
 
-            bytes_report = bytes_dl if final else (bytes_dl - prev_bytes)
-            time_report  = start_time if final else prev_time
+        try:
+            await self.exception_retry(attempt, exception=(httpx.TransportError, XTryThisSourceAgain),
+                                       name=f'{ self.filename } bytes { seg["start"] }-{ seg["end"] }')
+        except XSegmentRefused:
+            raise XTryThisSourceAgain()
 
-            kb = bytes_report / 1024
-            k_per_sec = bytes_report / 1024 / (time.time() - time_report)
-            mb_dl = bytes_dl / 1048576
-            pct = bytes_dl / total_size * 100
-            self.print(f'{msg} {self.filename} %0.2f MB %0.2f KB/s %0.1f%%\n' % ( mb_dl, k_per_sec, pct))
+    # A segment request didn't get the range it asked for
+    def segment_refused(self, response, url):
+        if response.status_code >= 500:
+            raise XTryThisSourceAgain()
+        if response.status_code == 416 or (response.status_code == 200 and not self.resume.validators_match(response)):
+            self.print(f'*** { self.filename } changed on the server, starting over\n')
+            self.resume.remove()
+        else:
+            # The first request worked, but this host won't do more than one
+            self.print(f'*** { httpx.URL(url).host } refused a segment request, using one stream\n')
+            DownloadSourceBase._no_segment_hosts.add(httpx.URL(url).host)
+        raise XSegmentRefused()
 
-            prev_bytes = bytes_dl
-            prev_time = time.time()
+    # A FileWriter for this piece, from offset within it on.  The hasher
+    # hears about bytes once they're in the file
+    def open_writer(self, mode, offset):
+        def written(pos, data):
+            if self.hasher:
+                self.hasher.feed(pos - self.base_offset, data)
+        return self.disk_writer.open(self.filename, mode, self.base_offset + offset,
+                                     write_size=self.write_size, buffer_size=self.write_buffer_size,
+                                     on_written=written, source=type(self).__name__)
 
-        async with aiofiles.open(self.filename, mode='wb') as fh:
-            with ProgressTimer(start=10, interval=30, cb=print_progress) as t:
-                # We'll get a httpx.ReadTimeout if there's a download timeout
-                # which will get caught in the exeption_retry() of download()
-                async for chunk in response.aiter_bytes(chunk_size=65536):
-                    bytes_dl += len(chunk)
-                    await fh.write(chunk)
+    async def save_segment(self, response, seg, progress):
+        pos = seg['pos']
+        host = response.url.host
 
-        print_progress(msg='Done downloading', final=True)
+        async with self.open_writer('r+b', pos) as out:
+            # Only count what's made it to disk
+            async def checkpoint():
+                await out.flush()
+                seg['pos'] = pos
+                if self.resumable:
+                    self.resume.save()
 
-class ProgressTimer(object):
-    def __init__(self, interval, cb, start = None):
-        self.interval = interval
-        self.start = start
-        self.cb = cb
+            try:
+                async for chunk in response.aiter_bytes(chunk_size=self.chunk_size):
+                    chunk = chunk[:seg['end'] - pos]
+                    await self.rate_limiter.throttle(host, len(chunk))
+                    metrics.add_bytes(type(self).__name__, host, len(chunk))
+                    await out.write(chunk)
+                    if self.progress:
+                        self.progress.add_bytes(len(chunk))
+                    pos += len(chunk)
+                    progress.bytes_dl += len(chunk)
+                    if pos >= seg['end']:
+                        # The first segment's request was open-ended
+                        break
+                    if pos - seg['pos'] >= self.resume_checkpoint_bytes:
+                        await checkpoint()
+            finally:
+                await checkpoint()
 
-    def __enter__(self):
-        self.task = asyncio.create_task(self._run())
+        if pos < seg['end']:
+            raise httpx.RemoteProtocolError(f'Segment ended early at byte { pos } of { seg["end"] }')
 
-    def __exit__(self, type, value, traceback):
-        self.task.cancel()
+    async def save_stream_response(self, response):
+        self.print(f'Trying to download from { response.url }\n')
+        if response.status_code not in (200, 206):
+            self.print(f"  status code { response.status_code }, try another source...\n")
+            raise XTryAnotherSource()
+        self.make_working_dir()
+
+        offset = self.resume.start_offset(response)
+        if offset is None:
+            self.print(f'*** Range response for { self.filename } does not match what we have, starting over\n')
+            self.resume.remove()
+            raise XTryThisSourceAgain()
+        if offset > 0:
+            self.print(f'Resuming { self.filename } at byte { offset }\n')
+        await self.place(self.resume.content_length, response)
+        if self.hasher:
+            self.hasher.start_at(offset)
+
+        checkpoint_bytes = offset
+        host = response.url.host
+        total_size = self.resume.content_length or offset + int(response.headers.get('Content-Length', 0))
+        progress = TransferProgress(self, total_size, offset)
 
-    async def _run(self):
-        if self.start is not None:
-            await asyncio.sleep(self.start)
+        if self.slot:
+            mode = 'r+b'
         else:
-            await asyncio.sleep(self.interval)
+            mode = 'ab' if offset else 'wb'
+        async with self.open_writer(mode, offset) as out:
+            # Only count what's made it to disk
+            async def checkpoint():
+                nonlocal checkpoint_bytes
+                if not self.resumable:
+                    return
+                await out.flush()
+                self.resume.bytes = checkpoint_bytes = progress.bytes_dl
+                self.resume.save()
 
-        while True:
-            self.cb()
-            await asyncio.sleep(self.interval)
+            try:
+                with progress:
+                    # We'll get a httpx.ReadTimeout if there's a download timeout
+                    # which will get caught in the exeption_retry() of download()
+                    async for chunk in response.aiter_bytes(chunk_size=self.chunk_size):
+                        await self.rate_limiter.throttle(host, len(chunk))
+                        metrics.add_bytes(type(self).__name__, host, len(chunk))
+                        await out.write(chunk)
+                        if self.progress:
+                            self.progress.add_bytes(len(chunk))
+                        progress.bytes_dl += len(chunk)
+                        if progress.bytes_dl - checkpoint_bytes >= self.resume_checkpoint_bytes:
+                            await checkpoint()
+            finally:
+                # Remember how far we got, even if the transfer died
+                await checkpoint()
+
+        if self.resumable:
+            self.resume.complete = True
+            self.resume.save()
+        progress.print_done()
+
+# Keeps track of the bytes saved for one file.  It's on the progress board
+# for the length of a with block
+class TransferProgress(object):
+    def __init__(self, dl, total_size, offset=0):
+        self.dl = dl
+        self.total_size = total_size
+        self.offset = offset
+        self.bytes_dl = offset
+        self.start_time = time.time()
+        self.file = getattr(dl.progress, 'pathname', dl.filename)
+        self.file_size = getattr(dl.progress, 'size', total_size)
+        self.batch = os.path.dirname(self.file) or None
+
+    def __enter__(self):
+        board.track(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        board.untrack(self)
 
+    def print_done(self):
+        bytes_report = self.bytes_dl - self.offset
+        k_per_sec = bytes_report / 1024 / max(time.time() - self.start_time, 0.001)
+        if bytes_report > 0:
+            self.dl.ranker.record_rate(type(self.dl).__name__, k_per_sec * 1024)
+        mb_dl = self.bytes_dl / 1048576
+        pct = self.bytes_dl / self.total_size * 100 if self.total_size else 0
+        self.dl.print(f'Done downloading {self.dl.filename} %0.2f MB %0.2f KB/s %0.1f%%\n' % ( mb_dl, k_per_sec, pct))
@@ -4,20 +4,32 @@
 #
 # The file might have been split into multiple parts.  If so, we'll create
 # tasks to download each of those parts, and then join them together when
-# they're all downloaded.
+# they're all downloaded.  With direct_write turned on, the parts are instead
+# written straight into their places in one preallocated file, and there's
+# nothing to join.
 #
 # The file will have one or more download sources.  We'll make a list of
-# the sources we support, randomize them, then try them in order
+# the sources we support, rank them by how well they've been doing lately
+# (see SourceRanker), then try them in order.  With hedge turned on, a slow
+# source gets raced against the next one.
+#
+# Progress is recorded in the JobJournal.  After a restart the source a file
+# was being downloaded from goes first, so its pieces can be resumed.
 
 import os
+import time
+import errno
+import shutil
 import asyncio
-import aiofiles
 import aiofiles.os
-import hashlib
-import random
 
 from toshodl.Printable import Printable
-from toshodl.DownloadSourceBase import XTryAnotherSource
+from toshodl.DownloadSourceBase import DownloadSourceBase, XTryAnotherSource
+from toshodl.ResumeState import ResumeState
+from toshodl.ChainedHasher import ChainedHasher
+from toshodl.PieceLayout import PieceLayout
+from toshodl.Metrics import metrics
+from toshodl.JobJournal import journal
 
 # A list of classes we've imported that we can download from.
 from toshodl.KrakenFilesDownloader import KrakenFilesDownloader
@@ -32,12 +44,24 @@ download_classes = {
 
 class FileDownloader(Printable):
 
-    dl_sem = asyncio.Semaphore(5)  # limit concurrent downloads
+    # Write the pieces of a split file directly into one working file at
+    # their own offsets.  Saves the join, and needs half the disk space
+    direct_write = False
+
+    # Race sources against each other: if the first source is on track to
+    # take longer than hedge_slow seconds after hedge_warmup seconds of
+    # downloading, start the next source too, and keep whichever finishes
+    # first.  Only works when we know the file's size.
+    hedge = False
+    hedge_warmup = 60
+    hedge_slow = 15 * 60
+    hedge_check_interval = 10
 
     def __init__(self,  filename,
                         md5,
                         links,
                         bundle = None,
+                        size = None,
                         *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -45,6 +69,7 @@ class FileDownloader(Printable):
         self.pathname = os.path.join(bundle, filename) if bundle else filename
         self.working_pathname = os.path.join('working', self.pathname)
         self.md5 = md5
+        self.size = size
 
         supported_sources = set(download_classes.keys())
         available_sources = set(links.keys())
@@ -53,72 +78,158 @@ class FileDownloader(Printable):
     async def download(self):
         if self.is_already_downloaded():
             self.print(f'Skipping { self.filename } because it already exists\n')
+            journal.set_file_state(self.pathname, 'done')
             return
 
-        source_names = list(self.sources.keys())
-        random.shuffle(source_names)
-        for source in source_names:
-            try:
-                self.print(f'Downloading { len(self.sources[source]) } pieces from { source } for { self.filename }\n')
-                dl_class = download_classes[source]
+        source_names = self.ranker.rank({ name: download_classes[name] for name in self.sources }, self.size)
+        journaled = journal.file(self.pathname)
+        if journaled and journaled['source'] in source_names:
+            self.print(f'Resuming { self.filename } from { journaled["source"] }\n')
+            source_names.remove(journaled['source'])
+            source_names.insert(0, journaled['source'])
 
-                piece_tasks = [ ]
-                async with asyncio.TaskGroup() as tg:
-                    for idx, link in enumerate(self.sources[source], start=1):
-                        task = tg.create_task(self.download_piece(dl_class, link, idx))
-                        piece_tasks.append(task)
+        if self.hedge and self.size and len(source_names) > 1:
+            await self.hedged_download(source_names)
+            return
 
-                working_filenames = [ t.result() for t in piece_tasks ]
-                await self.finalize_file(working_filenames)
+        for source in source_names:
+            attempt = SourceAttempt(self, source, self.working_pathname)
+            try:
+                await attempt.download()
+                await self.finalize_attempt(attempt)
                 return # This one worked; don't try other sources
 
             except* XTryAnotherSource as e:
-                self.print(f'*** Source { source } gave up on { self.filename }, trying the next one...\n')
-                await self.remove_working_files(source)
+                self.source_failed(attempt)
+                await attempt.remove_working_files()
 
         self.print(f'*** There are no more sources for { self.filename }\n')
+        journal.set_file_state(self.pathname, 'failed')
 
-    async def remove_working_files(self, source):
-        for i in range(len(self.sources[source])):
-            dl_filename = '%s.%03d' % ( self.working_pathname, i+1)
-            self.print(f'*** deleting: { dl_filename }\n')
-            try:
-                await aiofiles.os.unlink(dl_filename)
-            except FileNotFoundError:
-                pass
+    @property
+    def ranker(self):
+        return DownloadSourceBase.ranker
+
+    def source_failed(self, attempt):
+        self.print(f'*** Source { attempt.source } gave up on { self.filename }, trying the next one...\n')
+        self.ranker.record_failure(attempt.dl_class.__name__)
+        metrics.inc('try_another_source_total', source=attempt.dl_class.__name__)
+
+    async def finalize_attempt(self, attempt):
+        if await self.finalize_file(attempt):
+            self.ranker.record_success(attempt.dl_class.__name__)
+        else:
+            self.ranker.record_failure(attempt.dl_class.__name__)
+
+    # Start with the best source, and if it's too slow, race it against the
+    # next one.  The first to finish wins and the other is cancelled.
+    async def hedged_download(self, source_names):
+        waiting = list(source_names)
+        running = { }   # task => SourceAttempt
+
+        def start_next():
+            # The first source gets the usual working filenames so it can be
+            # resumed by a later run; the others get their own
+            first = len(waiting) == len(source_names)
+            source = waiting.pop(0)
+            working_pathname = self.working_pathname if first else f'{ self.working_pathname }~{ source }'
+            attempt = SourceAttempt(self, source, working_pathname)
+            running[asyncio.create_task(attempt.download())] = attempt
+
+        start_next()
+        try:
+            while running:
+                done, pending = await asyncio.wait(running.keys(), timeout=self.hedge_check_interval,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = running[task]
+                    if task.exception() is None:
+                        del running[task]
+                        for other_task, other in running.items():
+                            self.print(f'{ attempt.source } beat { other.source } to { self.filename }\n')
+                            other_task.cancel()
+                        await asyncio.gather(*running.keys(), return_exceptions=True)
+                        for other in running.values():
+                            await other.remove_working_files()
+                        running.clear()
+                        await self.finalize_attempt(attempt)
+                        return
+
+                    # Anything other than a source giving up is a real problem
+                    exc = task.exception()
+                    if isinstance(exc, ExceptionGroup):
+                        exc = exc.split(XTryAnotherSource)[1]
+                    elif isinstance(exc, XTryAnotherSource):
+                        exc = None
+                    if exc is not None:
+                        raise exc
+                    del running[task]
+                    self.source_failed(attempt)
+                    await attempt.remove_working_files()
+
+                if waiting and not running:
+                    start_next()
+                elif waiting and len(running) == 1:
+                    attempt = next(iter(running.values()))
+                    remaining = attempt.projected_remaining(self.size)
+                    if remaining is not None and remaining > self.hedge_slow:
+                        # It's infinite if nothing has arrived yet
+                        estimate = f'about { int(remaining) }s' if remaining != float('inf') else 'who knows how long'
+                        self.print(f'{ attempt.source } needs { estimate } more for { self.filename }, also trying { waiting[0] }\n')
+                        start_next()
+        finally:
+            # Something went wrong, or we were cancelled.  Stop the others
+            # writing, and clean up after the hedges, which a later run
+            # can't resume
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running.keys(), return_exceptions=True)
+            for attempt in running.values():
+                if not attempt.journaled:
+                    await attempt.remove_working_files()
+
+        self.print(f'*** There are no more sources for { self.filename }\n')
+        journal.set_file_state(self.pathname, 'failed')
 
     def is_already_downloaded(self):
         return os.path.exists(self.pathname)
 
-    # Download one piece of a file with the given download class and URL/link
-    # Return the working filename
-    async def download_piece(self, source_class, link, idx):
-        async with FileDownloader.dl_sem:
-            self.print(f'{ self.filename } part { idx }: { link }\n')
-            dl_filename = '%s.%03d' % ( self.working_pathname, idx)
-            dl = source_class(url=link, filename=dl_filename)
-            await dl.download()
-        return dl_filename
-
     # Join the pieces into the final combined file
-    async def finalize_file(self, working_filenames):
+    async def finalize_file(self, attempt):
         self.make_batch_subdir()
+        working_filenames = attempt.working_filenames
+        journal.set_file_state(self.pathname, 'finalizing')
+
+        with metrics.timer('hash'):
+            md5 = await attempt.hasher.result()
 
-        if len(working_filenames) > 1:
+        if attempt.layout:
+            self.print(f'All parts of { self.pathname } were written in place\n')
+            await self.move_single_file(attempt.working_pathname)
+
+        elif len(working_filenames) > 1:
             self.print(f'All parts of { self.pathname } are done\n')
-            md5 = await self.join_file_parts(working_filenames)
+            await self.join_file_parts(working_filenames)
 
         else:
             self.print(f'{ self.pathname } is just one part\n')
-            md5 = await self.move_single_file(working_filenames[0])
+            await self.move_single_file(working_filenames[0])
+
+        # The file is in place; we won't need to resume its pieces.  Until
+        # now a restart could pick them up again
+        for idx in range(1, len(working_filenames) + 1):
+            ResumeState(attempt.piece_filename(idx)).remove()
 
         if md5.hexdigest() != self.md5:
             self.print(f'*** { self.pathname } md5 differs!\n    Got      { md5.hexdigest() }\n    Expected { self.md5 }\n')
+            metrics.inc('md5_mismatch_total', source=attempt.dl_class.__name__)
             dirname = os.path.dirname(self.pathname)
             orig_filename = os.path.basename(self.pathname)
             os.rename(self.pathname, os.path.join(dirname, f'badsum-{ orig_filename }'))
+            journal.set_file_state(self.pathname, 'badsum')
             return False
 
+        journal.set_file_state(self.pathname, 'done')
         return True
 
     def make_batch_subdir(self):
@@ -129,29 +240,195 @@ class FileDownloader(Printable):
         except FileExistsError:
             pass
 
+    # The rest of the parts are appended to the first one, then it's renamed
+    # into place.  That way the first part is never copied, and a
+    # half-joined file never shows up under the final name.
     async def join_file_parts(self, parts):
-        async with aiofiles.open(self.pathname, 'wb') as fh:
-            md5 = hashlib.md5()
-            for part in parts:
-                self.print(f'  { part }\n')
-                await self.flush_stdout()
-                async with aiofiles.open(part, 'rb') as part_fh:
-                    chunk = await part_fh.read()
-                    md5.update(chunk)
-                    await fh.write(chunk)
+        for part in parts:
+            self.print(f'  { part }\n')
+        await self.flush_stdout()
+
+        with metrics.timer('join'):
+            await asyncio.to_thread(append_files, parts[0], parts[1:])
+        os.rename(parts[0], self.pathname)
         self.print(f'  ===> { self.pathname }\n')
         await self.flush_stdout()
 
-        for part in parts:
+        for part in parts[1:]:
             os.remove(part)
 
-        return md5
-
     async def move_single_file(self, dl_filename):
-        md5 = hashlib.md5()
-        async with aiofiles.open(dl_filename, 'rb') as part_fh:
-            chunk = await part_fh.read()
-            md5.update(chunk)
         os.rename(dl_filename, self.pathname)
 
-        return md5
+# One try at downloading all the pieces of a file from one source
+class SourceAttempt(object):
+    def __init__(self, fd, source, working_pathname):
+        self.fd = fd
+        self.pathname = fd.pathname
+        self.size = fd.size
+        self.source = source
+        self.dl_class = download_classes[source]
+        self.links = fd.sources[source]
+        self.working_pathname = working_pathname
+        # A hedged attempt with its own working files isn't journaled; a
+        # later run resumes the one using the usual ones
+        self.journaled = working_pathname == fd.working_pathname
+        self.working_filenames = None
+        self.bytes = 0
+        self.resumed = 0
+        self.start_time = time.time()
+
+        piece_count = len(self.links)
+        if fd.direct_write and piece_count > 1:
+            self.layout = PieceLayout(working_pathname,
+                                      [ ResumeState(self.piece_filename(idx)).sidecar
+                                        for idx in range(1, piece_count + 1) ])
+            piece_filenames = [ working_pathname ] * piece_count
+        else:
+            self.layout = None
+            piece_filenames = [ self.piece_filename(idx) for idx in range(1, piece_count + 1) ]
+        # The MD5 is worked out as the pieces come in
+        self.hasher = ChainedHasher(piece_filenames)
+
+    def piece_filename(self, idx):
+        return '%s.%03d' % ( self.working_pathname, idx)
+
+    async def download(self):
+        if self.journaled:
+            journaled = journal.file(self.fd.pathname)
+            if journaled and journaled['source'] == self.source and journaled['state'] == 'finalizing':
+                self.undo_partial_join(journaled['pieces'])
+            journal.start_file(self.fd.pathname, self.source)
+        self.resumed = self.resumed_bytes()
+
+        self.fd.print(f'Downloading { len(self.links) } pieces from { self.source } for { self.fd.filename }\n')
+        piece_tasks = [ ]
+        async with asyncio.TaskGroup() as tg:
+            for idx, link in enumerate(self.links, start=1):
+                task = tg.create_task(self.download_piece(link, idx))
+                piece_tasks.append(task)
+
+        self.working_filenames = [ t.result() for t in piece_tasks ]
+
+    # Download one piece of a file with the given URL/link
+    # Return the working filename
+    # Concurrency is limited by the download class's Scheduler
+    async def download_piece(self, link, idx):
+        self.fd.print(f'{ self.fd.filename } part { idx }: { link }\n')
+        if self.layout:
+            dl_filename = self.working_pathname
+            slot = self.layout.slot(idx-1)
+        else:
+            dl_filename = self.piece_filename(idx)
+            slot = None
+        dl = self.dl_class(url=link, filename=dl_filename, hasher=self.hasher.piece(idx-1), slot=slot,
+                           progress=self)
+        await dl.download()
+        if self.journaled:
+            journal.piece_done(self.fd.pathname, idx, dl.resume.content_length if self.layout else os.path.getsize(dl_filename))
+        return dl_filename
+
+    # Joining appends the other pieces to the first one.  If that was cut
+    # off, cut the first piece back to its own size so it counts as
+    # downloaded again
+    def undo_partial_join(self, piece_sizes):
+        if self.layout or 1 not in piece_sizes:
+            return
+        first = self.piece_filename(1)
+        try:
+            if os.path.getsize(first) > piece_sizes[1]:
+                self.fd.print(f'Undoing the unfinished join of { self.fd.pathname }\n')
+                os.truncate(first, piece_sizes[1])
+        except FileNotFoundError:
+            pass
+
+    # The downloaders report each chunk they save
+    def add_bytes(self, n):
+        self.bytes += n
+
+    # How much of the pieces earlier runs already saved, going by their
+    # sidecars
+    def resumed_bytes(self):
+        total = 0
+        for idx in range(1, len(self.links) + 1):
+            resume = ResumeState(self.piece_filename(idx))
+            resume.load()
+            total += resume.saved_bytes()
+        return total
+
+    # Seconds until this attempt is done, going by the rate so far, or None
+    # if it's too soon to tell
+    def projected_remaining(self, size):
+        elapsed = time.time() - self.start_time
+        if elapsed < self.fd.hedge_warmup:
+            return None
+        remaining = max(size - self.resumed - self.bytes, 0)
+        if remaining == 0:
+            return 0
+        if self.bytes == 0:
+            return float('inf')
+        return remaining / (self.bytes / elapsed)
+
+    async def remove_working_files(self):
+        for i in range(len(self.links)):
+            dl_filename = self.piece_filename(i+1)
+            self.fd.print(f'*** deleting: { dl_filename }\n')
+            for f in (dl_filename, ResumeState(dl_filename).sidecar):
+                try:
+                    await aiofiles.os.unlink(f)
+                except FileNotFoundError:
+                    pass
+        try:
+            await aiofiles.os.unlink(self.working_pathname)
+        except FileNotFoundError:
+            pass
+
+
+# Append the contents of each of the files in 'sources' to 'dest'.  This is
+# blocking, so run it in a thread.
+def append_files(dest, sources):
+    with open(dest, 'r+b') as out:
+        pos = out.seek(0, os.SEEK_END)
+        for src in sources:
+            with open(src, 'rb') as inp:
+                size = os.fstat(inp.fileno()).st_size
+                copy_range(inp, out, pos, size)
+                pos += size
+
+# The errors that mean "this kind of copy won't work for these files", as
+# opposed to a real I/O problem
+_copy_unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+# Copy all of inp to out starting at dst_offset.  Let the kernel do it if it
+# can: copy_file_range() doesn't bring the data into userspace, and on
+# filesystems that support it (btrfs, XFS) it makes a reflink instead of
+# copying at all.  sendfile() is next best, and a plain read/write loop is
+# the last resort.
+def copy_range(inp, out, dst_offset, size):
+    copied = 0
+    for copier in (_copy_file_range, _sendfile):
+        try:
+            while copied < size:
+                n = copier(inp.fileno(), out.fileno(), copied, dst_offset + copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except AttributeError:
+            continue    # Not available on this platform
+        except OSError as e:
+            if e.errno not in _copy_unsupported:
+                raise
+            continue
+        if copied == size:
+            return
+
+    inp.seek(copied)
+    out.seek(dst_offset + copied)
+    shutil.copyfileobj(inp, out, 1048576)
+
+def _copy_file_range(in_fd, out_fd, src_offset, dst_offset, count):
+    return os.copy_file_range(in_fd, out_fd, min(count, 1 << 30), src_offset, dst_offset)
+
+def _sendfile(in_fd, out_fd, src_offset, dst_offset, count):
+    os.lseek(out_fd, dst_offset, os.SEEK_SET)
+    return os.sendfile(out_fd, in_fd, src_offset, min(count, 1 << 30))
@@ -1,58 +1,22 @@
 from urllib.parse import urlparse
 import os.path
-import re
-import asyncio
 
-from toshodl.DownloadSourceBase import DownloadSourceBase,XTryAnotherSource
+from toshodl.DownloadSourceBase import DownloadSourceBase,XTryAnotherSource,XTryThisSourceAgain
+from toshodl.GoFileTokens import GoFileTokens
 
 # Originally based on https://github.com/ltsdw/gofile-downloader, but heavily
 # modified since then
 
 class GoFileDownloader(DownloadSourceBase):
-    # websiteToken is used in the getContent API endpoint.  They change it from
-    # time-to-time, so we extract it from a source file and cache it for the
-    # duration of the program
-    # Make access to this serialized
-    _website_token_lock = asyncio.Lock()
-    _website_token = None
-    async def website_token(self):
-        async with GoFileDownloader._website_token_lock:
-            if GoFileDownloader._website_token is None:
-                response = await self.exception_retry(lambda: self.client.get('https://gofile.io/dist/js/config.js'), name='GoFile config.js')
-                js_code = response.text
+    # GoFile's file servers are happy to serve several ranges at once
+    max_segments = 4
 
-                # The code contains a line that looks like:
-                # appdata.wt = "abcdef123456"
-                match = re.search(r'appdata.wt\s+=\s+"([^"]+)"', js_code)
-                if match:
-                    GoFileDownloader._website_token = match[1]
-                    self.print(f'GoFile website_token { GoFileDownloader._website_token }\n')
-                else:
-                    raise ValueError('Could not find website token')
-
-        return GoFileDownloader._website_token
-
-    # A user/session token.  I don't know how long these anonymous users last,
-    # but it seems to be long enough that we can create one when we first
-    # download something, and use it for the whole life of the program.
-    # A previous version created a new account for every download, and it got
-    # throttled on their end for getting hit too often,
-    # Make access to this serialized
-    _dl_token_lock = asyncio.Lock()
-    _dl_token = None
-    async def dl_token(self):
-        async with GoFileDownloader._dl_token_lock:
-            if GoFileDownloader._dl_token is None:
-                response = await self.exception_retry(lambda: self.client.post('https://api.gofile.io/accounts'), name='GoFile accounts')
-                json_data = response.json()
-                # looks like: {data => {token => 0eoxBkYGFYmHZ43mxkJpY2vWLeCYW5SV}, status => ok}
-                if 'data' in json_data and 'token' in json_data['data']:
-                    GoFileDownloader._dl_token = json_data['data']['token']
-                    self.print(f'GoFile dl_token { GoFileDownloader._dl_token }\n')
-                else:
-                    raise KeyError(f'Could not get dl_token, got { json_data }')
-
-        return GoFileDownloader._dl_token
+    # websiteToken is used in the getContent API endpoint, and the account
+    # token for that and the download itself.  See GoFileTokens
+    tokens = GoFileTokens()
+    # API statuses that mean it didn't like one of the tokens
+    website_token_errors = [ 'error-notPremium' ]
+    account_token_errors = [ 'error-auth', 'error-token' ]
 
     async def download_from_url(self):
         # The url we're created with looks like https://gofile.io/d/fileId
@@ -64,11 +28,15 @@ class GoFileDownloader(DownloadSourceBase):
         uri = urlparse(self.url)
         file_id = os.path.basename(uri.path)
 
-        website_token = await self.website_token()
         url = f'https://api.gofile.io/contents/{ file_id }'
         self.print(f"{self.url} => {url}\n")
 
-        dl_token = await self.dl_token()
+        async with self.tokens.account_token(self) as dl_token:
+            self.account_token = dl_token
+            await self.download_contents(url, dl_token)
+
+    async def download_contents(self, url, dl_token):
+        website_token = await self.tokens.website_token(self)
         async def get_json_rsp():
             response = await self.client.get(
                                 url,
@@ -77,6 +45,8 @@ class GoFileDownloader(DownloadSourceBase):
                                     'Authorization': f'Bearer { dl_token }',
                                     'X-Website-Token': website_token,
                                 })
+            if response.status_code == 401:
+                return { 'status': 'error-auth' }
             return response.json()
         json = await self.exception_retry(get_json_rsp)
 
@@ -112,6 +82,14 @@ class GoFileDownloader(DownloadSourceBase):
         if json['status'] == 'error-notFound':
             self.print(f'*** { self.url } is not found here\n')
             raise XTryAnotherSource()
+        if json['status'] in self.website_token_errors:
+            self.print(f'*** GoFile rejected the website token: { json["status"] }\n')
+            self.tokens.reject_website_token(website_token)
+            raise XTryThisSourceAgain()
+        if json['status'] in self.account_token_errors:
+            self.print(f'*** GoFile rejected the account token: { json["status"] }\n')
+            self.tokens.reject_account_token(dl_token)
+            raise XTryThisSourceAgain()
         if json['status'] != 'ok':
             self.print(f'*** Unexpected link data: { json }\n')
             raise XTryAnotherSource()
@@ -119,11 +97,15 @@ class GoFileDownloader(DownloadSourceBase):
             raise ValueError(f"Expected 1 'children' but got { json['data']['children'] }")
         for v in json['data']['children'].values():
             dl_link = v['link']
+            size = v.get('size')
             break
 
-        self.print(f'Downloading from {url} => {dl_link}\n')
-        dl_token = await self.dl_token()
+        # Knowing the size before the download starts lets the pieces after
+        # this one find their place in a shared file sooner
+        if size is not None:
+            await self.place(size)
 
+        self.print(f'Downloading from {url} => {dl_link}\n')
         dl_headers = {
             'Cookie':           f'accountToken={ dl_token }',
             'Accept-Encoding':  'gzip, deflate, br',
@@ -133,7 +115,10 @@ class GoFileDownloader(DownloadSourceBase):
             'Cache-Control':    'no-cache'
         }
 
-        async with self.client.stream('GET', dl_link, headers=dl_headers) as response:
-            await self.save_stream_response(response)
+        await self.stream_to_file(dl_link, headers=dl_headers)
 
-        return
+    def check_stream_response(self, response):
+        if response.status_code in (401, 403):
+            self.print(f'*** GoFile refused the download with { response.status_code }, getting a new account token\n')
+            self.tokens.reject_account_token(self.account_token)
+            raise XTryThisSourceAgain()
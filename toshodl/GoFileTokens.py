@@ -0,0 +1,126 @@
+# The tokens GoFile's API wants, kept in the state directory so they're
+# reused between runs.
+#
+# The website token is scraped from config.js.  They change it from time to
+# time, so it's refreshed after website_token_ttl, or sooner if the API
+# rejects it.  Account tokens are for anonymous users made with /accounts.
+# Up to pool_size of them are kept, and each download uses whichever is
+# least busy, only making a new account when all the existing ones are in
+# use.  An account is dropped after account_token_ttl, or when it's
+# rejected.
+#
+# Refreshes are done under a lock, and a rejection only counts if the token
+# is still the current one, so a burst of failures makes one refresh rather
+# than one each.
+
+import os
+import re
+import json
+import time
+import asyncio
+import contextlib
+
+from toshodl import StateDir
+
+class GoFileTokens(object):
+    config_url = 'https://gofile.io/dist/js/config.js'
+    accounts_url = 'https://api.gofile.io/accounts'
+    website_token_ttl = 6 * 60 * 60
+    account_token_ttl = 7 * 24 * 60 * 60
+    pool_size = 2
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.state = None
+        self.in_use = { }
+        self.website_lock = asyncio.Lock()
+        self.account_lock = asyncio.Lock()
+
+    def load(self):
+        if self.state is not None:
+            return
+        if self.filename is None:
+            self.filename = StateDir.path('gofile-tokens.json')
+        try:
+            with open(self.filename, 'r') as fh:
+                self.state = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.state = { }
+        self.state.setdefault('website', None)
+        self.state.setdefault('accounts', [ ])
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.state, fh, indent=1)
+        os.replace(tmp, self.filename)
+
+    # dl is the GoFileDownloader asking; its client is used for any requests
+    async def website_token(self, dl):
+        async with self.website_lock:
+            self.load()
+            website = self.state['website']
+            if website is None or time.time() - website['fetched'] > self.website_token_ttl:
+                response = await dl.exception_retry(lambda: dl.client.get(self.config_url), name='GoFile config.js')
+
+                # The code contains a line that looks like:
+                # appdata.wt = "abcdef123456"
+                match = re.search(r'appdata.wt\s+=\s+"([^"]+)"', response.text)
+                if not match:
+                    raise ValueError('Could not find website token')
+                website = self.state['website'] = { 'token': match[1], 'fetched': time.time() }
+                self.save()
+                dl.print(f'GoFile website_token { website["token"] }\n')
+            return website['token']
+
+    def reject_website_token(self, token):
+        self.load()
+        if self.state['website'] and self.state['website']['token'] == token:
+            self.state['website'] = None
+            self.save()
+
+    # An account token for the length of the with block
+    @contextlib.asynccontextmanager
+    async def account_token(self, dl):
+        token = await self.acquire_account_token(dl)
+        try:
+            yield token
+        finally:
+            self.in_use[token] -= 1
+
+    async def acquire_account_token(self, dl):
+        async with self.account_lock:
+            self.load()
+            now = time.time()
+            accounts = [ a for a in self.state['accounts'] if now - a['created'] < self.account_token_ttl ]
+            if len(accounts) != len(self.state['accounts']):
+                self.state['accounts'] = accounts
+                self.save()
+
+            least_busy = min(accounts, key=lambda a: self.in_use.get(a['token'], 0), default=None)
+            if least_busy is None or (self.in_use.get(least_busy['token'], 0) > 0 and len(accounts) < self.pool_size):
+                least_busy = await self.create_account(dl)
+
+            token = least_busy['token']
+            self.in_use[token] = self.in_use.get(token, 0) + 1
+            return token
+
+    async def create_account(self, dl):
+        response = await dl.exception_retry(lambda: dl.client.post(self.accounts_url), name='GoFile accounts')
+        json_data = response.json()
+        # looks like: {data => {token => 0eoxBkYGFYmHZ43mxkJpY2vWLeCYW5SV}, status => ok}
+        if 'data' not in json_data or 'token' not in json_data['data']:
+            raise KeyError(f'Could not get dl_token, got { json_data }')
+
+        account = { 'token': json_data['data']['token'], 'created': time.time() }
+        self.state['accounts'].append(account)
+        self.save()
+        dl.print(f'GoFile dl_token { account["token"] }\n')
+        return account
+
+    def reject_account_token(self, token):
+        self.load()
+        accounts = [ a for a in self.state['accounts'] if a['token'] != token ]
+        if len(accounts) != len(self.state['accounts']):
+            self.state['accounts'] = accounts
+            self.save()
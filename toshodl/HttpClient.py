@@ -1,35 +1,64 @@
 # A mixin that gives the consumer a "client" attribute that's an httpx
-# client object
+# client object.  It, and any other clients from "pool", share connections
+# (see ClientPool), and exception_retry(), which retries as retry_policy
+# says (see RetryPolicy)
 
 import httpx
 import asyncio
 
 from toshodl.Printable import Printable
+from toshodl.ClientPool import ClientPool
+from toshodl.RetryPolicy import RetryPolicy, XThrottled, throttle_statuses, error_host
+from toshodl.Metrics import metrics
 
 class HttpClient(Printable):
-    client = httpx.AsyncClient()
+    pool = ClientPool()
+    client = pool.client()
+    retry_policy = RetryPolicy()
 
     def __init__(self, *args, **kwargs):
         self.client = HttpClient.client
         super().__init__(*args, **kwargs)
 
-    async def exception_retry(self, fn, exception=httpx.ConnectTimeout, tries=5, delay=5, name=None):
+    # Call fn until it works, retrying on exception, and on XThrottled or a
+    # 429 or 503 response.  tries and delay override the policy's, which
+    # depend on the error and the host it came from.  If host is given, the
+    # outcome counts toward its circuit breaker, and retrying stops if that
+    # opens
+    async def exception_retry(self, fn, exception=httpx.ConnectTimeout, tries=None, delay=None, name=None, host=None):
         if name is None:
             name = self.url
-        for i in range(tries):
+        exceptions = (exception if isinstance(exception, tuple) else (exception,)) + (XThrottled,)
+        attempt = 0
+        while True:
             try:
                 rv = await fn()
-            except exception as e:
-                self.print(f'*** { self } fn { fn } Caught { type(e) } { e } attempt { i }: { name }\n')
-                if delay and delay > 0:
-                    await asyncio.sleep(delay)
-                last_exception = e
+                if isinstance(rv, httpx.Response) and rv.status_code in throttle_statuses:
+                    raise XThrottled(rv)
+            except exceptions as e:
+                failed_host = host or error_host(e)
+                if host:
+                    self.retry_policy.record_failure(host)
+                metrics.inc('retries_total', source=type(self).__name__, exception=type(e).__name__)
+                attempt += 1
+                if attempt >= (tries or self.retry_policy.tries_for(e, failed_host)):
+                    self.print(f'*** Ran out of retries for { name }, throwing a { type(e).__name__ }: { e }\n')
+                    raise
+                if host and self.retry_policy.is_open(host):
+                    self.print(f'*** { host } keeps failing, giving up on { name }: { type(e).__name__ } { e }\n')
+                    raise
+                wait = self.retry_policy.delay(e, attempt - 1, failed_host) if delay is None else delay
+                self.print(f'*** Caught { type(e).__name__ } { e } on attempt { attempt }: { name }, '
+                           f'trying again in { wait:.1f}s\n')
+                await asyncio.sleep(wait)
                 continue # try again
 
             # if we get here, fn() was successful
+            if host:
+                self.retry_policy.record_success(host)
             return rv
 
-        # If we get here, we ran out of retries
-        self.print(f'*** ran out of retries, throwing a { type(last_exception) }: { last_exception }\n')
-        raise last_exception from last_exception
-
+    # A 429 or 503 is retried after its Retry-After, by exception_retry()
+    def check_throttled(self, response):
+        if response.status_code in throttle_statuses:
+            raise XThrottled(response)
@@ -0,0 +1,157 @@
+# Remembers how far each job got, so a run that dies partway through can be
+# picked up again without repeating the steps that were already done.
+#
+# It's a SQLite file in the state directory, written through as things
+# happen:
+#   titles  each line of input, and the tosho id it was found to be
+#   items   each tosho id: queued, resolving, waiting (not ready yet),
+#           downloading (with the file list it resolved to), paused, done,
+#           failed (some of its files did), gave-up or cancelled
+#   files   each file: the source being used, which of its pieces are
+#           finished and how big they are, and downloading, finalizing,
+#           done, badsum or failed
+#
+# On startup toshodl.py starts resolvers for the items that aren't done.
+# They use the journaled file list instead of asking the feed again, a title
+# that was already found isn't searched for again, and each file goes back
+# to the source it was using, whose partly downloaded pieces can be resumed
+# (see ResumeState).  Once an item is finished, or has failed, its file list
+# is forgotten and its title will be searched for again, so queueing it
+# another time gets fresh links.
+
+import json
+import time
+import sqlite3
+
+from toshodl import StateDir
+
+class JobJournal(object):
+    finished_item_states = [ 'done', 'gave-up', 'cancelled' ]
+    # Items in these states don't keep the file list they resolved to
+    forget_data_states = finished_item_states + [ 'failed' ]
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.db = None
+
+    def open(self):
+        if self.db is not None:
+            return self.db
+        if self.filename is None:
+            self.filename = StateDir.path('journal.sqlite')
+        self.db = sqlite3.connect(self.filename)
+        # Each change is committed as it's made, so keep that cheap
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS titles (
+                    title       TEXT PRIMARY KEY,
+                    id          TEXT NOT NULL,
+                    updated     REAL NOT NULL
+                )''')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS items (
+                    id          TEXT PRIMARY KEY,
+                    state       TEXT NOT NULL,
+                    data        TEXT,
+                    updated     REAL NOT NULL
+                )''')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    pathname    TEXT PRIMARY KEY,
+                    source      TEXT,
+                    state       TEXT NOT NULL,
+                    pieces      TEXT NOT NULL,
+                    updated     REAL NOT NULL
+                )''')
+        return self.db
+
+    # The id a line of input was found to be, or None.  A title whose item
+    # is finished is searched for again
+    def title_id(self, title):
+        placeholders = ', '.join('?' for s in self.finished_item_states)
+        row = self.open().execute(f'''SELECT titles.id FROM titles LEFT JOIN items ON items.id = titles.id
+                                      WHERE title = ? AND (items.state IS NULL OR items.state NOT IN ({ placeholders }))''',
+                                  (title, *self.finished_item_states)).fetchone()
+        return row[0] if row else None
+
+    def found_title(self, title, id):
+        with self.open() as db:
+            db.execute('INSERT OR REPLACE INTO titles (title, id, updated) VALUES (?, ?, ?)',
+                       (title, str(id), time.time()))
+
+    def set_item_state(self, id, state):
+        with self.open() as db:
+            db.execute('''INSERT INTO items (id, state, updated) VALUES (?, ?, ?)
+                          ON CONFLICT (id) DO UPDATE SET state = excluded.state, updated = excluded.updated''',
+                       (str(id), state, time.time()))
+            if state in self.forget_data_states:
+                db.execute('UPDATE items SET data = NULL WHERE id = ?', (str(id),))
+
+    def item_state(self, id):
+        row = self.open().execute('SELECT state FROM items WHERE id = ?', (str(id),)).fetchone()
+        return row[0] if row else None
+
+    # The item is about to be downloaded as data (from the feed API)
+    def resolved_item(self, id, data):
+        with self.open() as db:
+            db.execute('INSERT OR REPLACE INTO items (id, state, data, updated) VALUES (?, ?, ?, ?)',
+                       (str(id), 'downloading', json.dumps(data), time.time()))
+
+    # The file list an unfinished item was resolved to, or None
+    def item_data(self, id):
+        placeholders = ', '.join('?' for s in self.forget_data_states)
+        row = self.open().execute(f'SELECT data FROM items WHERE id = ? AND state NOT IN ({ placeholders })',
+                                  (str(id), *self.forget_data_states)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    # Forget the file lists these items (or all of them) were resolved to,
+    # so they're asked about again
+    def forget_item_data(self, ids=None):
+        with self.open() as db:
+            if ids is None:
+                db.execute('UPDATE items SET data = NULL')
+            else:
+                db.executemany('UPDATE items SET data = NULL WHERE id = ?', [ (str(id),) for id in ids ])
+
+    # Ids of the items that were started and never finished, oldest first
+    def unfinished_items(self):
+        placeholders = ', '.join('?' for s in self.finished_item_states)
+        return [ row[0] for row in self.open().execute(
+                    f'SELECT id FROM items WHERE state NOT IN ({ placeholders }) ORDER BY updated',
+                    self.finished_item_states) ]
+
+    # { source, state, pieces: { piece number: size } } for a file, or None
+    def file(self, pathname):
+        row = self.open().execute('SELECT source, state, pieces FROM files WHERE pathname = ?', (pathname,)).fetchone()
+        if row is None:
+            return None
+        source, state, pieces = row
+        return { 'source': source, 'state': state, 'pieces': { int(k): v for k, v in json.loads(pieces).items() } }
+
+    # Downloading pathname from source.  Switching sources forgets the
+    # pieces from the old one
+    def start_file(self, pathname, source):
+        previous = self.file(pathname)
+        pieces = previous['pieces'] if previous and previous['source'] == source else { }
+        with self.open() as db:
+            db.execute('INSERT OR REPLACE INTO files (pathname, source, state, pieces, updated) VALUES (?, ?, ?, ?, ?)',
+                       (pathname, source, 'downloading', json.dumps(pieces), time.time()))
+
+    def piece_done(self, pathname, idx, size):
+        f = self.file(pathname)
+        if f is None:
+            return
+        f['pieces'][idx] = size
+        with self.open() as db:
+            db.execute('UPDATE files SET pieces = ?, updated = ? WHERE pathname = ?',
+                       (json.dumps(f['pieces']), time.time(), pathname))
+
+    def set_file_state(self, pathname, state):
+        with self.open() as db:
+            db.execute('''INSERT INTO files (pathname, state, pieces, updated) VALUES (?, ?, '{}', ?)
+                          ON CONFLICT (pathname) DO UPDATE SET state = excluded.state, updated = excluded.updated''',
+                       (pathname, state, time.time()))
+
+journal = JobJournal()
@@ -1,7 +1,4 @@
-from io import BytesIO
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-from playwright.async_api import async_playwright
+import asyncio
 
 from toshodl.DownloadSourceBase import DownloadSourceBase,XTryAnotherSource
 
@@ -12,14 +9,11 @@ class KrakenFilesDownloader(DownloadSourceBase):
         dl_link = await self.get_download_link()
 
         if dl_link:
-            async with self.client.stream('GET', dl_link, timeout=30.0) as response:
-                await self.save_stream_response(response)
+            await self.stream_to_file(dl_link, timeout=30.0)
 
     async def get_download_link(self):
         self.print(f"Attempting DL from { self.url }\n")
-        async with async_playwright() as p:
-            browser = await p.firefox.launch()
-            ctx = await browser.new_context()
+        async with self.browser_pool.context() as ctx:
             page = await ctx.new_page()
 
             # Their ad stuff often redirects to a sponsor page the first
@@ -54,6 +48,5 @@ class KrakenFilesDownloader(DownloadSourceBase):
             download = await download_info.value
             dl_url = download.url
             await download.cancel()
-            await ctx.close()
 
         return dl_url
@@ -0,0 +1,203 @@
+# Counters, gauges and timings for the whole program, so there's more to go
+# on than the progress lines when tuning concurrency or finding a slow host.
+#
+# Everything records into the module's "metrics" object:
+#   metrics.inc('retries_total', source='GoFileDownloader')
+#   metrics.add_bytes('GoFileDownloader', 'store1.gofile.io', len(chunk))
+#   with metrics.timer('transfer', source=...):
+#       ...
+# Gauges that are cheaper to work out when asked (like how many tasks are
+# waiting on the scheduler's semaphores) are registered as functions with
+# gauge_function().
+#
+# They can be read two ways, both started from toshodl.py:
+#   * Prometheus text format from http://127.0.0.1:<port>/metrics, when
+#     TOSHODL_METRICS_PORT is set
+#   * a JSON snapshot rewritten every snapshot_interval seconds, when
+#     TOSHODL_METRICS_FILE is set
+
+import os
+import json
+import time
+import asyncio
+import contextlib
+
+class Metrics(object):
+    prefix = 'toshodl_'
+    # Transfer rates are averaged over this many seconds
+    rate_window = 10
+    snapshot_interval = 15
+
+    help = {
+        'bytes_total':              'Bytes downloaded',
+        'rate_bytes_per_second':    'Download rate over the last rate_window seconds',
+        'phase_seconds':            'Time spent in each phase: search, resolve, link, transfer, join, hash',
+        'retries_total':            'Operations retried after an exception',
+        'try_another_source_total': 'Times a source gave up on a file',
+        'md5_mismatch_total':       'Files whose MD5 did not match',
+        'semaphore_waiters':        'Tasks waiting for a scheduler slot or connection',
+        'pool_connections':         'Connections in the shared pool, idle or active',
+        'pool_connections_created': 'Connections the shared pool has opened',
+        'pool_requests':            'Requests sent through the shared pool',
+        'dns_cache_lookups':        'Host lookups answered from the DNS cache, or not',
+        'breakers_open':            'Hosts whose circuit breaker is open (see RetryPolicy)',
+        'breaker_opened_total':     'Times a host\'s circuit breaker opened',
+        'disk_write_seconds':       'Time taken by each block written to disk',
+        'disk_write_bytes_total':   'Bytes written to disk',
+        'disk_fsync_seconds':       'Time taken by each fsync',
+    }
+
+    def __init__(self):
+        self.counters = { }
+        self.gauges = { }
+        self.timings = { }      # (name, labels) => [ count, sum ]
+        self.rates = { }        # labels => { second: bytes }
+        self.gauge_functions = { }
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        timing = self.timings.setdefault(key, [ 0, 0.0 ])
+        timing[0] += 1
+        timing[1] += seconds
+
+    # Time the with block as one of phase_seconds
+    @contextlib.contextmanager
+    def timer(self, phase, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.monotonic() - start, phase=phase, **labels)
+
+    def add_bytes(self, source, host, n):
+        self.inc('bytes_total', n, source=source, host=host)
+        buckets = self.rates.setdefault(label_key({ 'source': source, 'host': host }), { })
+        second = int(time.monotonic())
+        buckets[second] = buckets.get(second, 0) + n
+        if len(buckets) > self.rate_window + 1:
+            for s in [ s for s in buckets if s <= second - self.rate_window ]:
+                del buckets[s]
+
+    # fn returns a list of (labels dict, value) when the gauge is read
+    def gauge_function(self, name, fn):
+        self.gauge_functions.setdefault(name, [ ]).append(fn)
+
+    def current_gauges(self):
+        gauges = dict(self.gauges)
+        now = int(time.monotonic())
+        for labels, buckets in self.rates.items():
+            total = sum(n for s, n in buckets.items() if now - self.rate_window <= s < now)
+            gauges[('rate_bytes_per_second', labels)] = total / self.rate_window
+        for name, fns in self.gauge_functions.items():
+            for fn in fns:
+                for labels, value in fn():
+                    gauges[(name, label_key(labels))] = value
+        return gauges
+
+    def snapshot(self):
+        def entries(d):
+            return [ { 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in sorted(d.items()) ]
+        return {
+            'time':     time.time(),
+            'counters': entries(self.counters),
+            'gauges':   entries(self.current_gauges()),
+            'timings':  [ { 'name': name, 'labels': dict(labels), 'count': count, 'sum': total }
+                          for (name, labels), (count, total) in sorted(self.timings.items()) ],
+        }
+
+    def prometheus(self):
+        lines = [ ]
+        def family(items, kind):
+            seen = set()
+            for (name, labels), value in sorted(items):
+                full = self.prefix + name
+                if full not in seen:
+                    seen.add(full)
+                    if name in self.help:
+                        lines.append(f'# HELP { full } { self.help[name] }')
+                    lines.append(f'# TYPE { full } { kind }')
+                yield full, labels, value
+
+        for full, labels, value in family(self.counters.items(), 'counter'):
+            lines.append(f'{ full }{ label_text(labels) } { value }')
+        for full, labels, value in family(self.current_gauges().items(), 'gauge'):
+            lines.append(f'{ full }{ label_text(labels) } { value }')
+        for full, labels, (count, total) in family(self.timings.items(), 'summary'):
+            lines.append(f'{ full }_count{ label_text(labels) } { count }')
+            lines.append(f'{ full }_sum{ label_text(labels) } { total }')
+        return '\n'.join(lines) + '\n'
+
+    # Answer GET /metrics on 127.0.0.1:port
+    async def serve(self, port, host='127.0.0.1'):
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass    # skip the headers
+                parts = request.decode('latin-1').split()
+                if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                    status, body = '200 OK', self.prometheus().encode()
+                else:
+                    status, body = '404 Not Found', b'Not found\n'
+                writer.write(f'HTTP/1.1 { status }\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             f'Content-Length: { len(body) }\r\nConnection: close\r\n\r\n'.encode() + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    # Rewrite filename with a snapshot every snapshot_interval seconds, until
+    # cancelled
+    async def write_snapshots(self, filename):
+        try:
+            while True:
+                await asyncio.sleep(self.snapshot_interval)
+                self.write_snapshot(filename)
+        finally:
+            self.write_snapshot(filename)
+
+    def write_snapshot(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.snapshot(), fh, indent=1)
+        os.replace(tmp, filename)
+
+    # Start whichever exporters the environment asks for.  Call it with the
+    # event loop running; returns the tasks/servers to shut down at the end
+    async def start_exporters(self):
+        running = [ ]
+        port = os.environ.get('TOSHODL_METRICS_PORT')
+        if port:
+            running.append(await self.serve(int(port)))
+        filename = os.environ.get('TOSHODL_METRICS_FILE')
+        if filename:
+            running.append(asyncio.create_task(self.write_snapshots(filename)))
+        return running
+
+    async def stop_exporters(self, running):
+        for r in running:
+            if isinstance(r, asyncio.Task):
+                r.cancel()
+                await asyncio.gather(r, return_exceptions=True)
+            else:
+                r.close()
+                await r.wait_closed()
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escaped = [ (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels ]
+    return '{' + ','.join(f'{ k }="{ v }"' for k, v in escaped) + '}'
+
+metrics = Metrics()
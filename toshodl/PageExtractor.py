@@ -0,0 +1,247 @@
+# Pulls the few things the scraping downloaders need (form inputs, captcha
+# digits, a link) out of a page without building a tree for the whole thing.
+#
+# extract() takes the page's text and a dict of name => selector, and
+# returns name => list of Elements.  The selectors are a small subset of
+# CSS: compound selectors made of a tag, #id, .class and [attr], [attr=v],
+# [attr*=v], [attr^=v], [attr$=v] parts, separated by spaces (descendant).
+# They're matched the way the downloaders used to do it with BeautifulSoup,
+# select_one() on the first part then select() inside that for the rest:
+#   'form[name=F1]'         => [ the first matching form ]
+#   'form[name=F1] input'   => all the inputs inside that form
+#
+# The backend is pluggable:
+#   stream  Python's HTMLParser, keeping only a stack of open tags, and
+#           stopping as soon as every selector is satisfied.  The default
+#   lxml    BeautifulSoup with the lxml parser, if lxml is installed
+#   soup    BeautifulSoup with html.parser, like the downloaders used to
+
+import re
+import logging
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml
+    have_lxml = True
+except ImportError:
+    have_lxml = False
+
+logger = logging.getLogger(__name__)
+
+class PageExtractor(object):
+    backend = 'stream'
+
+    def extract(self, html, queries, backend=None):
+        backend = backend or self.backend
+        if backend == 'lxml' and not have_lxml:
+            logger.warning('The lxml backend needs lxml installed, using stream')
+            backend = 'stream'
+
+        if backend == 'stream':
+            return stream_extract(html, queries)
+        elif backend in ('soup', 'lxml'):
+            return soup_extract(html, queries, 'lxml' if backend == 'lxml' else 'html.parser')
+        raise ValueError(f'Unknown PageExtractor backend { backend }')
+
+# The parts of an element the downloaders care about.  get() and text work
+# like they do on a BeautifulSoup Tag
+class Element(object):
+    def __init__(self, tag, attrs, text=''):
+        self.tag = tag
+        self.attrs = attrs
+        self.text = text
+
+    def get(self, name, default=None):
+        return self.attrs.get(name, default)
+
+    def __eq__(self, other):
+        return (self.tag, self.attrs, self.text) == (other.tag, other.attrs, other.text)
+
+    def __repr__(self):
+        return f'Element({ self.tag !r}, { self.attrs !r}, { self.text !r})'
+
+# { name: value } for a list of input elements
+def form_inputs(elements):
+    return { e.get('name'): e.get('value') for e in elements }
+
+# The captcha on ClickNUpload-style pages is 4 span elements that display
+# numbers.  The HTML has them out of order, but uses "padding-left" styles to
+# display them in the proper order.  Sort them in the right order and
+# return the 4-digit string.
+def padding_ordered_text(elements):
+    def ordering(e):
+        match = re.search(r'padding-left:\s*(\d+)', e.get('style') or '')
+        return int(match[1]) if match else 0
+    return ''.join(e.text for e in sorted(elements, key=ordering))
+
+
+compound_re = re.compile(r'''
+    (?P<tag>[a-zA-Z][\w-]*)
+  | \#(?P<id>[\w-]+)
+  | \.(?P<cls>[\w-]+)
+  | \[ \s* (?P<attr>[\w-]+) \s* (?: (?P<op>[*^$]?=) \s* (?P<val>"[^"]*"|'[^']*'|[^\]\s]+) \s* )? \]
+''', re.VERBOSE)
+
+# One compound selector, like 'span[style*=padding-left]'
+class Compound(object):
+    def __init__(self, text):
+        self.text = text
+        self.tag = None
+        self.tests = [ ]
+        pos = 0
+        while pos < len(text):
+            m = compound_re.match(text, pos)
+            if not m:
+                raise ValueError(f"Can't parse selector { text !r}")
+            if m['tag']:
+                self.tag = m['tag'].lower()
+            elif m['id']:
+                self.tests.append(('id', '=', m['id']))
+            elif m['cls']:
+                self.tests.append(('class', '~=', m['cls']))
+            else:
+                val = m['val']
+                if val and val[0] in '"\'':
+                    val = val[1:-1]
+                self.tests.append((m['attr'].lower(), m['op'], val))
+            pos = m.end()
+
+    def matches(self, tag, attrs):
+        if self.tag and self.tag != tag:
+            return False
+        for name, op, val in self.tests:
+            have = attrs.get(name)
+            if have is None:
+                return False
+            if op is None:
+                continue
+            if op == '=' and have != val:
+                return False
+            if op == '~=' and val not in have.split():
+                return False
+            if op == '*=' and val not in have:
+                return False
+            if op == '^=' and not have.startswith(val):
+                return False
+            if op == '$=' and not have.endswith(val):
+                return False
+        return True
+
+def parse_selector(selector):
+    return [ Compound(part) for part in selector.split() ]
+
+
+def soup_extract(html, queries, features):
+    dom = BeautifulSoup(html, features=features)
+    results = { }
+    for name, selector in queries.items():
+        scope_sel, *rest = selector.split()
+        scope = dom.select_one(scope_sel)
+        if scope is None:
+            found = [ ]
+        elif rest:
+            found = scope.select(' '.join(rest))
+        else:
+            found = [ scope ]
+        results[name] = [ Element(e.name, { k: ' '.join(v) if isinstance(v, list) else v for k, v in e.attrs.items() },
+                                  e.get_text())
+                          for e in found ]
+    return results
+
+
+# Elements that never have an end tag
+void_elements = { 'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                  'link', 'meta', 'param', 'source', 'track', 'wbr' }
+
+class StopParsing(Exception):
+    pass
+
+def stream_extract(html, queries):
+    parser = StreamExtractor(queries)
+    try:
+        parser.feed(html)
+        parser.close()
+    except StopParsing:
+        pass
+    return { q.name: q.found for q in parser.queries }
+
+# Where one selector is up to while the page is being parsed
+class StreamQuery(object):
+    def __init__(self, name, selector):
+        self.name = name
+        self.scope_sel, *self.rest = parse_selector(selector)
+        self.scope_depth = None
+        self.found = [ ]
+        self.done = False
+
+    # Does the element at the top of stack match, given it's inside the scope
+    def rest_matches(self, stack):
+        if not self.rest[-1].matches(*stack[-1][:2]):
+            return False
+        want = len(self.rest) - 2
+        for tag, attrs, el in reversed(stack[self.scope_depth+1:-1]):
+            if want < 0:
+                break
+            if self.rest[want].matches(tag, attrs):
+                want -= 1
+        return want < 0
+
+class StreamExtractor(HTMLParser):
+    def __init__(self, queries):
+        super().__init__(convert_charrefs=True)
+        self.queries = [ StreamQuery(name, sel) for name, sel in queries.items() ]
+        # (tag, attrs, Element or None) for each open tag
+        self.stack = [ ]
+        # Elements collecting text, and the stack depth they're at
+        self.capturing = [ ]
+
+    def handle_starttag(self, tag, attr_list):
+        attrs = { k: (v if v is not None else '') for k, v in attr_list }
+        self.stack.append((tag, attrs, None))
+        depth = len(self.stack) - 1
+
+        for q in self.queries:
+            if q.done:
+                continue
+            if q.scope_depth is None:
+                if q.scope_sel.matches(tag, attrs):
+                    q.scope_depth = depth
+                    if not q.rest:
+                        self.capture(q, tag, attrs, depth)
+            elif q.rest and q.rest_matches(self.stack):
+                self.capture(q, tag, attrs, depth)
+
+        if tag in void_elements:
+            self.close_to(depth)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in void_elements:
+            self.close_to(len(self.stack) - 1)
+
+    def handle_endtag(self, tag):
+        for depth in range(len(self.stack) - 1, -1, -1):
+            if self.stack[depth][0] == tag:
+                self.close_to(depth)
+                return
+
+    def handle_data(self, data):
+        for el, depth in self.capturing:
+            el.text += data
+
+    def capture(self, q, tag, attrs, depth):
+        el = Element(tag, attrs)
+        q.found.append(el)
+        self.capturing.append((el, depth))
+
+    # Close the open tags from depth up
+    def close_to(self, depth):
+        del self.stack[depth:]
+        self.capturing = [ (el, d) for el, d in self.capturing if d < depth ]
+        for q in self.queries:
+            if q.scope_depth is not None and q.scope_depth >= depth:
+                q.done = True
+        if all(q.done for q in self.queries):
+            raise StopParsing()
@@ -0,0 +1,67 @@
+# Where each piece of a split file goes when the pieces are written straight
+# into one working file instead of being downloaded separately and joined.
+#
+# A piece's offset is the total size of the pieces before it, so a piece
+# reports its size as soon as it knows it (from the GoFile API, or the
+# response headers) and then waits until all the earlier pieces have done
+# the same.  A piece gives up its scheduler slots while it waits, so the
+# earlier pieces can't get stuck behind it.
+
+import os
+import asyncio
+
+from toshodl.DownloadSourceBase import XTryAnotherSource
+
+class PieceLayout(object):
+    def __init__(self, filename, sidecars):
+        self.filename = filename
+        self.slots = [ PieceSlot(self, idx, sidecar) for idx, sidecar in enumerate(sidecars) ]
+        self.sizes = [ None for s in sidecars ]
+        self.cond = asyncio.Condition()
+
+    # The slot for piece number idx (0-based)
+    def slot(self, idx):
+        return self.slots[idx]
+
+    # Record the piece's size and return its offset in the file once it's
+    # known.  That part of the file is allocated before returning.
+    async def place(self, idx, size):
+        async with self.cond:
+            if self.sizes[idx] is not None and self.sizes[idx] != size:
+                raise XTryAnotherSource(f'Piece { idx+1 } of { self.filename } was { self.sizes[idx] } bytes, now { size }')
+            self.sizes[idx] = size
+            self.cond.notify_all()
+            await self.cond.wait_for(lambda: None not in self.sizes[:idx])
+
+        offset = sum(self.sizes[:idx])
+        await asyncio.to_thread(allocate_range, self.filename, offset, size)
+        return offset
+
+# What a downloader sees: one piece's place in the layout
+class PieceSlot(object):
+    def __init__(self, layout, idx, sidecar):
+        self.layout = layout
+        self.idx = idx
+        self.sidecar = sidecar
+
+    # True if the earlier pieces' sizes are all known
+    def is_ready(self):
+        return None not in self.layout.sizes[:self.idx]
+
+    async def place(self, size):
+        return await self.layout.place(self.idx, size)
+
+def allocate_range(filename, offset, size):
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, offset, size)
+        except (AttributeError, OSError):
+            if os.fstat(fd).st_size < offset + size:
+                os.ftruncate(fd, offset + size)
+    finally:
+        os.close(fd)
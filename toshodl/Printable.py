@@ -3,10 +3,13 @@
 # The "flush_stdout" decorator will force a stdout flush/drain
 # after the function completes.  It only works on methods of
 # classes that are Printable
+#
+# Printing to the terminal goes around the progress board (see ProgressBoard)
 
 import asyncio
 
 from toshodl import AsyncConsole
+from toshodl.ProgressBoard import board
 
 class Printable(object):
     def __init__(self, *args, **kwargs):
@@ -14,7 +17,7 @@ class Printable(object):
         super().__init__(*args, **kwargs)
 
     def print(self, msg):
-        self.stdout.write(msg.encode())
+        board.write(self.stdout, msg.encode())
 
     def flush_stdout(self):
         return self.stdout.drain()
@@ -0,0 +1,232 @@
+# One place that shows how all the transfers are doing, instead of each
+# transfer printing its own progress lines.
+#
+# Transfers register their TransferProgress with the module's "board" for as
+# long as they're running, and keep counting bytes into it.  The board reads
+# the counts when it draws, so there's nothing to call per chunk.  Pieces of
+# the same file are added together, and files in the same batch are grouped
+# under it.
+#
+# On a terminal the board is a block of lines at the bottom, redrawn every
+# tty_interval seconds:
+#   3 files  4.21 MB/s  1.20 GB of 3.50 GB  ETA 0:09:20
+#     Some Batch  2 files  3.01 MB/s  ...
+#       episode 01.mkv  45.2%  1.50 MB/s  ETA 0:03:10
+# Everything else printed goes through write(), which takes the block away,
+# writes, and puts it back underneath.  When stdout isn't a terminal, the
+# same lines are printed as a summary every summary_interval seconds
+# instead.  TOSHODL_PROGRESS=tty, plain or off picks one regardless.
+#
+# The drawing task also drains stdout, so the buffer can't keep growing
+# when nothing else is flushing it.
+
+import os
+import sys
+import time
+import asyncio
+
+from toshodl import AsyncConsole
+
+class ProgressBoard(object):
+    tty_interval = 1
+    summary_interval = 30
+    # Rates are averaged over this many seconds
+    rate_window = 10
+    # Files stay on the board this long after their last piece stops, in
+    # case another piece is about to start
+    linger = 30
+    # Show at most this many file lines
+    max_lines = 20
+
+    def __init__(self):
+        self.transfers = set()
+        self.files = { }
+        self.task = None
+        self.drawn = b''
+        self.drawn_lines = 0
+        self.at_line_start = True
+        self.mode = os.environ.get('TOSHODL_PROGRESS')
+
+    def is_tty(self):
+        if self.mode:
+            return self.mode == 'tty'
+        return sys.stdout.isatty()
+
+    def track(self, progress):
+        if self.mode == 'off':
+            return
+        self.transfers.add(progress)
+        f = self.files.get(progress.file)
+        if f is None:
+            f = self.files[progress.file] = FileStatus(progress.file, progress.batch, progress.file_size)
+        f.transfers.add(progress)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def untrack(self, progress):
+        if progress not in self.transfers:
+            return
+        self.transfers.discard(progress)
+        f = self.files[progress.file]
+        f.transfers.discard(progress)
+        f.finished_bytes += progress.bytes_dl - progress.offset
+        if not f.transfers:
+            f.idle_since = time.monotonic()
+
+    # Write data to stdout without it getting mixed up with the block
+    def write(self, stdout, data):
+        console = AsyncConsole.stdout()
+        if stdout is not console or console is None:
+            stdout.write(data)
+            return
+        if self.drawn_lines:
+            data = self.erase() + data
+            if data.endswith(b'\n'):
+                # Put the block back under what was written
+                self.at_line_start = True
+                data += self.drawn
+                self.drawn_lines = self.drawn.count(b'\n')
+            else:
+                self.drawn = b''
+                self.drawn_lines = 0
+        console.write(data)
+        if not self.drawn_lines:
+            self.at_line_start = data.endswith(b'\n')
+
+    def erase(self):
+        # Up to the start of the block, then clear to the end of the screen
+        return f'\x1b[{ self.drawn_lines }F\x1b[J'.encode()
+
+    async def run(self):
+        tty = self.is_tty()
+        interval = self.tty_interval if tty else self.summary_interval
+        last_summary = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tty_interval)
+            self.sample()
+            if not self.files:
+                break
+            console = AsyncConsole.stdout()
+            if console is None:
+                continue
+            if tty:
+                self.draw(console)
+            elif time.monotonic() - last_summary >= interval:
+                last_summary = time.monotonic()
+                console.write(''.join(line + '\n' for line in self.lines()).encode())
+            await console.drain()
+        self.clear()
+
+    # Take away the block, if it's showing
+    def clear(self):
+        console = AsyncConsole.stdout()
+        if self.drawn_lines and console is not None:
+            console.write(self.erase())
+        self.drawn = b''
+        self.drawn_lines = 0
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.clear()
+
+    def draw(self, console):
+        text = ''.join(line + '\n' for line in self.lines()).encode()
+        data = self.erase() if self.drawn_lines else b''
+        if not self.at_line_start:
+            # Something left the cursor mid-line, like an input prompt.
+            # Start below it, and only erase back to there
+            data += b'\n'
+            self.at_line_start = True
+        console.write(data + text)
+        self.drawn = text
+        self.drawn_lines = text.count(b'\n')
+
+    # Record how far each file has got, and drop the ones that are done
+    def sample(self):
+        now = time.monotonic()
+        for name, f in list(self.files.items()):
+            if not f.transfers and now - f.idle_since > self.linger:
+                del self.files[name]
+                continue
+            f.samples.append((now, f.bytes()))
+            while len(f.samples) > 2 and now - f.samples[1][0] >= self.rate_window:
+                f.samples.pop(0)
+
+    def lines(self):
+        files = sorted(self.files.values(), key=lambda f: (f.batch or '', f.name))
+        active = [ f for f in files if f.transfers ]
+        lines = [ summary_line(f'{ len(active) } files', active) ]
+
+        shown = 0
+        batch = None
+        for f in files:
+            if shown >= self.max_lines:
+                lines.append(f'    ... and { len(files) - shown } more')
+                break
+            if f.batch and f.batch != batch:
+                batch = f.batch
+                in_batch = [ b for b in files if b.batch == batch ]
+                lines.append('  ' + summary_line(f'{ batch }  { len(in_batch) } files', in_batch))
+            elif not f.batch:
+                batch = None
+            indent, name = ('    ', os.path.basename(f.name)) if f.batch else ('  ', f.name)
+            state = 'waiting' if not f.transfers else rate_text(f.rate())
+            pct = f'  %0.1f%%' % (f.bytes() / f.size * 100) if f.size else ''
+            lines.append(f'{ indent }{ name }{ pct }  { state }{ eta_text(f.remaining(), f.rate()) }')
+            shown += 1
+        return lines
+
+# The transfers for one file and how fast it's been going
+class FileStatus(object):
+    def __init__(self, name, batch, size):
+        self.name = name
+        self.batch = batch
+        self.size = size
+        self.transfers = set()
+        self.finished_bytes = 0
+        self.idle_since = time.monotonic()
+        self.samples = [ ]
+
+    def bytes(self):
+        return self.finished_bytes + sum(t.bytes_dl - t.offset for t in self.transfers)
+
+    def rate(self):
+        if len(self.samples) < 2 or not self.transfers:
+            return 0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / max(t1 - t0, 0.001)
+
+    def remaining(self):
+        if not self.size:
+            return None
+        return max(self.size - self.bytes(), 0)
+
+def summary_line(label, files):
+    rate = sum(f.rate() for f in files)
+    got = sum(f.bytes() for f in files)
+    line = f'{ label }  { rate_text(rate) }  { size_text(got) }'
+    if files and all(f.size for f in files):
+        remaining = sum(f.remaining() for f in files)
+        line += f' of { size_text(sum(f.size for f in files)) }{ eta_text(remaining, rate) }'
+    return line
+
+def size_text(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return f'%0.2f { unit }' % n
+        n /= 1024
+    return f'%0.2f GB' % n
+
+def rate_text(rate):
+    return size_text(rate) + '/s'
+
+def eta_text(remaining, rate):
+    if remaining is None or rate <= 0:
+        return ''
+    seconds = int(remaining / rate)
+    return '  ETA %d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+board = ProgressBoard()
@@ -0,0 +1,126 @@
+# Caps download bandwidth overall and per host with token buckets.
+#
+# Each chunk read from the network reserves its bytes from the buckets that
+# apply to it.  A bucket is allowed to go into debt, and the reader sleeps
+# until the debt would be paid off.  Reservations are served in the order
+# they're made, so active streams share the rate evenly.  Streams that are
+# idle don't reserve anything, so their share goes to the active ones.
+#
+# The limits are read from a JSON file (StateDir's ratelimit.json by
+# default) at startup, and again whenever the process gets a SIGHUP.  Rates
+# are in bytes per second; leave one out or set it to 0 for no limit:
+#   {
+#       "global": 10000000,
+#       "hosts": { "buzzheavier.com": 2000000 },
+#       "windows": [ { "start": "08:00", "end": "23:00", "rate": 3000000 } ]
+#   }
+# A "windows" entry replaces the global rate between those local times of
+# day.  Windows can wrap past midnight.
+
+import json
+import time
+import signal
+import asyncio
+
+from toshodl import StateDir
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        self.rate = rate
+        # Enough for a quarter second of data by default
+        self.burst = burst if burst else max(rate / 4, 65536)
+        self.tokens = min(self.tokens, self.burst)
+
+    # Take n bytes and return how many seconds to wait before using them
+    def reserve(self, n):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class RateLimiter(object):
+    # How often to check whether we've moved into or out of a window
+    window_check_interval = 30
+
+    def __init__(self, config_file=None):
+        self.config_file = config_file
+        self.global_rate = 0
+        self.host_rates = { }
+        self.windows = [ ]
+        self.global_bucket = None
+        self.host_buckets = { }
+        self.next_window_check = 0
+        self.load()
+
+    def load(self):
+        if self.config_file is None:
+            # This runs on import, so don't make the directory
+            self.config_file = StateDir.path('ratelimit.json', create=False)
+        try:
+            with open(self.config_file, 'r') as fh:
+                config = json.load(fh)
+        except FileNotFoundError:
+            config = { }
+        self.set_limits(**config)
+
+    def set_limits(self, hosts=None, windows=None, **kwargs):
+        self.global_rate = kwargs.get('global') or 0
+        self.host_rates = hosts or { }
+        self.windows = [ (parse_time(w['start']), parse_time(w['end']), w['rate']) for w in (windows or [ ]) ]
+        self.host_buckets = { }
+        self.next_window_check = 0
+        self.apply_global_rate(self.current_global_rate())
+
+    # Reload the config file when we get a SIGHUP.  Call it with the event
+    # loop running
+    def watch_signal(self):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.load)
+        except (NotImplementedError, AttributeError):
+            pass    # No SIGHUP on this platform
+
+    def current_global_rate(self):
+        if self.windows:
+            now = time.localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+            for start, end, rate in self.windows:
+                if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                    return rate
+        return self.global_rate
+
+    def apply_global_rate(self, rate):
+        if not rate:
+            self.global_bucket = None
+        elif self.global_bucket is None:
+            self.global_bucket = TokenBucket(rate)
+        elif self.global_bucket.rate != rate:
+            self.global_bucket.set_rate(rate)
+
+    # Wait until it's OK to use n more bytes from host
+    async def throttle(self, host, n):
+        if self.windows:
+            now = time.monotonic()
+            if now >= self.next_window_check:
+                self.next_window_check = now + self.window_check_interval
+                self.apply_global_rate(self.current_global_rate())
+
+        delay = 0
+        if self.global_bucket is not None:
+            delay = self.global_bucket.reserve(n)
+        if host in self.host_rates and self.host_rates[host]:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self.host_rates[host])
+            delay = max(delay, self.host_buckets[host].reserve(n))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# 'HH:MM' to minutes after midnight
+def parse_time(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
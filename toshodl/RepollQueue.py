@@ -0,0 +1,126 @@
+# Keeps tosho ids that aren't ready to download yet (still uploading, or
+# some files don't have links yet) and checks on them again later, backing
+# off exponentially.  Once one is ready, its resolver is run again and the
+# downloads start.
+#
+# Checks are done in rounds: whatever's due, up to batch_size of them, a
+# few seconds apart so the feed API isn't hit all at once.  An id that
+# still isn't ready after give_up_after seconds is dropped.
+#
+# watch() asks to hear about an id: the callback gets the task running its
+# resolver when it's started, or None if the id is dropped instead.
+
+import time
+import asyncio
+
+from toshodl.JobJournal import journal
+
+class RepollQueue(object):
+    first_delay = 60
+    max_delay = 30 * 60
+    backoff = 2
+    give_up_after = 24 * 60 * 60
+    batch_size = 10
+    # Seconds between checks in the same round
+    request_spacing = 2
+
+    def __init__(self):
+        self.pending = { }
+        self.watchers = { }
+        self.task = None
+        self.wakeup = None
+
+    # Check on this resolver's id later.  The resolver is what does the
+    # checking, and gets run again when it's ready
+    def add(self, resolver):
+        id = str(resolver.id)
+        if id not in self.pending:
+            self.pending[id] = RepollEntry(resolver, self.first_delay)
+
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        else:
+            self.wakeup.set()
+
+    # Stop checking on id
+    def remove(self, id):
+        self.pending.pop(str(id), None)
+        self.notify(str(id), None)
+
+    def watch(self, id, callback):
+        self.watchers[str(id)] = callback
+
+    def notify(self, id, task):
+        callback = self.watchers.pop(id, None)
+        if callback is not None:
+            callback(task)
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Wait until nothing is left to check on, and the downloads for the ones
+    # that became ready are done
+    async def join(self):
+        while self.task is not None and not self.task.done():
+            await self.task
+
+    async def run(self):
+        async with asyncio.TaskGroup() as tg:
+            while self.pending:
+                now = time.monotonic()
+                entries = sorted(self.pending.values(), key=lambda e: e.due)
+                if entries[0].due > now:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=entries[0].due - now)
+                    except TimeoutError:
+                        pass
+                    continue
+
+                batch = [ e for e in entries if e.due <= now ][:self.batch_size]
+                for i, entry in enumerate(batch):
+                    if i > 0:
+                        await asyncio.sleep(self.request_spacing)
+                    await self.check(entry, tg)
+
+    # The id can be remove()d while this is waiting on the feed (or while
+    # the round is waiting to get to it), and then it's left alone
+    async def check(self, entry, tg):
+        resolver = entry.resolver
+        id = str(resolver.id)
+        if self.pending.get(id) is not entry:
+            return
+        try:
+            data = await resolver.fetch_tosho()
+        except Exception as e:
+            resolver.print(f'*** Checking on id { id } failed: { type(e).__name__ } { e }\n')
+            data = None
+        if self.pending.get(id) is not entry:
+            return
+
+        if data is not None:
+            resolver.cache.put(resolver.id, data)
+            if resolver.is_ready(data):
+                resolver.print(f'Id { id } is ready now\n')
+                self.pending.pop(id, None)
+                self.notify(id, tg.create_task(resolver.run()))
+                return
+
+        if time.monotonic() - entry.since > self.give_up_after:
+            resolver.print(f'*** Giving up on id { id }, it still isn\'t ready\n')
+            journal.set_item_state(id, 'gave-up')
+            self.pending.pop(id, None)
+            self.notify(id, None)
+            return
+
+        entry.delay = min(entry.delay * self.backoff, self.max_delay)
+        entry.due = time.monotonic() + entry.delay
+        resolver.print(f'Id { id } still isn\'t ready: { data.get("status") if data else "no response" }, next check in { entry.delay } seconds\n')
+
+class RepollEntry(object):
+    def __init__(self, resolver, delay):
+        self.resolver = resolver
+        self.since = time.monotonic()
+        self.delay = delay
+        self.due = self.since + delay
@@ -0,0 +1,218 @@
+# Tracks how much of a working file has been saved so an interrupted
+# download can pick up where it left off.
+#
+# The state lives in a small JSON sidecar next to the working file
+# (filename.resume).  Besides the byte count, it records the validators the
+# server gave us (ETag, Last-Modified and the full Content-Length) so we can
+# tell if the file on the other end changed between attempts.  If it did,
+# the partial data is thrown away and we start over.
+#
+# A file fetched as several byte ranges at once ("segments") is preallocated
+# to its full size and the sidecar records how far each segment got, as a
+# list of { start, end, pos } dicts with 'end' exclusive.
+#
+# When a piece is written into part of a file shared with other pieces, the
+# sidecar is named after the piece, and offsets are relative to where the
+# piece starts.  The shared file is never truncated.
+
+import os
+import re
+import json
+
+class ResumeState(object):
+    def __init__(self, filename, sidecar=None):
+        self.filename = filename
+        self.shared = sidecar is not None
+        self.sidecar = sidecar if self.shared else filename + '.resume'
+        self.clear()
+
+    def clear(self):
+        self.bytes = 0
+        self.etag = None
+        self.last_modified = None
+        self.content_length = None
+        self.complete = False
+        self.segments = None
+
+    def load(self):
+        try:
+            with open(self.sidecar, 'r') as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.clear()
+            return
+
+        self.bytes          = data.get('bytes', 0)
+        self.etag           = data.get('etag')
+        self.last_modified  = data.get('last_modified')
+        self.content_length = data.get('content_length')
+        self.complete       = data.get('complete', False)
+        self.segments       = data.get('segments')
+
+    def save(self):
+        data = {
+            'bytes':            self.bytes,
+            'etag':             self.etag,
+            'last_modified':    self.last_modified,
+            'content_length':   self.content_length,
+            'complete':         self.complete,
+            'segments':         self.segments,
+        }
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(tmp, self.sidecar)
+
+    def remove(self):
+        self.clear()
+        try:
+            os.unlink(self.sidecar)
+        except FileNotFoundError:
+            pass
+
+    # True if a previous attempt saved the whole file.  It may have died
+    # after the last byte but before saying it was complete
+    def is_complete(self):
+        if self.content_length is None:
+            return False
+        if not self.complete and self.contiguous_bytes() != self.content_length:
+            return False
+        if self.shared:
+            return os.path.exists(self.filename)
+        try:
+            return os.path.getsize(self.filename) == self.content_length
+        except FileNotFoundError:
+            return False
+
+    # True if the working file is there at its full size, as it is when
+    # it's being fetched in segments
+    def is_preallocated(self):
+        if self.shared:
+            return os.path.exists(self.filename)
+        try:
+            return os.path.getsize(self.filename) == self.content_length
+        except FileNotFoundError:
+            return False
+
+    # Headers to add to the GET request.  If we have some of the file already,
+    # ask for the rest of it.  The sidecar is only updated after the data has
+    # been written, so it's the trustworthy count; anything on disk past that
+    # is discarded.
+    def request_headers(self):
+        if self.shared:
+            if not os.path.exists(self.filename):
+                self.bytes = 0
+            return self.range_headers(self.bytes) if self.bytes else { }
+
+        try:
+            size = os.path.getsize(self.filename)
+        except FileNotFoundError:
+            size = 0
+
+        self.bytes = min(self.bytes, size)
+        if size > self.bytes:
+            os.truncate(self.filename, self.bytes)
+        if self.bytes == 0:
+            return { }
+        return self.range_headers(self.bytes)
+
+    # Headers asking for bytes start through end-1, or start through the end
+    # of the file if end is None
+    def range_headers(self, start, end=None):
+        headers = { 'Range': f'bytes={ start }-{ end - 1 if end else "" }' }
+        # If-Range makes the server send the whole file instead of a 206 if
+        # it changed.  Weak ETags aren't allowed there.
+        if self.etag and not self.etag.startswith('W/'):
+            headers['If-Range'] = self.etag
+        elif self.last_modified:
+            headers['If-Range'] = self.last_modified
+        return headers
+
+    # Look at the response to our (maybe ranged) request and return the
+    # offset to start writing at, or None if the server sent back a range
+    # that doesn't line up with what we have
+    def start_offset(self, response):
+        if response.status_code == 206 and self.bytes > 0:
+            if not self.range_matches(response, self.bytes):
+                return None
+            return self.bytes
+
+        # A plain 200 means the server ignored the Range (or we didn't send
+        # one), so we're starting from the beginning
+        self.clear()
+        self.remember_validators(response)
+        return 0
+
+    # True if the server turned down our Range because we already have the
+    # whole file: a 416 with Content-Range "bytes */N", N being what we have
+    def range_finished(self, response):
+        if response.status_code != 416 or not self.bytes:
+            return False
+        match = re.match(r'bytes\s+\*/(\d+)', response.headers.get('Content-Range', ''))
+        return bool(match) and int(match[1]) == self.bytes == self.content_length
+
+    # Start over, fetching the file as 'count' segments
+    def split(self, response, count):
+        self.clear()
+        self.remember_validators(response)
+        size = -(-self.content_length // count)
+        self.segments = [ { 'start': s, 'end': min(s + size, self.content_length), 'pos': s }
+                          for s in range(0, self.content_length, size) ]
+
+    # Go back to a single stream.  Everything up to the first unfinished
+    # segment is good; the rest of the preallocated file gets truncated away
+    # by request_headers()
+    def unsplit(self):
+        self.bytes = self.contiguous_bytes()
+        self.segments = None
+
+    # How much of the file, from the start, has been saved
+    def contiguous_bytes(self):
+        if not self.segments:
+            return self.bytes
+        for seg in self.segments:
+            if seg['pos'] < seg['end']:
+                return seg['pos']
+        return self.segments[-1]['end']
+
+    # How much of the file has been saved, in whatever order
+    def saved_bytes(self):
+        if self.complete and self.content_length is not None:
+            return self.content_length
+        if self.segments:
+            return sum(seg['pos'] - seg['start'] for seg in self.segments)
+        return self.bytes
+
+    def remember_validators(self, response):
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.content_length = total_length(response)
+
+    # True if a 206 response starts at the given offset and is for the same
+    # file we started with
+    def range_matches(self, response, start):
+        match = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', response.headers.get('Content-Range', ''))
+        if not match or int(match[1]) != start:
+            return False
+        if match[3] != '*' and int(match[3]) != self.content_length:
+            return False
+        return self.validators_match(response)
+
+    def validators_match(self, response):
+        etag = response.headers.get('ETag')
+        if self.etag and etag and etag != self.etag:
+            return False
+        last_modified = response.headers.get('Last-Modified')
+        if self.last_modified and last_modified and last_modified != self.last_modified:
+            return False
+        return True
+
+
+# The size of the whole file a response is for, or None if we can't tell
+def total_length(response):
+    if response.status_code == 206:
+        match = re.match(r'bytes\s+\d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+        return int(match[1]) if match else None
+    if 'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    return None
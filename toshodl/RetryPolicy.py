@@ -0,0 +1,205 @@
+# Decides how long to wait before trying something again, and when to stop
+# trying a host altogether.  HttpClient.exception_retry asks it.
+#
+# Delays back off exponentially, base_delay * multiplier ** attempt up to
+# max_delay, with the top jitter fraction of that picked at random so
+# everything that failed at once doesn't come back at once.  A 429 or 503
+# (XThrottled) waits as long as its Retry-After says, if it says.
+#
+# Settings come from, in order of precedence:
+#   hosts[host][error class]    e.g. hosts['gofile.io']['throttled']
+#   hosts[host]                 for any error from that host
+#   error_classes[error class]
+#   the class attributes
+# where the error class is one of connect, timeout, throttled, server,
+# network or other (see error_class()).
+#
+# Each source host also has a circuit breaker, fed by the attempts at
+# downloading pieces from it.  After breaker_failures failures in a row it
+# opens, and allow() turns away new pieces for the host for breaker_cooldown
+# seconds.  Then one try is let through every cooldown; if that fails too
+# the cooldown doubles, up to breaker_max_cooldown, and the first success
+# closes it again.  breaker_failures None means never.
+
+import time
+import email.utils
+import random
+
+import httpx
+
+from toshodl.Metrics import metrics
+
+# Raised for a 429 or 503 response, so it can be retried after its
+# Retry-After
+class XThrottled(Exception):
+    def __init__(self, response):
+        self.response = response
+        self.host = response.url.host
+        self.retry_after = retry_after(response)
+        super().__init__(f'{ response.status_code } from { self.host }')
+
+throttle_statuses = (429, 503)
+
+# The host an exception came from, if it knows
+def error_host(e):
+    if isinstance(e, XThrottled):
+        return e.host
+    try:
+        return e.request.url.host
+    except (AttributeError, RuntimeError):
+        return None
+
+# Seconds a response's Retry-After header asks for, or None
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0)
+
+class RetryPolicy(object):
+    tries = 5
+    base_delay = 1
+    multiplier = 2
+    max_delay = 60
+    jitter = 0.5
+    # Don't wait longer than this, whatever Retry-After says
+    max_retry_after = 600
+
+    breaker_failures = 5
+    breaker_cooldown = 30
+    breaker_max_cooldown = 600
+
+    error_classes = {
+        'connect':      { 'base_delay': 2 },
+        'timeout':      { 'base_delay': 2 },
+        'throttled':    { 'tries': 8, 'base_delay': 5, 'max_delay': 300 },
+        'server':       { 'base_delay': 3 },
+    }
+    hosts = {
+        # A search shouldn't hang around long
+        'feed.animetosho.org':  { 'tries': 3 },
+    }
+
+    def __init__(self):
+        self.breakers = { }
+        metrics.gauge_function('breakers_open', self.open_breakers)
+
+    def setting(self, name, host=None, error_class=None):
+        host_settings = self.hosts.get(host, { })
+        for settings in (host_settings.get(error_class, { }), host_settings,
+                         self.error_classes.get(error_class, { })):
+            if name in settings:
+                return settings[name]
+        return getattr(self, name)
+
+    def error_class(self, e):
+        if isinstance(e, XThrottled):
+            return 'throttled'
+        if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+            return 'connect'
+        if isinstance(e, httpx.TimeoutException):
+            return 'timeout'
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500:
+            return 'server'
+        if isinstance(e, httpx.TransportError):
+            return 'network'
+        return 'other'
+
+    def tries_for(self, e, host=None):
+        return self.setting('tries', host, self.error_class(e))
+
+    # Seconds to wait after e, on the attempt'th try (from 0)
+    def delay(self, e, attempt, host=None):
+        error_class = self.error_class(e)
+        if getattr(e, 'retry_after', None) is not None:
+            return min(e.retry_after, self.setting('max_retry_after', host, error_class))
+        delay = min(self.setting('base_delay', host, error_class)
+                    * self.setting('multiplier', host, error_class) ** attempt,
+                    self.setting('max_delay', host, error_class))
+        jitter = self.setting('jitter', host, error_class)
+        return delay * (1 - jitter * random.random())
+
+    def breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = Breaker()
+        return breaker
+
+    # False if the host's breaker is open and it's not time for another try
+    def allow(self, host):
+        if host is None or self.setting('breaker_failures', host) is None:
+            return True
+        return self.breaker(host).allow()
+
+    def record_success(self, host):
+        if host in self.breakers:
+            self.breakers[host].close()
+
+    # Returns true if that opened the host's breaker
+    def record_failure(self, host):
+        threshold = self.setting('breaker_failures', host)
+        if host is None or threshold is None:
+            return False
+        breaker = self.breaker(host)
+        if not breaker.failed(threshold, self.setting('breaker_cooldown', host),
+                              self.setting('breaker_max_cooldown', host)):
+            return False
+        metrics.inc('breaker_opened_total', host=host)
+        return True
+
+    def is_open(self, host):
+        return host in self.breakers and self.breakers[host].opened is not None
+
+    # For the metrics: 1 for each host whose breaker is open
+    def open_breakers(self):
+        return [ ({ 'host': host }, 1) for host, breaker in self.breakers.items() if breaker.opened is not None ]
+
+class Breaker(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.cooldown = None
+        self.next_try = None
+        self.trying = False
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        now = time.monotonic()
+        if now < self.next_try:
+            return False
+        # Let this one through, and the next after another cooldown
+        self.next_try = now + self.cooldown
+        self.trying = True
+        return True
+
+    def close(self):
+        self.failures = 0
+        self.opened = None
+        self.cooldown = None
+        self.trying = False
+
+    def failed(self, threshold, cooldown, max_cooldown):
+        self.failures += 1
+        now = time.monotonic()
+        if self.opened is not None:
+            if self.trying:
+                # The try after the cooldown failed too
+                self.trying = False
+                self.cooldown = min(self.cooldown * 2, max_cooldown)
+                self.next_try = now + self.cooldown
+            return False
+        if self.failures < threshold:
+            return False
+        self.opened = now
+        self.cooldown = cooldown
+        self.next_try = now + cooldown
+        return True
@@ -0,0 +1,115 @@
+# Decides how many pieces can be doing what at the same time.
+#
+# There are two kinds of slots.  A "resolution" slot is held while a
+# downloader works out the direct download link (API calls, scraping landing
+# pages, captcha countdowns).  A "transfer" slot is held only while the file
+# data is actually being fetched, so a piece doesn't take one until its link
+# is ready.
+#
+# Each kind is limited per host, per download source class (the class's
+# transfer_limit and resolve_limit) and overall.  Transfers are also limited
+# per account token for sources that use one.  A slot is a set of
+# semaphores, always acquired most-specific first, so one busy or
+# serialized host only ties up its own slots.
+
+import httpx
+import asyncio
+import contextlib
+
+from toshodl.Metrics import metrics
+
+class Scheduler(object):
+    max_transfers = 5
+    max_resolutions = 10
+    transfers_per_host = 3
+    resolutions_per_host = 4
+    transfers_per_token = 3
+
+    # hostname => limit, overriding the per-host defaults above
+    host_transfer_limits = { }
+    host_resolution_limits = { }
+
+    def __init__(self):
+        self.sems = { }
+        metrics.gauge_function('semaphore_waiters', self.waiters)
+
+    # For the metrics: how many tasks are waiting on each semaphore
+    def waiters(self):
+        gauges = [ ]
+        for key, sem in self.sems.items():
+            kind, name = key if isinstance(key, tuple) else (key, '')
+            gauges.append(({ 'kind': kind, 'key': name }, waiting(sem)))
+        return gauges
+
+    def sem(self, key, limit):
+        if key not in self.sems:
+            self.sems[key] = asyncio.Semaphore(limit)
+        return self.sems[key]
+
+    # A slot for dl (a DownloadSourceBase) to work out the download link
+    # from url
+    def resolution(self, dl, url):
+        host = httpx.URL(url).host
+        sems = [ self.sem(('resolve-host', host), self.host_resolution_limits.get(host, self.resolutions_per_host)) ]
+        if dl.resolve_limit:
+            sems.append(self.sem(('resolve-source', type(dl).__name__), dl.resolve_limit))
+        sems.append(self.sem('resolve', self.max_resolutions))
+        return Slot(sems)
+
+    # A slot for dl to download the file at url, optionally using an account
+    # token
+    def transfer(self, dl, url, token=None):
+        host = httpx.URL(url).host
+        sems = [ self.sem(('transfer-host', host), self.host_transfer_limits.get(host, self.transfers_per_host)) ]
+        if dl.transfer_limit:
+            sems.append(self.sem(('transfer-source', type(dl).__name__), dl.transfer_limit))
+        if token:
+            sems.append(self.sem(('transfer-token', token), self.transfers_per_token))
+        sems.append(self.sem('transfer', self.max_transfers))
+        return Slot(sems)
+
+# Holds a set of semaphores together.  It can be released early, and
+# releasing it more than once is harmless
+class Slot(object):
+    def __init__(self, sems):
+        self.sems = sems
+        self.held = False
+
+    async def acquire(self):
+        acquired = [ ]
+        try:
+            for sem in self.sems:
+                await sem.acquire()
+                acquired.append(sem)
+        except BaseException:
+            for sem in reversed(acquired):
+                sem.release()
+            raise
+        self.held = True
+
+    def release(self):
+        if self.held:
+            for sem in reversed(self.sems):
+                sem.release()
+            self.held = False
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.release()
+
+    # Let someone else have the slot while we wait on something
+    @contextlib.asynccontextmanager
+    async def suspended(self):
+        held = self.held
+        self.release()
+        try:
+            yield
+        finally:
+            if held:
+                await self.acquire()
+
+def waiting(sem):
+    return len(getattr(sem, '_waiters', None) or ())
@@ -0,0 +1,113 @@
+# Turns lines of input into ToshoResolver tasks without waiting for each
+# search to finish before reading the next line.
+#
+# Lines go into a bounded queue, and up to "concurrency" workers search for
+# them at once.  As soon as a search comes up with an id, that id's resolver
+# is started.  The same title showing up again, or two titles finding the
+# same id, only starts one resolver.
+#
+# Each search prints into its own Transcript instead of straight to the
+# terminal.  Transcripts are written out in the order the lines were read,
+# so the "is id" lines and ambiguous match lists come out the same way no
+# matter which search finished first.
+#
+# Titles and ids are recorded in the JobJournal, so a title found in an
+# earlier run isn't searched for again.
+
+import os
+import asyncio
+
+from toshodl.Printable import Printable
+from toshodl.ToshoResolver import ToshoResolver
+from toshodl.Metrics import metrics
+from toshodl.JobJournal import journal
+
+class SearchPipeline(Printable):
+    # How many searches to run at once
+    concurrency = int(os.environ.get('TOSHODL_SEARCHES', 4))
+    # How many lines can be read ahead of the searches
+    queue_size = 64
+
+    def __init__(self, tosho, tg, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tosho = tosho
+        self.tg = tg
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.seen_titles = set()
+        self.started_ids = set()
+        self.transcripts = { }
+        self.next_seq = 0
+        self.line_count = 0
+        self.workers = [ tg.create_task(self.worker()) for i in range(self.concurrency) ]
+
+    # Queue up one line of input.  Waits if the queue is full
+    async def add(self, title):
+        if title in self.seen_titles:
+            return
+        self.seen_titles.add(title)
+        await self.queue.put((self.line_count, title))
+        self.line_count += 1
+
+    # No more input.  Waits for the searches to finish; the resolvers they
+    # started keep going in the task group
+    async def close(self):
+        for w in self.workers:
+            await self.queue.put(None)
+        await asyncio.gather(*self.workers)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                return
+            seq, title = job
+
+            transcript = Transcript()
+            id = journal.title_id(title)
+            if id is not None:
+                transcript.write(f'{ title } is id { id } (from the journal)\n'.encode())
+                self.start_resolver(id)
+            else:
+                try:
+                    with metrics.timer('search'):
+                        id = await self.tosho.sharing(transcript).search(title)
+                except Exception as e:
+                    transcript.write(f'*** Searching for { title } failed: { type(e).__name__ } { e }\n'.encode())
+                    id = None
+
+                if id is not None:
+                    transcript.write(f'{ title } is id { id }\n'.encode())
+                    journal.found_title(title, id)
+                    self.start_resolver(id)
+
+            self.transcripts[seq] = transcript
+            await self.write_transcripts()
+
+    def start_resolver(self, id):
+        id = str(id)
+        if id in self.started_ids:
+            return
+        self.started_ids.add(id)
+        journal.set_item_state(id, 'queued')
+        self.tg.create_task(ToshoResolver(id).run())
+
+    # Write out all the finished transcripts that are next in line
+    async def write_transcripts(self):
+        while self.next_seq in self.transcripts:
+            self.print(self.transcripts.pop(self.next_seq).text())
+            self.next_seq += 1
+        await self.flush_stdout()
+
+# Stands in for stdout to collect what a search printed
+class Transcript(object):
+    def __init__(self):
+        self.chunks = [ ]
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    async def drain(self):
+        pass
+
+    def text(self):
+        return b''.join(self.chunks).decode()
@@ -0,0 +1,107 @@
+# Keeps track of how well each download source has been doing, and decides
+# which order to try them in.
+#
+# For each source class it keeps moving averages of throughput, time to first
+# byte and failure rate, saved in the state directory so they carry over
+# between runs.  Sources are tried in order of expected time to finish a
+# file: time to first byte plus size / throughput, scaled up by the chance
+# of having to give up and try another source.
+#
+# Scores go stale.  A source with no recent numbers is tried first so it
+# gets new ones, and now and then a random other source is moved to the
+# front so a bad score doesn't stick forever.
+
+import os
+import json
+import time
+import random
+
+from toshodl import StateDir
+
+class SourceRanker(object):
+    # Weight of a new sample in the moving averages
+    alpha = 0.3
+    # Numbers older than this (in seconds) don't count
+    stale_after = 24 * 60 * 60
+    # How often to shuffle a random source to the front
+    explore_rate = 0.1
+    # Used for ranking when we don't know how big the file is
+    default_size = 500 * 1048576
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.stats = None
+
+    def load(self):
+        if self.stats is not None:
+            return
+        if self.filename is None:
+            self.filename = StateDir.path('source-stats.json')
+        try:
+            with open(self.filename, 'r') as fh:
+                self.stats = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.stats = { }
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.stats, fh, indent=1)
+        os.replace(tmp, self.filename)
+
+    def source_stats(self, source):
+        self.load()
+        if source not in self.stats:
+            self.stats[source] = { 'rate': None, 'ttfb': None, 'failure': 0.0, 'updated': 0 }
+        return self.stats[source]
+
+    def average(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    # bytes per second seen during a transfer
+    def record_rate(self, source, rate):
+        s = self.source_stats(source)
+        s['rate'] = self.average(s['rate'], rate)
+        s['updated'] = time.time()
+
+    # seconds between sending a download request and getting the headers back
+    def record_ttfb(self, source, seconds):
+        s = self.source_stats(source)
+        s['ttfb'] = self.average(s['ttfb'], seconds)
+
+    def record_success(self, source):
+        s = self.source_stats(source)
+        s['failure'] = self.average(s['failure'], 0.0)
+        s['updated'] = time.time()
+        self.save()
+
+    def record_failure(self, source):
+        s = self.source_stats(source)
+        s['failure'] = self.average(s['failure'], 1.0)
+        s['updated'] = time.time()
+        self.save()
+
+    # Estimated seconds to download size bytes from source, or None if we
+    # don't have recent enough numbers
+    def expected_time(self, source, size):
+        s = self.source_stats(source)
+        if not s['rate'] or time.time() - s['updated'] > self.stale_after:
+            return None
+        seconds = (s['ttfb'] or 0) + size / s['rate']
+        return seconds / max(1 - s['failure'], 0.05)
+
+    # sources is a dict of name => source class; return the names in the
+    # order to try them
+    def rank(self, sources, size=None):
+        size = size or self.default_size
+        names = list(sources.keys())
+        random.shuffle(names)   # breaks ties randomly
+
+        def key(name):
+            t = self.expected_time(sources[name].__name__, size)
+            return (0, 0) if t is None else (1, t)
+        names.sort(key=key)
+
+        if len(names) > 1 and random.random() < self.explore_rate:
+            names.insert(0, names.pop(random.randrange(1, len(names))))
+        return names
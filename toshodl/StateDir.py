@@ -0,0 +1,14 @@
+# Where to keep files that should outlast one run of the program: caches,
+# indexes, stats.  It's a directory under the current one, next to working/,
+# unless TOSHODL_STATE_DIR says otherwise.
+
+import os
+
+state_dir = os.environ.get('TOSHODL_STATE_DIR', '.toshodl')
+
+# Where the file called name goes.  Pass create=False when only reading it,
+# so the directory isn't made for nothing
+def path(name, create=True):
+    if create:
+        os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, name)
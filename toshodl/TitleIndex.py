@@ -0,0 +1,137 @@
+# A local SQLite index of Anime Tosho feed items: title => id, plus the
+# rest of the feed entry.  It lives in the state directory and is filled in
+# incrementally from the feed, so lookups don't need to hit the network.
+#
+# The "meta" table remembers the highest feed id we've seen (the high-water
+# mark) and when the index was last brought up to date.
+#
+# For fuzzier matching, each title also has a normalized form: lowercase,
+# with brackets, punctuation and extra whitespace squashed to single spaces.
+# Those are indexed by trigram in an FTS5 table so substring searches don't
+# have to scan every title.  If this SQLite doesn't have FTS5's trigram
+# tokenizer, the searches still work, just by scanning.
+
+import re
+import json
+import time
+import sqlite3
+
+from toshodl import StateDir
+
+class TitleIndex(object):
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = StateDir.path('titles.sqlite')
+        self.db = sqlite3.connect(filename)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS titles (
+                id          INTEGER PRIMARY KEY,
+                title       TEXT NOT NULL,
+                timestamp   INTEGER,
+                status      TEXT,
+                total_size  INTEGER,
+                num_files   INTEGER,
+                item        TEXT
+            );
+            CREATE INDEX IF NOT EXISTS titles_title ON titles(title);
+            CREATE TABLE IF NOT EXISTS meta (
+                key         TEXT PRIMARY KEY,
+                value       TEXT
+            );
+        ''')
+
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(titles)') ]
+        if 'norm' not in columns:
+            with self.db:
+                self.db.execute('ALTER TABLE titles ADD COLUMN norm TEXT')
+                for id, title in self.db.execute('SELECT id, title FROM titles').fetchall():
+                    self.db.execute('UPDATE titles SET norm = ? WHERE id = ?', (normalize(title), id))
+
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5(norm, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        if self.fts:
+            (indexed,) = self.db.execute('SELECT count(*) FROM titles_fts').fetchone()
+            (total,) = self.db.execute('SELECT count(*) FROM titles').fetchone()
+            if indexed != total:
+                with self.db:
+                    self.db.execute('DELETE FROM titles_fts')
+                    self.db.execute('INSERT INTO titles_fts (rowid, norm) SELECT id, norm FROM titles')
+
+    # items are dicts from the feed's json API
+    def add(self, items):
+        rows = [ (item['id'], item['title'], normalize(item['title']), item.get('timestamp'), item.get('status'),
+                  item.get('total_size'), item.get('num_files'), json.dumps(item))
+                 for item in items ]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO titles (id, title, norm, timestamp, status, total_size, num_files, item) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                rows)
+            if self.fts:
+                self.db.executemany('INSERT OR REPLACE INTO titles_fts (rowid, norm) VALUES (?, ?)',
+                                    [ (row[0], row[2]) for row in rows ])
+
+    # The id for exactly this title, or None
+    def lookup(self, title):
+        row = self.db.execute('SELECT id FROM titles WHERE title = ? ORDER BY id DESC LIMIT 1', (title,)).fetchone()
+        return row[0] if row else None
+
+    # { title: id } for all titles containing key
+    def substring_matches(self, key):
+        return { title: id for title, id, norm in self.candidates(key, normalized=False) }
+
+    # Titles containing key once both are normalized, as a list of
+    # (title, id), best match first: the ones where key covers more of the
+    # title, then the newer ones
+    def normalized_matches(self, key, limit=None):
+        norm_key = normalize(key)
+        if not norm_key:
+            return [ ]
+        rows = self.candidates(norm_key, normalized=True)
+        ranked = sorted(rows, key=lambda row: (-len(norm_key) / max(len(row[2]), 1), -row[1]))
+        return [ (title, id) for title, id, norm in ranked[:limit] ]
+
+    # Rows with key in the title (or norm) column.  The trigram index can
+    # narrow it down when key is long enough; instr() makes the final call
+    # since trigram matching is case-insensitive
+    def candidates(self, key, normalized):
+        column = 'norm' if normalized else 'title'
+        fts_key = key if normalized else normalize(key)
+        if self.fts and len(fts_key) >= 3:
+            return self.db.execute(f'SELECT title, id, norm FROM titles WHERE id IN (SELECT rowid FROM titles_fts WHERE titles_fts MATCH ?) AND instr({ column }, ?) > 0',
+                                   (fts_phrase(fts_key), key)).fetchall()
+        return self.db.execute(f'SELECT title, id, norm FROM titles WHERE instr({ column }, ?) > 0', (key,)).fetchall()
+
+    def all_titles(self):
+        return self.db.execute('SELECT title, id FROM titles ORDER BY id')
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def high_water(self):
+        return self.get_meta('high_water')
+
+    def set_high_water(self, id):
+        self.set_meta('high_water', id)
+
+    def last_refresh(self):
+        return self.get_meta('last_refresh', 0)
+
+    def set_last_refresh(self, when=None):
+        self.set_meta('last_refresh', when if when is not None else time.time())
+
+
+# Lowercase, and turn runs of anything that isn't a letter or digit
+# (brackets, punctuation, underscores, whitespace) into a single space
+def normalize(title):
+    return re.sub(r'[\W_]+', ' ', title.lower()).strip()
+
+# Quote a string as an FTS5 phrase
+def fts_phrase(s):
+    return '"' + s.replace('"', '""') + '"'
@@ -0,0 +1,81 @@
+# A local cache of the feed API's torrent details (show=torrent), keyed by
+# tosho id, so ToshoResolver doesn't have to ask again for items it's
+# already seen.
+#
+# Once an item's status is "complete" and all its files have links, they
+# don't change, so those entries are kept until they're invalidated.
+# Anything else (still uploading, partial, ...) is only good for ttl seconds.
+#
+# It's a SQLite file in the state directory.  See tosho-cache.py for
+# preloading and invalidating entries by hand.
+
+import json
+import time
+import sqlite3
+
+from toshodl import StateDir
+
+class TorrentCache(object):
+    # How long to keep entries that aren't complete yet, in seconds
+    ttl = 10 * 60
+    immutable_statuses = [ 'complete' ]
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.db = None
+
+    def open(self):
+        if self.db is not None:
+            return self.db
+        if self.filename is None:
+            self.filename = StateDir.path('torrents.sqlite')
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS torrents (
+                id          INTEGER PRIMARY KEY,
+                status      TEXT,
+                fetched     REAL NOT NULL,
+                data        TEXT NOT NULL
+            )''')
+        return self.db
+
+    # The cached data for id, or None if it isn't there or is too old
+    def get(self, id):
+        row = self.open().execute('SELECT status, fetched, data FROM torrents WHERE id = ?', (int(id),)).fetchone()
+        if row is None:
+            return None
+        status, fetched, data = row
+        data = json.loads(data)
+        if not self.is_final(data) and time.time() - fetched > self.ttl:
+            return None
+        return data
+
+    def is_final(self, data):
+        return data.get('status') in self.immutable_statuses and has_links(data)
+
+    def put(self, id, data):
+        with self.open() as db:
+            db.execute('INSERT OR REPLACE INTO torrents (id, status, fetched, data) VALUES (?, ?, ?, ?)',
+                       (int(id), data.get('status'), time.time(), json.dumps(data)))
+
+    # Forget about the given ids, or everything if ids is None.  Returns
+    # how many were removed
+    def invalidate(self, ids=None):
+        with self.open() as db:
+            if ids is None:
+                return db.execute('DELETE FROM torrents').rowcount
+            return db.executemany('DELETE FROM torrents WHERE id = ?', [ (int(id),) for id in ids ]).rowcount
+
+    # Drop entries that have expired
+    def expire(self):
+        placeholders = ', '.join('?' for s in self.immutable_statuses)
+        with self.open() as db:
+            return db.execute(f"DELETE FROM torrents WHERE IFNULL(status, '') NOT IN ({ placeholders }) AND fetched < ?",
+                              (*self.immutable_statuses, time.time() - self.ttl)).rowcount
+
+    def ids(self):
+        return [ row[0] for row in self.open().execute('SELECT id FROM torrents ORDER BY id') ]
+
+# True if every file has at least one download link
+def has_links(data):
+    return all(f.get('links') for f in data.get('files', [ ]))
@@ -7,11 +7,20 @@ import asyncio
 from toshodl.Printable import Printable
 from toshodl.FileDownloader import FileDownloader
 from toshodl.HttpClient import HttpClient
+from toshodl.RetryPolicy import XThrottled
+from toshodl.TorrentCache import TorrentCache, has_links
+from toshodl.RepollQueue import RepollQueue
+from toshodl.Metrics import metrics
+from toshodl.JobJournal import journal
 
 complete_statuses = ['complete', 'complete_partial']
+# An item with a file that ended up in one of these failed
+failed_file_states = ['failed', 'badsum']
 
 class ToshoResolver(HttpClient):
     base_url = 'https://feed.animetosho.org/json'
+    cache = TorrentCache()
+    repoll = RepollQueue()
 
     def __init__(self, id, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -21,38 +30,67 @@ class ToshoResolver(HttpClient):
         return f'ToshoResolver { self.id }'
 
     async def query_tosho(self):
-        for retries in range(5):
-            try:
-                response = await self.client.get(self.base_url,
-                                                 params={ 'show': 'torrent', 'id': self.id })
-                self.print(f'Got response { response.status_code } for id { self.id }\n')
-                data = response.json()
-
-                if data['status'] not in complete_statuses:
-                    self.print(f"Item with id { self.id } is not complete: { data['status'] }\n")
-                    return None
-                else:
-                    # Canonicalize the "links" values so it's always a list, perhaps of even one item
-                    for f in data['files']:
-                        links = f.get('links', {})
-                        for k,v in links.items():
-                            if type(v) is not list:
-                                links[k] = [ v ]
-            except httpx.ConnectTimeout:
-                self.print(f'*** Timeout getting id { self.id } from tosho\n')
-                continue
-
+        # A previous run was already downloading it, and didn't finish
+        data = journal.item_data(self.id)
+        if data is not None:
+            self.print(f'Using journaled details for id { self.id }\n')
             return data
-        return None
+
+        data = self.cache.get(self.id)
+        if data is not None:
+            self.print(f'Using cached details for id { self.id }\n')
+        else:
+            with metrics.timer('resolve'):
+                data = await self.fetch_tosho()
+            if data is None:
+                return None
+            self.cache.put(self.id, data)
+        return data
+
+    async def fetch_tosho(self):
+        try:
+            response = await self.exception_retry(
+                lambda: self.client.get(self.base_url, params={ 'show': 'torrent', 'id': self.id }),
+                exception=httpx.TransportError, name=f'id { self.id } from tosho')
+        except (httpx.TransportError, XThrottled):
+            self.print(f'*** Could not get id { self.id } from tosho\n')
+            return None
+        self.print(f'Got response { response.status_code } for id { self.id }\n')
+        data = response.json()
+
+        # Canonicalize the "links" values so it's always a list, perhaps of even one item
+        for f in data.get('files', []):
+            links = f.get('links', {})
+            for k,v in links.items():
+                if type(v) is not list:
+                    links[k] = [ v ]
+        return data
+
+    # True if the item can be downloaded now: it's complete and its files all
+    # have links.  A partially complete item won't be getting any more links,
+    # so it's as ready as it'll ever be
+    def is_ready(self, data):
+        status = data.get('status')
+        if status == 'complete':
+            return has_links(data)
+        return status in complete_statuses
 
     async def run(self):
         self.print(f'Trying to get { self.id } from feed API\n')
+        journal.set_item_state(self.id, 'resolving')
 
         data = await self.query_tosho()
         if data is None:
             self.print('*** No response from tosho about id { self.id }\n')
             return
 
+        if not self.is_ready(data):
+            self.print(f"Item with id { self.id } is not ready: { data.get('status') }, will check again later\n")
+            journal.set_item_state(self.id, 'waiting')
+            self.repoll.add(self)
+            return
+        journal.resolved_item(self.id, data)
+
         # The 'files' key will be a list of hashes, each of which looks like:
         # { id: int
         #   filename: str
@@ -64,13 +102,16 @@ class ToshoResolver(HttpClient):
         #           'https://example.org/9876',
         #       ]
         # }
+        downloaders = [ ]
         async with asyncio.TaskGroup() as tg:
             if data['num_files'] == 1:
                 # Note that 'links' might be missing because the pieces haven't
                 # been uploaded yet
                 dl = FileDownloader(filename = data['files'][0]['filename'],
                                     md5      = data['files'][0]['md5'],
+                                    size     = data['files'][0].get('size'),
                                     links    = data['files'][0].get('links', {}))
+                downloaders.append(dl)
                 tg.create_task(dl.download())
 
             elif data['num_files'] > 1:
@@ -78,6 +119,12 @@ class ToshoResolver(HttpClient):
                     dl = FileDownloader(bundle = data['title'],
                                         filename = f['filename'],
                                         md5      = f['md5'],
+                                        size     = f.get('size'),
                                         links    = f.get('links', {}))
+                    downloaders.append(dl)
                     tg.create_task(dl.download())
 
+        failed = [ dl for dl in downloaders if (journal.file(dl.pathname) or { }).get('state') in failed_file_states ]
+        if failed:
+            self.print(f'*** { len(failed) } of the files for id { self.id } failed\n')
+        journal.set_item_state(self.id, 'failed' if failed else 'done')
@@ -1,22 +1,52 @@
+import copy
 import httpx
+import json
+import asyncio
 import logging
 import re
+import time
 
-from toshodl.Printable import Printable, flush_stdout
+from toshodl.Printable import flush_stdout
+from toshodl.HttpClient import HttpClient
+from toshodl.RetryPolicy import XThrottled
+from toshodl.TitleIndex import TitleIndex, normalize
 
 logger = logging.getLogger(__name__)
 
-class ToshoSearch(Printable):
-    def __init__(self, *args, **kwargs):
+# Titles are looked up in a persistent local index (see TitleIndex).  It's
+# brought up to date from the feed at most once every refresh_interval
+# seconds, reading feed pages newest first until reaching the items it
+# already had.
+#
+# A title matches if it's exactly the key, contains the key, or failing
+# that, contains the key after both are normalized (see TitleIndex.normalize)
+class ToshoSearch(HttpClient):
+    refresh_interval = 5 * 60
+    # Don't read more than this many feed pages catching up
+    max_catch_up_pages = 20
+    # How many candidates to list when the match is ambiguous
+    max_candidates_shown = 20
+
+    def __init__(self, index=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.client = httpx.AsyncClient(base_url='https://feed.animetosho.org')
-        self.cache = { }
+        self.client = HttpClient.pool.client(base_url='https://feed.animetosho.org')
+        self.index = index if index is not None else TitleIndex()
+        self.refresh_lock = asyncio.Lock()
+
+    # Another searcher with the same index, client and refresh lock, but
+    # that prints to stdout instead.  For running searches concurrently
+    # while keeping their output apart
+    def sharing(self, stdout):
+        other = copy.copy(self)
+        other.stdout = stdout
+        return other
 
     async def search(self, key):
-        if key in self.cache:
-            return self.cache[key]
+        found = self.index.lookup(key)
+        if found is not None:
+            return found
 
-        await self.load_one_page_of_results()
+        await self.update_index()
         found = await self.find_cache_match(key)
         if found:
             return found
@@ -36,60 +66,94 @@ class ToshoSearch(Printable):
             return key
 
         # Exact match
-        if key in self.cache:
-            return self.cache[key]
+        found = self.index.lookup(key)
+        if found is not None:
+            return found
 
         # substr match
-        matches = { title: id for title, id in self.cache.items() if title.find(key) >= 0 }
+        matches = self.index.substring_matches(key)
         if len(matches) == 1:
             return list(matches.values())[0]
         elif len(matches) > 1:
             self.print('*** There were multiple matches:\n');
             for title, id in matches.items():
                 self.print(f'\t{id} {title}\n')
+            return None
+
+        # normalized substr match
+        matches = self.index.normalized_matches(key)
+        if len(matches) == 1:
+            return matches[0][1]
+        elif len(matches) > 1:
+            if normalize(matches[0][0]) == normalize(key):
+                return matches[0][1]
+            self.print(f'*** There were { len(matches) } close matches:\n');
+            for title, id in matches[:self.max_candidates_shown]:
+                self.print(f'\t{id} {title}\n')
 
         return None
 
     @flush_stdout
     async def show_cache(self):
-        for title, id in self.cache.items():
+        for title, id in self.index.all_titles():
             self.print(f'{ id } { title }\n')
 
+    # Read feed pages until we get back to the high-water mark.  The first
+    # time through, just the newest page is read.  Concurrent callers wait
+    # for the one already refreshing instead of all reading the feed.
+    async def update_index(self, force=False):
+        if not force and time.time() - self.index.last_refresh() < self.refresh_interval:
+            return
+
+        async with self.refresh_lock:
+            if force or time.time() - self.index.last_refresh() >= self.refresh_interval:
+                await self.read_feed_pages()
+
+    async def read_feed_pages(self):
+        high_water = self.index.high_water()
+        newest = high_water
+        for page in range(self.max_catch_up_pages):
+            items = await self.load_one_page_of_results(page)
+            if not items:
+                break
+            ids = [ item['id'] for item in items ]
+            newest = max(ids + [ newest or 0 ])
+            if high_water is None or min(ids) <= high_water:
+                break
+
+        if newest is not None:
+            self.index.set_high_water(newest)
+        self.index.set_last_refresh()
+
+    async def get_json(self, params):
+        response = await self.client.get('json', params=params)
+        self.check_throttled(response)
+        return response.json()
+
     async def load_one_page_of_results(self, page = 0):
         self.print(f'Updating feed page {page}\n')
 
-        response = None
-        for retries in range(3):
-            try:
-                if page == 0:
-                    response = await self.client.get('json')
-                    break
-                else:
-                    response = await self.client.get('json',params={ 'page': page })
-                    break
-            except httpx.ConnectTimeout:
-                logger.warn("Timout getting feed page from animetosho")
-                continue
-
-        if response:
-            for item in response.json():
-                self.cache[ item['title'] ] = item['id']
-                logger.debug('Got >>%s<< id %s', item['title'], item['id'])
+        params = { 'page': page } if page else { }
+        try:
+            items = await self.exception_retry(lambda: self.get_json(params),
+                                               exception=(httpx.TransportError, json.decoder.JSONDecodeError),
+                                               name=f'feed page { page }')
+        except (httpx.TransportError, json.decoder.JSONDecodeError, XThrottled):
+            logger.warn("Couldn't get feed page from animetosho")
+            items = [ ]
+        for item in items:
+            logger.debug('Got >>%s<< id %s', item['title'], item['id'])
+        self.index.add(items)
+        return items
 
     async def search_tosho(self, key):
         self.print(f'Searching for {key}\n')
 
-        for retries in range(3):
-            try:
-                response = await self.client.get('json', params={'q': key})
-                items = response.json()
-                break
-            except httpx.ConnectTimeout:
-                logger.warn("Timout getting search results from animetosho")
-                continue
-            except json.decoder.JSONDecodeError:
-                logger.warn(f"Problem decoding json response: { reponse.text }")
-                continue
-        for item in items:
-            #logger.debug('Got >>%s<< id %s', item['title'], item['id'])
-            self.cache[ item['title'] ] = item['id']
+        try:
+            items = await self.exception_retry(lambda: self.get_json({ 'q': key }),
+                                               exception=(httpx.TransportError, json.decoder.JSONDecodeError),
+                                               name=f'search for { key }')
+        except (httpx.TransportError, json.decoder.JSONDecodeError, XThrottled):
+            logger.warn("Couldn't get search results from animetosho")
+            items = [ ]
+        self.index.add(items)